@@ -20,47 +20,42 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 from PyQt5.Qt import QWidget, QHBoxLayout, QVBoxLayout, QFormLayout, \
                      QCheckBox, QGroupBox, QLabel, QLineEdit, QRadioButton, \
                      QGridLayout, QPushButton, QIcon, QPixmap, QCompleter, \
-                     QDialogButtonBox, QDialog
+                     QDialogButtonBox, QDialog, QInputDialog, QSpinBox
 from PyQt5.QtCore import Qt
 from calibre.utils.config import JSONConfig
 
 import webbrowser
-import json
+
+from .lib.prefs import DEFAULTS
+from .lib.rules import load_rule_tables
 
 
 class Config():
     """Class to store/retrieve preference data within Calibre"""
 
-    DEFAULTS = {
-        "force_override": False,
-        "heuristic": {"title_override": False, "type_footnotes": False},
-        "access": {
-            "accessibilitySummary": ["This publication conforms to WCAG 2.0 AA."],
-            "accessMode": ["textual", "visual"],
-            "accessModeSufficient": ["textual"],
-            "accessibilityFeature": ["structuralNavigation", "alternativeText"],
-            "accessibilityHazard": ["unknown"],
-        },
-        "a11y": {
-            "enabled": False,
-            "certifiedBy": "",
-            "certifierCredential": "",
-            "certifierReport": "",
-        },
-        "dcterms": {"conformsTo": ""},
-    }
+    DEFAULTS = DEFAULTS
 
     def __init__(self):
         self.prefs = JSONConfig('plugins/access_aide')
         if not self.prefs:
             self.prefs.defaults = self.DEFAULTS
 
+        # named profiles, as {name: prefs}
+        self.profiles = JSONConfig('plugins/access_aide_profiles')
+
     def get_prefs(self):
         return self.prefs
 
     def store_prefs(self, prefs):
         self.prefs = prefs
 
+    def get_profiles(self):
+        return self.profiles
+
+    def store_profile(self, name, prefs):
+        self.profiles[name] = {key: prefs[key] for key in self.DEFAULTS
+                               if key in prefs}
+
 
 class Completer(QCompleter):
 
@@ -118,8 +113,57 @@ class ConfigWidget(QDialog):
                                        'overwritten.')
         self.force_override.setChecked(self.prefs.get('force_override', False))
 
+        self.savepoint = QCheckBox('Full savepoint before running', self)
+        self.savepoint.setToolTip('When checked, a copy of the whole book '
+                                  'is kept for the editor undo. Otherwise, '
+                                  'only the changes are recorded, and can '
+                                  'be undone with "Undo Access Aide".')
+        self.savepoint.setChecked(self.prefs.get('savepoint', False))
+
+        self.image_report = QCheckBox('Report images without alt text', self)
+        self.image_report.setToolTip('When checked, lists every image of '
+                                     'the book with its alt text status, '
+                                     'size and format, and reports the '
+                                     'alt text coverage.')
+        self.image_report.setChecked(self.prefs.get('image_report', False))
+
+        self.audit = QCheckBox('Check for issues to fix by hand', self)
+        self.audit.setToolTip('When checked, reports heading level skips, '
+                              'tables without headers, links without '
+                              'text, unknown epub:type values and titles '
+                              'differing from the first <h1>.')
+        self.audit.setChecked(self.prefs.get('audit', False))
+
+        self.infer_access = QCheckBox('Infer accessibility metadata', self)
+        self.infer_access.setToolTip('When checked, accessibilityFeature, '
+                                     'accessMode, accessModeSufficient and '
+                                     'accessibilitySummary are inferred '
+                                     'from the content of the book, '
+                                     'instead of taken from the values '
+                                     'below.')
+        self.infer_access.setChecked(self.prefs.get('infer_access', False))
+
+        self.memory_budget = QSpinBox(self)
+        self.memory_budget.setRange(0, 65536)
+        self.memory_budget.setSuffix(' MB')
+        self.memory_budget.setSpecialValueText('No limit')
+        self.memory_budget.setToolTip('Memory the parsed documents may take '
+                                      'during a run. Past it, documents '
+                                      'are saved and unloaded as soon as '
+                                      'they are done, so that large books '
+                                      'do not fill the memory.')
+        self.memory_budget.setValue(int(self.prefs.get('memory_budget', 0)))
+        memory = QHBoxLayout()
+        memory.addWidget(QLabel('Memory budget:', self))
+        memory.addWidget(self.memory_budget)
+
         vbox = QVBoxLayout()
         vbox.addWidget(self.force_override)
+        vbox.addWidget(self.savepoint)
+        vbox.addWidget(self.image_report)
+        vbox.addWidget(self.audit)
+        vbox.addWidget(self.infer_access)
+        vbox.addLayout(memory)
         vbox.addStretch(1)
         group_box.setLayout(vbox)
 
@@ -142,9 +186,19 @@ class ConfigWidget(QDialog):
         self.type_fn.setChecked(self.prefs.get('heuristic', {}) \
                                      .get('type_footnotes', False))
 
+        self.passage_lang = QCheckBox('Add lang to passages in other '
+                                      'languages', self)
+        self.passage_lang.setToolTip('When checked, detects paragraphs, '
+                                     'quotations and other blocks written '
+                                     'in a language other than the book '
+                                     'one and declares their language.')
+        self.passage_lang.setChecked(self.prefs.get('heuristic', {}) \
+                                          .get('passage_lang', False))
+
         vbox = QVBoxLayout()
         vbox.addWidget(self.title_override)
         vbox.addWidget(self.type_fn)
+        vbox.addWidget(self.passage_lang)
         vbox.addStretch(1)
         group_box.setLayout(vbox)
 
@@ -196,8 +250,7 @@ class ConfigWidget(QDialog):
         self.acc_feat.setPlaceholderText('structuralNavigation '
                                          'alternativeText')
 
-        feat_list = json.loads(get_resources('assets/acc_feature_values.json'))
-        completer = Completer(feat_list)
+        completer = Completer(list(load_rule_tables().features))
         self.acc_feat.setCompleter(completer)
 
         # accessibilityHazard
@@ -318,6 +371,12 @@ class ConfigWidget(QDialog):
         buttonBox.accepted.connect(self.accept)
         buttonBox.rejected.connect(self.reject)
 
+        save = buttonBox.addButton('Save as Profile...',
+                                   QDialogButtonBox.ActionRole)
+        save.setToolTip('Save these preferences as a named profile, which '
+                        'gets its own action and shortcut in the editor.')
+        save.clicked.connect(self.save_profile)
+
         return buttonBox
 
     def accept(self):
@@ -327,6 +386,13 @@ class ConfigWidget(QDialog):
     def reject(self):
         super().reject()
 
+    def save_profile(self):
+        name, ok = QInputDialog.getText(self, 'Access Aide',
+                                        'Profile name:')
+        if ok and name.strip():
+            self.gather_data()
+            self.config.store_profile(name.strip(), self.prefs)
+
     def gather_data(self):
 
         # accessMode
@@ -370,9 +436,15 @@ class ConfigWidget(QDialog):
                 access_hazard.append('noSoundHazard')
 
         self.prefs['force_override'] = self.force_override.isChecked()
+        self.prefs['savepoint'] = self.savepoint.isChecked()
+        self.prefs['image_report'] = self.image_report.isChecked()
+        self.prefs['audit'] = self.audit.isChecked()
+        self.prefs['infer_access'] = self.infer_access.isChecked()
+        self.prefs['memory_budget'] = self.memory_budget.value()
         self.prefs['heuristic'] = {
             'title_override': self.title_override.isChecked(),
-            'type_footnotes': self.type_fn.isChecked()
+            'type_footnotes': self.type_fn.isChecked(),
+            'passage_lang': self.passage_lang.isChecked()
             }
         self.prefs['access'] = {
             'accessibilitySummary': [self.acc_summ.text()],
@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+'''
+Access Aide - A Calibre plugin to enhance accessibility features in epub files.
+Copyright (C) 2020-2021 Luca Baffa
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+import hashlib
+from collections import namedtuple
+
+import lxml.etree
+
+try:
+    from .images import IMG_TAGS
+except ImportError:
+    from images import IMG_TAGS
+
+# bump when checks change, so that cached findings are not reused
+AUDIT_VERSION = 1
+
+CHECKS = ('heading-skip', 'table-headers', 'empty-link', 'unknown-epub-type',
+          'title-mismatch')
+
+HEADINGS = ('h1', 'h2', 'h3', 'h4', 'h5', 'h6')
+
+# `line` is the line of the element in the document, None if unknown
+Finding = namedtuple('Finding', ['document', 'check', 'line', 'message'])
+
+
+def findings_key(data, rules_digest):
+    '''Return the cache key of the findings of a document, audited with
+    the rule tables of digest `rules_digest`.
+
+    Findings only depend on the document content and the known epub:type
+    values, as the audit sees each element before the rules change it.
+    '''
+
+    h = hashlib.sha256(data)
+    h.update('\0audit\0{}\0{}'.format(AUDIT_VERSION,
+                                      rules_digest).encode('utf-8'))
+    return h.hexdigest()
+
+
+def text(node):
+    return ' '.join(''.join(node.itertext()).split())
+
+
+class Auditor():
+    '''Accessibility checks run by the 'audit' rule of the engine walk.
+
+    Its methods are called on elements as the engine finds them (see
+    `Engine.compile_rules()`); `finish()` returns the (check, line,
+    message) findings of the document, and `reset()` readies the auditor
+    for the next one.
+    '''
+
+    def __init__(self, types):
+        # epub:type values of `epubtype-aria-map.json`
+        self.types = types
+        self.reset()
+
+    def reset(self):
+        self.findings = []
+        self.level = 0
+        self.title = self.h1 = None
+
+    def add(self, check, node, message):
+        self.findings.append((check, node.sourceline, message))
+
+    def heading(self, node):
+        level = int(node.tag[-1])
+
+        if self.level and level > self.level + 1:
+            self.add('heading-skip', node,
+                     '<h{}> follows <h{}>'.format(level, self.level))
+        self.level = level
+
+        if level == 1 and self.h1 is None:
+            self.h1 = node
+
+    def title_node(self, node):
+        if self.title is None:
+            self.title = node
+
+    def table(self, node):
+        for child in node.iter(lxml.etree.Element):
+            if child.tag.rpartition('}')[2] == 'th' or child.get('scope'):
+                return
+
+        self.add('table-headers', node, 'Table without <th> or scope')
+
+    def link(self, node):
+        href = node.get('href')
+        if href is None or text(node):
+            return
+
+        for attribute in ('aria-label', 'aria-labelledby', 'title'):
+            if (node.get(attribute) or '').strip():
+                return
+
+        for img in node.iter(IMG_TAGS):
+            if (img.get('alt') or '').strip():
+                return
+
+        self.add('empty-link', node, 'Link to {} without text'.format(href))
+
+    def epub_type(self, node, value):
+        for token in value.split():
+            # prefixed values belong to other vocabularies
+            if ':' not in token and token not in self.types:
+                self.add('unknown-epub-type', node,
+                         'epub:type "{}" has no aria role mapping'
+                         .format(token))
+
+    def finish(self):
+        if self.title is not None and self.h1 is not None:
+            title, h1 = text(self.title), text(self.h1)
+            if title != h1:
+                self.add('title-mismatch', self.title,
+                         '<title> "{}" differs from <h1> "{}"'
+                         .format(title, h1))
+
+        return self.findings
+
+
+def count_findings(findings):
+    '''Return the number of findings of each check.'''
+
+    counts = dict.fromkeys(CHECKS, 0)
+    for finding in findings:
+        counts[finding.check] += 1
+
+    return counts
@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+'''
+Access Aide - A Calibre plugin to enhance accessibility features in epub files.
+Copyright (C) 2020-2021 Luca Baffa
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+import os
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+try:
+    from .container import EpubContainer
+    from .engine import Engine
+    from .rules import load_rule_tables
+    from .cache import ResultCache
+    from .metrics import Metrics
+    from .report import build_report, error_entry
+    from .profiles import compile_plan
+except ImportError:
+    from container import EpubContainer
+    from engine import Engine
+    from rules import load_rule_tables
+    from cache import ResultCache
+    from metrics import Metrics
+    from report import build_report, error_entry
+    from profiles import compile_plan
+
+# per-process state, set once by `init_worker`
+_worker_prefs = None
+_worker_plan = None
+_worker_cache = None
+_worker_stream_threshold = None
+_worker_trace = False
+
+
+def process_book(src, dst, prefs, jobs=None, cache=None,
+                 stream_threshold=None, metrics=None, run_plan=None):
+    '''Run Access Aide on the `src` EPUB and write the result to `dst`.
+
+    `jobs` is the number of worker processes used for the documents of
+    the book, `cache` an optional `ResultCache`, `stream_threshold` the
+    size in bytes above which documents are streamed, `metrics` the
+    `Metrics` registry to update and `run_plan` the prefs compiled
+    beforehand, if any. Returns the engine used, so that callers can read
+    its stats.
+    '''
+
+    engine = Engine(prefs, cache=cache, stream_threshold=stream_threshold,
+                    metrics=metrics, run_plan=run_plan)
+
+    with engine.metrics.timer('load'):
+        container = EpubContainer(src)
+    try:
+        engine.run(container, jobs=jobs)
+        with engine.metrics.timer('commit'):
+            container.commit(dst)
+    finally:
+        container.close()
+
+    return engine
+
+
+def init_worker(prefs, cache_path=None, cache_size=None,
+                stream_threshold=None, trace=False):
+    '''Load prefs and rule tables, compile the run plan (and open the
+    cache) once per worker process.'''
+
+    global _worker_prefs, _worker_plan, _worker_cache, \
+        _worker_stream_threshold, _worker_trace
+    _worker_prefs = prefs
+    _worker_plan = compile_plan(prefs)
+    _worker_stream_threshold = stream_threshold
+    _worker_trace = trace
+    load_rule_tables()
+
+    if cache_path is not None:
+        _worker_cache = ResultCache(cache_path, cache_size)
+
+
+def add_engine_stats(result, engine):
+    result['stats'] = {stat.desc: stat.get() for stat in engine.stats()}
+    for key in ('files_changed', 'files_skipped', 'cache_hits',
+                'cache_misses'):
+        result[key] = engine.counters[key]
+
+
+def book_report(engine, snapshot, src, errors):
+    '''Return the report of a book, with the same sections as that of
+    `cli run`, unless the book failed before the engine was set up.'''
+
+    if engine is None:
+        return build_report(snapshot, book=src, errors=errors)
+    return engine.report(book=src, errors=errors)
+
+
+def process_members(src, members):
+    '''Transform the members of a book, already read and inflated, in a
+    worker process (see `lib.pipeline`).
+
+    Changed documents are serialised here, as parsed trees cannot leave
+    the process. Returns the {name: content} of the changed (or new)
+    members, and the result of the book in the shape of `process_one()`.
+    '''
+
+    result = {'input': src, 'ok': True, 'error': None, 'stats': {}}
+    start = time.perf_counter()
+    metrics = Metrics(trace=_worker_trace)
+    engine = None
+    errors = []
+    changed = {}
+
+    try:
+        engine = Engine(_worker_prefs, cache=_worker_cache,
+                        stream_threshold=_worker_stream_threshold,
+                        metrics=metrics, run_plan=_worker_plan)
+        container = EpubContainer(src, members)
+        engine.run(container)
+        with metrics.timer('serialise'):
+            container.flush()
+
+        changed = container.changed()
+        add_engine_stats(result, engine)
+    except Exception as e:
+        result['ok'] = False
+        result['error'] = '{}: {}'.format(type(e).__name__, e)
+        result['traceback'] = traceback.format_exc()
+        errors.append(error_entry(e))
+
+    result['seconds'] = time.perf_counter() - start
+    result['metrics'] = metrics.snapshot()
+    result['report'] = book_report(engine, result['metrics'], src, errors)
+
+    return changed, result
+
+
+def process_one(src, dst):
+    '''Process a single book in a worker process.
+
+    Exceptions are caught and reported in the result, so that a broken
+    book never aborts the whole batch.
+    '''
+
+    result = {'input': src, 'output': dst, 'ok': True, 'error': None,
+              'stats': {}}
+    start = time.perf_counter()
+    metrics = Metrics(trace=_worker_trace)
+    engine = None
+    errors = []
+
+    try:
+        os.makedirs(os.path.dirname(dst) or '.', exist_ok=True)
+        engine = process_book(src, dst, _worker_prefs, cache=_worker_cache,
+                              stream_threshold=_worker_stream_threshold,
+                              metrics=metrics, run_plan=_worker_plan)
+        add_engine_stats(result, engine)
+    except Exception as e:
+        result['ok'] = False
+        result['error'] = '{}: {}'.format(type(e).__name__, e)
+        result['traceback'] = traceback.format_exc()
+        errors.append(error_entry(e))
+
+    result['seconds'] = time.perf_counter() - start
+    result['metrics'] = metrics.snapshot()
+    result['report'] = book_report(engine, result['metrics'], src, errors)
+
+    return result
+
+
+def find_books(directory, recursive=False):
+    '''Return the sorted list of EPUB files in `directory`.'''
+
+    books = []
+    for root, dirs, files in os.walk(directory):
+        books.extend(os.path.join(root, f) for f in files
+                     if f.lower().endswith('.epub'))
+        if not recursive:
+            break
+
+    return sorted(books)
+
+
+def run_batch(books, src_dir, dst_dir, prefs, jobs=None, cache_path=None,
+              cache_size=None, stream_threshold=None, trace=False):
+    '''Process `books` across a pool of `jobs` worker processes.
+
+    Results are yielded as soon as each book is done, in completion
+    order. Output files mirror the layout of `src_dir` in `dst_dir`.
+    Workers share the result cache at `cache_path`, if given. Each result
+    holds a snapshot of the book metrics, with trace events if `trace`
+    is set.
+    '''
+
+    with ProcessPoolExecutor(max_workers=jobs, initializer=init_worker,
+                             initargs=(prefs, cache_path, cache_size,
+                                       stream_threshold, trace)) as executor:
+        futures = {}
+        for src in books:
+            dst = os.path.join(dst_dir, os.path.relpath(src, src_dir))
+            futures[executor.submit(process_one, src, dst)] = (src, dst)
+
+        for future in as_completed(futures):
+            try:
+                yield future.result()
+            except Exception as e:
+                # the worker itself died (e.g. killed by the OS)
+                src, dst = futures[future]
+                yield {'input': src, 'output': dst, 'ok': False,
+                       'error': '{}: {}'.format(type(e).__name__, e),
+                       'stats': {}, 'seconds': 0.0,
+                       'report': build_report(Metrics().snapshot(), book=src,
+                                              errors=[error_entry(e)])}
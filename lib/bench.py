@@ -0,0 +1,261 @@
+#!/usr/bin/env python3
+'''
+Access Aide - A Calibre plugin to enhance accessibility features in epub files.
+Copyright (C) 2020-2021 Luca Baffa
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from collections import namedtuple
+
+import lxml.etree
+
+try:
+    from .container import EpubContainer, OEB_DOCS, parse_xml, serialize
+    from .engine import Engine
+    from .prefs import merge_prefs
+    from .synth import BookSpec, make_book
+except ImportError:
+    from container import EpubContainer, OEB_DOCS, parse_xml, serialize
+    from engine import Engine
+    from prefs import merge_prefs
+    from synth import BookSpec, make_book
+
+BENCH_VERSION = 1
+
+STAGES = ('parse', 'add_lang', 'add_aria', 'override_title', 'add_fn_type',
+          'transform', 'add_metadata', 'add_a11y', 'serialise')
+
+# books every benchmark run is made of; change a spec (or add one) only
+# together with the saved baselines
+SUITE = {
+    'epub2': BookSpec(version=2),
+    'epub3': BookSpec(version=3),
+    'epub3-large-documents': BookSpec(documents=4, paragraphs=2500),
+    'epub3-many-documents': BookSpec(documents=300, paragraphs=10),
+    'epub3-footnotes': BookSpec(type_density=0.4, footnote_density=0.5),
+    'epub3-metadata': BookSpec(documents=2, metadata=3000),
+}
+
+# every rule enabled, so that no stage is a no-op
+PREFS = {
+    'heuristic': {'title_override': True, 'type_footnotes': True},
+    'a11y': {'certifiedBy': 'Access Aide benchmark'},
+    'dcterms': {'conformsTo': 'EPUB Accessibility 1.1 - WCAG 2.1 AA'},
+}
+
+# time allowed to import the engine in a fresh interpreter, so that
+# worker processes and short command line runs start fast
+IMPORT_BUDGET = 0.050
+
+LIB_DIR = os.path.dirname(os.path.abspath(__file__))
+
+IMPORT_CODE = '''
+import json, sys, time
+sys.path.insert(0, {lib!r})
+start = time.perf_counter()
+import engine
+seconds = time.perf_counter() - start
+gui = sorted(m for m in sys.modules
+             if m.split('.')[0] in ('PyQt5', 'PyQt6', 'qt') or
+             m.startswith('calibre.gui2'))
+print(json.dumps({{'seconds': seconds, 'gui': gui}}))
+'''
+
+Regression = namedtuple('Regression', ['book', 'stage', 'baseline', 'current'])
+
+
+def time_pass(path, prefs):
+    '''Run every stage once on the book at `path`, timing each of them.
+
+    Document rules run one after the other on the same tree, as separate
+    walks; `transform` is the fused walk, timed on a fresh tree.
+    '''
+
+    times = dict.fromkeys(STAGES, 0.0)
+    clock = time.perf_counter
+
+    container = EpubContainer(path)
+    engine = Engine(prefs)
+    lang = engine.get_lang(container)
+
+    docs = [name for name, media_type in container.mime_map.items()
+            if media_type in OEB_DOCS]
+
+    for name in docs:
+        data = container.raw_data(name, decode=False)
+
+        start = clock()
+        root = parse_xml(data)
+        times['parse'] += clock() - start
+
+        for stage, args in (('add_lang', (root, lang)),
+                            ('add_aria', (root,)),
+                            ('override_title', (root,)),
+                            ('add_fn_type', (root,))):
+            start = clock()
+            getattr(engine, stage)(*args)
+            times[stage] += clock() - start
+
+        fresh = parse_xml(data)
+        start = clock()
+        engine.transform(fresh, lang)
+        times['transform'] += clock() - start
+
+        start = clock()
+        serialize(fresh)
+        times['serialise'] += clock() - start
+
+    # the OPF is parsed when the container is opened, not timed here
+    opf = container.opf
+
+    for stage in ('add_metadata', 'add_a11y'):
+        start = clock()
+        getattr(engine, stage)(container)
+        times[stage] += clock() - start
+
+    start = clock()
+    serialize(opf)
+    times['serialise'] += clock() - start
+
+    return times
+
+
+def time_book(path, prefs, repeat=3):
+    '''Return the best time of each stage over `repeat` passes.'''
+
+    best = None
+    for _ in range(repeat):
+        times = time_pass(path, prefs)
+        if best is None:
+            best = times
+        else:
+            best = {stage: min(best[stage], times[stage]) for stage in best}
+
+    return best
+
+
+def time_import(repeat=3):
+    '''Return the best time to import the engine in a fresh interpreter,
+    along with the GUI modules it pulled in (there should be none).'''
+
+    best = None
+    for _ in range(repeat):
+        output = subprocess.check_output(
+            [sys.executable, '-c', IMPORT_CODE.format(lib=LIB_DIR)])
+        data = json.loads(output)
+        if best is None or data['seconds'] < best['seconds']:
+            best = data
+
+    return best['seconds'], best['gui']
+
+
+def run_suite(suite=None, repeat=3, prefs=None, directory=None):
+    '''Generate the books of `suite` and time them.
+
+    Books are written to `directory`, or to a temporary folder removed
+    afterwards. The import time of the engine is reported as the
+    `import` stage of the `core` book. Returns the results, ready to be
+    saved as a baseline.
+    '''
+
+    suite = SUITE if suite is None else suite
+    prefs = merge_prefs(PREFS if prefs is None else prefs)
+
+    results = {
+        'version': BENCH_VERSION,
+        'python': platform.python_version(),
+        'lxml': '.'.join(str(part) for part in lxml.etree.LXML_VERSION),
+        'repeat': repeat,
+        'books': {},
+    }
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for name, spec in suite.items():
+            path = os.path.join(directory or tmp, name + '.epub')
+            make_book(path, spec)
+
+            results['books'][name] = {
+                'spec': spec.as_dict(),
+                'size': os.path.getsize(path),
+                'stages': time_book(path, prefs, repeat),
+            }
+
+    seconds, gui = time_import(repeat)
+    results['books']['core'] = {'spec': {'budget': IMPORT_BUDGET},
+                                'size': 0, 'gui_modules': gui,
+                                'stages': {'import': seconds}}
+
+    return results
+
+
+def compare(results, baseline, threshold=0.25, min_delta=0.002):
+    '''Return the stages slower than in `baseline`.
+
+    A stage regressed when it takes more than `threshold` (a fraction)
+    longer than in the baseline, and at least `min_delta` seconds more, so
+    that noise on very short stages is not reported. Books missing from
+    either side, or generated from a different spec, are not compared.
+    '''
+
+    if baseline.get('version') != results.get('version'):
+        raise ValueError('Baseline version {} does not match {}'.format(
+            baseline.get('version'), results.get('version')))
+
+    regressions = []
+    for book, current in results['books'].items():
+        previous = baseline['books'].get(book)
+        if previous is None or previous['spec'] != current['spec']:
+            continue
+
+        for stage, seconds in current['stages'].items():
+            before = previous['stages'].get(stage)
+            if before is None:
+                continue
+
+            if seconds > before * (1 + threshold) and \
+               seconds - before > min_delta:
+                regressions.append(Regression(book, stage, before, seconds))
+
+    return regressions
+
+
+def format_results(results, regressions=()):
+    '''Return the results as a table, flagging regressed stages.'''
+
+    flagged = {(r.book, r.stage): r for r in regressions}
+
+    lines = ['{:<24} {:<16} {:>10}'.format('book', 'stage', 'ms')]
+    for book, data in results['books'].items():
+        for stage, seconds in data['stages'].items():
+            line = '{:<24} {:<16} {:>10.2f}'.format(book, stage,
+                                                    seconds * 1000)
+            if book == 'core' and seconds > IMPORT_BUDGET:
+                line += '  OVER BUDGET ({:.0f} ms)'.format(
+                    IMPORT_BUDGET * 1000)
+            regression = flagged.get((book, stage))
+            if regression is not None:
+                line += '  REGRESSION (baseline {:.2f} ms)'.format(
+                    regression.baseline * 1000)
+            lines.append(line)
+
+    return lines
@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+'''
+Access Aide - A Calibre plugin to enhance accessibility features in epub files.
+Copyright (C) 2020-2021 Luca Baffa
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+import hashlib
+import json
+import os
+import sqlite3
+import time
+
+DEFAULT_SIZE = 512 * 1024 * 1024
+
+
+class ResultCache():
+    '''Persistent cache of transformed documents.
+
+    Entries are keyed by the digest of the document bytes, the prefs, the
+    book language, the rule files and the engine version (see `key()`),
+    and hold the transformed
+    bytes (None if the transform left the document untouched) along with
+    the stat deltas of the transform. The cache is a SQLite file, so that
+    it can be shared by batch worker processes. When it grows over
+    `max_size` bytes, least recently used entries are evicted.
+
+    Audit findings are stored as entries too, under the keys of
+    `lib.audit.findings_key()`, with no output and the findings in place
+    of the deltas.
+    '''
+
+    def __init__(self, path, max_size=DEFAULT_SIZE):
+        self.path = path
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.conn = sqlite3.connect(path, timeout=60)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        with self.conn:
+            self.conn.execute('CREATE TABLE IF NOT EXISTS entries ('
+                              'key TEXT PRIMARY KEY, output BLOB, '
+                              'deltas TEXT, size INTEGER, used REAL)')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS entries_used '
+                              'ON entries (used)')
+            self.conn.execute('CREATE TABLE IF NOT EXISTS meta ('
+                              'name TEXT PRIMARY KEY, value INTEGER)')
+            self.conn.execute('INSERT OR IGNORE INTO meta VALUES (?, 0)',
+                              ('size',))
+
+    @staticmethod
+    def key(data, prefs_hash, lang, rules_digest, version):
+        '''Return the key of a document transformed with the prefs of
+        digest `prefs_hash`, the rule tables of digest `rules_digest`
+        (see `lib.rules.RuleTables`) and the engine `version`.'''
+
+        h = hashlib.sha256(data)
+        h.update('\0{}\0{}\0{}\0{}'.format(prefs_hash, lang, rules_digest,
+                                           version).encode('utf-8'))
+        return h.hexdigest()
+
+    def get(self, key):
+        '''Return (output, deltas) for `key`, None on a miss.'''
+
+        row = self.conn.execute('SELECT output, deltas FROM entries '
+                                'WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+
+        with self.conn:
+            self.conn.execute('UPDATE entries SET used = ? WHERE key = ?',
+                              (time.time(), key))
+
+        self.hits += 1
+        return row[0], json.loads(row[1])
+
+    def put(self, key, output, deltas):
+        deltas = json.dumps(deltas)
+        size = len(key) + len(deltas) + (len(output) if output else 0)
+
+        with self.conn:
+            row = self.conn.execute('SELECT size FROM entries '
+                                    'WHERE key = ?', (key,)).fetchone()
+            old_size = row[0] if row else 0
+
+            self.conn.execute('INSERT OR REPLACE INTO entries '
+                              'VALUES (?, ?, ?, ?, ?)',
+                              (key, output, deltas, size, time.time()))
+            self.conn.execute('UPDATE meta SET value = value + ? '
+                              'WHERE name = ?', (size - old_size, 'size'))
+
+        self.evict()
+
+    def size(self):
+        return self.conn.execute('SELECT value FROM meta WHERE name = ?',
+                                 ('size',)).fetchone()[0]
+
+    def evict(self):
+        '''Drop least recently used entries until under `max_size`.'''
+
+        excess = self.size() - self.max_size
+        while excess > 0:
+            with self.conn:
+                rows = self.conn.execute('SELECT key, size FROM entries '
+                                         'ORDER BY used LIMIT 64').fetchall()
+                if not rows:
+                    self.conn.execute('UPDATE meta SET value = 0 '
+                                      'WHERE name = ?', ('size',))
+                    return
+
+                evicted = []
+                freed = 0
+                for key, size in rows:
+                    evicted.append(key)
+                    freed += size
+                    if freed >= excess:
+                        break
+                excess -= freed
+
+                self.conn.executemany('DELETE FROM entries WHERE key = ?',
+                                      [(key,) for key in evicted])
+                self.conn.execute('UPDATE meta SET value = value - ? '
+                                  'WHERE name = ?',
+                                  (freed, 'size'))
+
+    def close(self):
+        self.conn.close()
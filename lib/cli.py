@@ -0,0 +1,487 @@
+#!/usr/bin/env python3
+'''
+Access Aide - A Calibre plugin to enhance accessibility features in epub files.
+Copyright (C) 2020-2021 Luca Baffa
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+import argparse
+import html
+import json
+import os
+import sys
+import zipfile
+
+try:
+    from .batch import process_book, find_books, run_batch
+    from .pipeline import BookPipeline, format_stats
+    from .container import EpubContainer
+    from .engine import Engine, AccessAideError
+    from .plan import apply_plan
+    from .prefs import load_prefs
+    from .profiles import ProfileError, get_profile
+    from .cache import ResultCache
+    from .metrics import Metrics
+    from .report import (append_report, build_report, error_entry,
+                         write_report)
+except ImportError:
+    from batch import process_book, find_books, run_batch
+    from pipeline import BookPipeline, format_stats
+    from container import EpubContainer
+    from engine import Engine, AccessAideError
+    from plan import apply_plan
+    from prefs import load_prefs
+    from profiles import ProfileError, get_profile
+    from cache import ResultCache
+    from metrics import Metrics
+    from report import (append_report, build_report, error_entry,
+                        write_report)
+
+
+def get_prefs(args):
+    '''Return the prefs of the --profile given, or of the --prefs file.'''
+
+    if args.profile is None:
+        prefs = load_prefs(args.prefs)
+    else:
+        prefs = get_profile(args.profile)
+
+    if getattr(args, 'memory_budget', None) is not None:
+        prefs = dict(prefs, memory_budget=args.memory_budget)
+
+    return prefs
+
+
+def cache_size(args):
+    return args.cache_size * 1024 * 1024
+
+
+def stream_threshold(args):
+    if args.stream_threshold is None:
+        return None
+    return args.stream_threshold * 1024 * 1024
+
+
+def import_bench():
+    # the benchmark is only needed by its own command
+    try:
+        from . import bench
+    except ImportError:
+        import bench
+    return bench
+
+
+def import_server():
+    # asyncio and the service are only needed by their own command
+    try:
+        from . import server
+    except ImportError:
+        import server
+    return server
+
+
+def write_metrics(args, metrics):
+    if args.metrics:
+        with open(args.metrics, 'w', encoding='utf-8') as f:
+            f.write(metrics.to_json(indent=2))
+
+    if args.trace:
+        with open(args.trace, 'w', encoding='utf-8') as f:
+            json.dump(metrics.chrome_trace(), f)
+
+
+def cmd_run(args):
+    prefs = get_prefs(args)
+    cache = None
+    if args.cache:
+        cache = ResultCache(args.cache, cache_size(args))
+    metrics = Metrics(trace=bool(args.trace))
+
+    try:
+        engine = process_book(args.input, args.output, prefs,
+                              jobs=args.jobs, cache=cache,
+                              stream_threshold=stream_threshold(args),
+                              metrics=metrics)
+    except (AccessAideError, ValueError, OSError, zipfile.BadZipFile) as e:
+        print('{}: {}'.format(args.input, e), file=sys.stderr)
+        if args.report:
+            write_report(args.report, build_report(
+                metrics.snapshot(), book=args.input,
+                errors=[error_entry(e)]))
+        return 1
+
+    for line in engine.report_lines():
+        print(html.unescape(line))
+
+    write_metrics(args, metrics)
+    if args.report:
+        write_report(args.report, engine.report(book=args.input))
+
+    return 0
+
+
+def cmd_plan(args):
+    prefs = get_prefs(args)
+
+    try:
+        plan = Engine(prefs).plan(EpubContainer(args.input))
+    except (AccessAideError, ValueError, OSError, zipfile.BadZipFile) as e:
+        print('{}: {}'.format(args.input, e), file=sys.stderr)
+        return 1
+
+    plan['book'] = args.input
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(plan, f, indent=2)
+    else:
+        json.dump(plan, sys.stdout, indent=2)
+        print()
+
+    return 0
+
+
+def cmd_audit(args):
+    prefs = get_prefs(args)
+    cache = None
+    if args.cache:
+        cache = ResultCache(args.cache, cache_size(args))
+
+    try:
+        engine = Engine(prefs, cache=cache)
+        findings = engine.audit(EpubContainer(args.input))
+    except (ValueError, OSError, zipfile.BadZipFile) as e:
+        print('{}: {}'.format(args.input, e), file=sys.stderr)
+        return 1
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump({'book': args.input,
+                       'findings': [f._asdict() for f in findings]},
+                      f, indent=2)
+    else:
+        for finding in findings:
+            print('{}:{}: {}: {}'.format(finding.document,
+                                         finding.line or '', finding.check,
+                                         finding.message))
+
+    print('{} findings, {} documents from the cache.'.format(
+        len(findings), engine.counters['audit_cached']), file=sys.stderr)
+
+    return 1 if findings else 0
+
+
+def cmd_apply(args):
+    with open(args.plan, encoding='utf-8') as f:
+        plan = json.load(f)
+
+    try:
+        container = EpubContainer(args.input)
+        applied, conflicts = apply_plan(container, plan)
+        container.commit(args.output)
+    except (ValueError, OSError, zipfile.BadZipFile) as e:
+        print('{}: {}'.format(args.input, e), file=sys.stderr)
+        return 1
+
+    print('Changes applied: {}, conflicts: {}'.format(applied, conflicts))
+
+    return 1 if conflicts else 0
+
+
+def cmd_batch(args):
+    prefs = get_prefs(args)
+    books = find_books(args.directory, recursive=args.recursive)
+
+    if os.path.abspath(args.output_dir) == os.path.abspath(args.directory):
+        print('The output directory must differ from the input one.',
+              file=sys.stderr)
+        return 2
+
+    options = {'jobs': args.jobs, 'cache_path': args.cache,
+               'cache_size': cache_size(args),
+               'stream_threshold': stream_threshold(args),
+               'trace': bool(args.trace)}
+    pipeline = None
+    if args.pipeline:
+        pipeline = BookPipeline(prefs, threads=args.threads,
+                                queue_size=args.queue_size, **options)
+        results = pipeline.run(books, args.directory, args.output_dir)
+    else:
+        results = run_batch(books, args.directory, args.output_dir, prefs,
+                            **options)
+
+    metrics = Metrics(trace=bool(args.trace))
+    failed = hits = misses = 0
+    for done, result in enumerate(results, start=1):
+        hits += result.get('cache_hits', 0)
+        misses += result.get('cache_misses', 0)
+        if 'metrics' in result:
+            prefix = os.path.relpath(result['input'], args.directory) + '/'
+            metrics.merge(result['metrics'], prefix=prefix)
+        if args.report:
+            append_report(args.report, result['report'])
+
+        if result['ok']:
+            print('[{}/{}] ok {} ({:.2f}s)'.format(done, len(books),
+                                                   result['input'],
+                                                   result['seconds']),
+                  flush=True)
+        else:
+            failed += 1
+            print('[{}/{}] FAILED {}: {}'.format(done, len(books),
+                                                 result['input'],
+                                                 result['error']),
+                  file=sys.stderr, flush=True)
+
+    print('{} books processed, {} failed.'.format(len(books), failed))
+    if args.cache:
+        print('Cache hits: {}, misses: {}'.format(hits, misses))
+    if pipeline is not None:
+        for line in format_stats(pipeline.stats()):
+            print(line)
+
+    write_metrics(args, metrics)
+
+    return 1 if failed else 0
+
+
+def cmd_serve(args):
+    import asyncio
+
+    server = import_server()
+
+    if not args.socket and not server.is_loopback(args.host):
+        print('Refusing to listen on {}: jobs read and write files on this '
+              'machine, so only loopback addresses are allowed.'.format(
+                  args.host), file=sys.stderr)
+        return 2
+
+    def ready(listener):
+        if args.socket:
+            address = args.socket
+        else:
+            address = 'http://{}:{}'.format(
+                *listener.sockets[0].getsockname()[:2])
+        print('Listening on {}'.format(address), flush=True)
+
+    asyncio.run(server.serve(path=args.socket, host=args.host,
+                             port=args.port, workers=args.jobs,
+                             queue_size=args.queue_size,
+                             max_upload=args.max_upload,
+                             cache_path=args.cache,
+                             cache_size=cache_size(args), ready=ready))
+
+    return 0
+
+
+def cmd_bench(args):
+    bench = import_bench()
+    suite = bench.SUITE
+    if args.book:
+        unknown = sorted(set(args.book) - set(suite))
+        if unknown:
+            print('Unknown books: {}, available: {}'.format(
+                ', '.join(unknown), ', '.join(sorted(suite))),
+                file=sys.stderr)
+            return 2
+        suite = {name: suite[name] for name in args.book}
+
+    results = bench.run_suite(suite, repeat=args.repeat)
+
+    regressions = []
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)
+        try:
+            regressions = bench.compare(results, baseline,
+                                        threshold=args.threshold / 100)
+        except ValueError as e:
+            print('{}: {}'.format(args.baseline, e), file=sys.stderr)
+            return 2
+
+    for line in bench.format_results(results, regressions):
+        print(line)
+
+    if args.save:
+        with open(args.save, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+
+    if regressions:
+        print('{} stages regressed.'.format(len(regressions)),
+              file=sys.stderr)
+        return 1
+
+    return 0
+
+
+def add_prefs_arguments(parser):
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument('--prefs', help='prefs JSON file, in the same shape '
+                                       'as the plugin config')
+    group.add_argument('--profile', help='use the prefs of this profile, '
+                                         'saved from the plugin config')
+
+
+def add_common_arguments(parser):
+    add_prefs_arguments(parser)
+    parser.add_argument('--cache', metavar='PATH',
+                        help='cache of transformed documents, reused '
+                             'across runs')
+    parser.add_argument('--cache-size', metavar='MB', type=int, default=512,
+                        help='maximum size of the cache (default: 512)')
+    parser.add_argument('--stream-threshold', metavar='MB', type=float,
+                        help='stream documents larger than this, instead '
+                             'of loading their whole tree in memory')
+    parser.add_argument('--memory-budget', metavar='MB', type=float,
+                        help='keep the parsed documents within about this '
+                             'much memory, serialising each one once '
+                             'transformed (0: no limit)')
+    parser.add_argument('--metrics', metavar='PATH',
+                        help='write counters, timings and size histograms '
+                             'to this JSON file')
+    parser.add_argument('--trace', metavar='PATH',
+                        help='write the timings of every stage to this '
+                             'file, in the Chrome trace format')
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(
+        prog='access-aide',
+        description='Enhance accessibility features in EPUB files.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    run = subparsers.add_parser('run', help='process a single EPUB file')
+    run.add_argument('input', help='EPUB file to process')
+    run.add_argument('output', help='where to write the processed EPUB')
+    run.add_argument('-j', '--jobs', type=int, default=None,
+                     help='transform the documents of the book in this '
+                          'many worker processes')
+    run.add_argument('--report', metavar='PATH',
+                     help='write a JSON report of the run to this file')
+    add_common_arguments(run)
+    run.set_defaults(func=cmd_run)
+
+    plan = subparsers.add_parser('plan', help='list the changes a run '
+                                              'would make, as JSON')
+    plan.add_argument('input', help='EPUB file to inspect')
+    plan.add_argument('-o', '--output', help='where to write the plan '
+                                             '(default: standard output)')
+    add_prefs_arguments(plan)
+    plan.set_defaults(func=cmd_plan)
+
+    audit = subparsers.add_parser('audit', help='check the accessibility '
+                                                'of an EPUB file')
+    audit.add_argument('input', help='EPUB file to check')
+    audit.add_argument('-o', '--output', help='write the findings to this '
+                                              'JSON file')
+    add_prefs_arguments(audit)
+    audit.add_argument('--cache', metavar='PATH',
+                       help='cache of findings, so that only changed '
+                            'documents are checked again')
+    audit.add_argument('--cache-size', metavar='MB', type=int, default=512,
+                       help='maximum size of the cache (default: 512)')
+    audit.set_defaults(func=cmd_audit)
+
+    apply = subparsers.add_parser('apply', help='apply a plan made with '
+                                                'the plan command')
+    apply.add_argument('input', help='EPUB file to process')
+    apply.add_argument('plan', help='plan JSON file')
+    apply.add_argument('output', help='where to write the processed EPUB')
+    apply.set_defaults(func=cmd_apply)
+
+    batch = subparsers.add_parser('batch', help='process every EPUB file '
+                                                'in a directory')
+    batch.add_argument('directory', help='directory holding EPUB files')
+    batch.add_argument('-o', '--output-dir', required=True,
+                       help='where to write the processed EPUBs')
+    batch.add_argument('-j', '--jobs', type=int, default=None,
+                       help='number of worker processes '
+                            '(default: number of CPUs)')
+    batch.add_argument('-r', '--recursive', action='store_true',
+                       help='also look for EPUB files in subdirectories')
+    batch.add_argument('--report', metavar='PATH',
+                       help='append a JSON report per book to this file, '
+                            'one per line (JSON Lines)')
+    batch.add_argument('--pipeline', action='store_true',
+                       help='overlap reading, transforming and writing '
+                            'books, in stages connected by queues')
+    batch.add_argument('--threads', type=int, default=2,
+                       help='threads of each I/O and zlib stage of the '
+                            'pipeline (default: 2)')
+    batch.add_argument('--queue-size', type=int, default=4,
+                       help='books waiting between two stages of the '
+                            'pipeline (default: 4)')
+    add_common_arguments(batch)
+    batch.set_defaults(func=cmd_batch)
+
+    serve = subparsers.add_parser('serve', help='process books sent over '
+                                                'a local socket')
+    listen = serve.add_mutually_exclusive_group()
+    listen.add_argument('--socket', metavar='PATH',
+                        help='listen on this Unix socket')
+    listen.add_argument('--port', type=int, default=8080,
+                        help='listen on this TCP port (default: 8080)')
+    serve.add_argument('--host', default='127.0.0.1',
+                       help='loopback address to listen on '
+                            '(default: 127.0.0.1)')
+    serve.add_argument('-j', '--jobs', type=int, default=2,
+                       help='books processed at once, each in its own '
+                            'worker process (default: 2)')
+    serve.add_argument('--queue-size', type=int, default=16,
+                       help='books waiting before new ones are turned '
+                            'away (default: 16)')
+    serve.add_argument('--max-upload', metavar='MB', type=int, default=256,
+                       help='largest EPUB accepted (default: 256)')
+    serve.add_argument('--cache', metavar='PATH',
+                       help='cache of transformed documents, reused '
+                            'across books')
+    serve.add_argument('--cache-size', metavar='MB', type=int, default=512,
+                       help='maximum size of the cache (default: 512)')
+    serve.set_defaults(func=cmd_serve)
+
+    bench_parser = subparsers.add_parser('bench', help='time every stage on '
+                                                       'synthetic books')
+    bench_parser.add_argument('--book', action='append',
+                              help='only time this book of the suite (can '
+                                   'be repeated)')
+    bench_parser.add_argument('--repeat', type=int, default=3,
+                              help='passes per book, the best one is kept '
+                                   '(default: 3)')
+    bench_parser.add_argument('--save', metavar='PATH',
+                              help='save the results as a JSON baseline')
+    bench_parser.add_argument('--baseline', metavar='PATH',
+                              help='flag the stages slower than in this '
+                                   'baseline')
+    bench_parser.add_argument('--threshold', metavar='PCT', type=float,
+                              default=25,
+                              help='slowdown reported as a regression '
+                                   '(default: 25)')
+    bench_parser.set_defaults(func=cmd_bench)
+
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+
+    try:
+        return args.func(args)
+    except ProfileError as e:
+        print(e, file=sys.stderr)
+        return 2
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,443 @@
+#!/usr/bin/env python3
+'''
+Access Aide - A Calibre plugin to enhance accessibility features in epub files.
+Copyright (C) 2020-2021 Luca Baffa
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+import io
+import os
+import posixpath
+import struct
+import time
+import zlib
+from collections import namedtuple
+from urllib.parse import unquote
+
+import lxml.etree
+
+OPF_MIME = 'application/oebps-package+xml'
+OEB_DOCS = {'application/xhtml+xml', 'text/html', 'text/x-oeb1-document',
+            'text/x-oeb-document', 'application/x-dtbook+xml'}
+
+NAMESPACES = {
+    'opf': 'http://www.idpf.org/2007/opf',
+    'dc': 'http://purl.org/dc/elements/1.1/',
+    'epub': 'http://www.idpf.org/2007/ops',
+    'ocf': 'urn:oasis:names:tc:opendocument:xmlns:container',
+}
+
+CONTAINER_XML = 'META-INF/container.xml'
+
+Version = namedtuple('Version', ['major', 'minor'])
+
+
+def parse_xml(data):
+    '''Parse an XML/XHTML file the way the container does.'''
+
+    parser = lxml.etree.XMLParser(resolve_entities=False,
+                                  remove_blank_text=False)
+    return lxml.etree.fromstring(data, parser)
+
+
+def serialize(root):
+    '''Serialise a parsed file, keeping its XML declaration and doctype.'''
+
+    return lxml.etree.tostring(root.getroottree(), encoding='utf-8',
+                               xml_declaration=True)
+
+
+def find_opf(data, path):
+    '''Return the name of the OPF file declared in `container.xml`,
+    given the {name: content} of the members of the book at `path`.'''
+
+    try:
+        root = lxml.etree.fromstring(data[CONTAINER_XML])
+    except KeyError:
+        raise ValueError('{} has no META-INF/container.xml'.format(path))
+
+    paths = root.xpath('//ocf:rootfile/@full-path', namespaces=NAMESPACES)
+    if not paths:
+        raise ValueError('{} does not declare an OPF file'.format(path))
+
+    return paths[0]
+
+
+# members smaller than this are deflated without a thread pool
+PARALLEL_DEFLATE_SIZE = 256 * 1024
+
+
+def read_raw(zf, info):
+    '''Return the content of a member of `zf` as stored, i.e. still
+    compressed.'''
+
+    # zipfile, the thread pool and tempfile are kept out of the import
+    # time of the engine, which only needs `parse_xml()` and co.
+    import zipfile
+
+    zf.fp.seek(info.header_offset)
+    header = zf.fp.read(30)
+    if header[:4] != b'PK\x03\x04':
+        raise zipfile.BadZipFile('Bad local header for {}'
+                                 .format(info.filename))
+
+    name_length, extra_length = struct.unpack('<HH', header[26:30])
+    zf.fp.seek(info.header_offset + 30 + name_length + extra_length)
+    return zf.fp.read(info.compress_size)
+
+
+def write_raw(zf, info, raw):
+    '''Append a member to `zf`, open for writing, from its content
+    already compressed as `info` describes.
+
+    zipfile has no public API for this: the local header is written
+    here, and the member added to the central directory the way
+    `ZipFile.writestr()` does. This is the only place relying on the
+    internals of `ZipFile`.
+    '''
+
+    info.header_offset = zf.fp.tell()
+    zf.fp.write(info.FileHeader())
+    zf.fp.write(raw)
+    zf.filelist.append(info)
+    zf.NameToInfo[info.filename] = info
+    zf.start_dir = zf.fp.tell()
+    zf._didModify = True
+
+
+def copy_info(info):
+    '''Return a new `ZipInfo` for a member copied as is.'''
+
+    import zipfile
+
+    new = zipfile.ZipInfo(info.filename, info.date_time)
+    for attribute in ('compress_type', 'CRC', 'compress_size', 'file_size',
+                      'external_attr', 'create_system', 'comment'):
+        setattr(new, attribute, getattr(info, attribute))
+    # sizes are known, so no data descriptor follows the content
+    new.flag_bits = info.flag_bits & ~0x08
+
+    return new
+
+
+def deflate(data):
+    '''Return the CRC and the raw deflate stream of `data`, as
+    `zipfile` would write them.'''
+
+    compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED,
+                                  -15)
+    return zlib.crc32(data), compressor.compress(data) + compressor.flush()
+
+
+def write_zip(f, names, data, source=None, threads=None):
+    '''Write the members `names` as an EPUB zip file to the path or file
+    object `f`.
+
+    Members in `data` are deflated, across `threads` threads when they
+    are large enough (zlib releases the GIL); the others are copied as
+    they are, without inflating them, from `source`, the open `ZipFile`
+    they come from. The `mimetype` file is stored uncompressed and first,
+    as required by the OCF specification.
+    '''
+
+    import zipfile
+    from concurrent.futures import ThreadPoolExecutor
+
+    deflated = [name for name in names
+                if name in data and name != 'mimetype']
+    date_time = time.localtime(time.time())[:6]
+
+    with zipfile.ZipFile(f, 'w') as zf:
+        if 'mimetype' in names:
+            mimetype = data['mimetype'] if 'mimetype' in data \
+                else source.read('mimetype')
+            zf.writestr('mimetype', mimetype,
+                        compress_type=zipfile.ZIP_STORED)
+
+        executor = None
+        if len(deflated) > 1 and threads != 1 and sum(
+                len(data[name]) for name in deflated) > PARALLEL_DEFLATE_SIZE:
+            executor = ThreadPoolExecutor(max_workers=threads)
+            streams = executor.map(deflate, (data[name] for name in deflated))
+        else:
+            streams = map(deflate, (data[name] for name in deflated))
+
+        try:
+            for name in names:
+                if name == 'mimetype':
+                    continue
+
+                if name not in data:
+                    info = source.getinfo(name)
+                    write_raw(zf, copy_info(info), read_raw(source, info))
+                    continue
+
+                # streams come in the order of `names`
+                crc, raw = next(streams)
+                info = zipfile.ZipInfo(name, date_time)
+                info.compress_type = zipfile.ZIP_DEFLATED
+                info.external_attr = 0o600 << 16
+                info.CRC = crc
+                info.compress_size = len(raw)
+                info.file_size = len(data[name])
+                write_raw(zf, info, raw)
+        finally:
+            if executor is not None:
+                executor.shutdown()
+
+
+class MemberWriter(io.BytesIO):
+    '''File-like object storing its content back into the container.'''
+
+    def __init__(self, container, name):
+        super().__init__()
+        self.container = container
+        self.name = name
+
+    def close(self):
+        if not self.closed:
+            self.container.data[self.name] = self.getvalue()
+        super().close()
+
+
+class EpubContainer():
+    '''Minimal EPUB container read straight from a zip file.
+
+    This class mirrors the subset of the Calibre editor container API
+    used by Access Aide (`mime_map`, `parsed()`, `dirty()`, `opf_xpath()`,
+    `insert_into_xml()`, ...), so that the very same engine can run
+    inside the editor and from the command line.
+
+    `members`, if given, maps the names of the files to their content,
+    already read from `path`, in zip order. Otherwise, `path` is kept
+    open and its members are only inflated when first read, so that
+    fonts, images and audio a run does not look at are never inflated:
+    on `commit()`, the members left unchanged are copied as they are.
+    '''
+
+    book_type = 'epub'
+
+    def __init__(self, path, members=None):
+        self.path = path
+        # content of the members read or written so far
+        self.data = {}
+        self.parsed_cache = {}
+        self.dirtied = set()
+        self.zf = None
+
+        if members is not None:
+            self.names = list(members)
+            self.data.update(members)
+        else:
+            import zipfile
+            self.zf = zipfile.ZipFile(path)
+            self.names = self.zf.namelist()
+
+        # content as read, to tell the members changed since
+        self.loaded = dict(self.data)
+
+        self.opf_name = self.find_opf()
+        self.mime_map = self.read_manifest()
+
+    def find_opf(self):
+        head = {name: self.read(name) for name in (CONTAINER_XML,)
+                if name in self.names}
+        return find_opf(head, self.path)
+
+    def read(self, name):
+        '''Return the content of a member, inflating it on first use.'''
+
+        data = self.data.get(name)
+        if data is None:
+            if self.zf is None or name not in self.names:
+                raise KeyError(name)
+            data = self.data[name] = self.loaded[name] = self.zf.read(name)
+
+        return data
+
+    def close(self):
+        '''Close the book file; members not read yet cannot be read after
+        this.'''
+
+        if self.zf is not None:
+            self.zf.close()
+            self.zf = None
+
+    def read_manifest(self):
+        '''Map manifest items (and the OPF itself) to their media type.'''
+
+        mime_map = {self.opf_name: OPF_MIME}
+        base = posixpath.dirname(self.opf_name)
+
+        for item in self.opf_xpath('//opf:manifest/opf:item[@href]'):
+            name = self.href_to_name(item.get('href'), base)
+            mime_map[name] = item.get('media-type', '')
+
+        return mime_map
+
+    @staticmethod
+    def href_to_name(href, base):
+        href = unquote(href.partition('#')[0])
+        return posixpath.normpath(posixpath.join(base, href))
+
+    @property
+    def spine_names(self):
+        '''Yield (name, is_linear) for every item of the spine.'''
+
+        manifest = {item.get('id'): item.get('href') for item in
+                    self.opf_xpath('//opf:manifest/opf:item[@href]')}
+        base = posixpath.dirname(self.opf_name)
+
+        for itemref in self.opf_xpath('//opf:spine/opf:itemref'):
+            href = manifest.get(itemref.get('idref'))
+            if href is not None:
+                yield (self.href_to_name(href, base),
+                       itemref.get('linear', 'yes') != 'no')
+
+    @property
+    def opf(self):
+        return self.parsed(self.opf_name)
+
+    @property
+    def opf_version_parsed(self):
+        version = self.opf.get('version', '2.0').split('.')
+        try:
+            return Version(int(version[0]),
+                           int(version[1]) if len(version) > 1 else 0)
+        except ValueError:
+            return Version(0, 0)
+
+    def opf_xpath(self, expr):
+        return self.opf.xpath(expr, namespaces=NAMESPACES)
+
+    def parsed(self, name):
+        '''Return the (cached) root element of the given file.'''
+
+        root = self.parsed_cache.get(name)
+        if root is None:
+            root = parse_xml(self.read(name))
+            self.parsed_cache[name] = root
+
+        return root
+
+    def raw_data(self, name, decode=True):
+        '''Return the content of a file, serialising pending changes.'''
+
+        if name in self.dirtied and name in self.parsed_cache:
+            self.commit_item(name, keep_parsed=True)
+
+        data = self.read(name)
+        return data.decode('utf-8') if decode else data
+
+    def open(self, name, mode='rb'):
+        '''Open a file for direct read/write.
+
+        Pending changes are committed and the parsed version is dropped,
+        as in the Calibre container. Members not read yet are inflated as
+        they are read from the file returned.
+        '''
+
+        if name in self.dirtied:
+            self.commit_item(name)
+        self.parsed_cache.pop(name, None)
+
+        if mode in ('r', 'rb'):
+            if name not in self.data and self.zf is not None \
+               and name in self.names:
+                return self.zf.open(name)
+            return io.BytesIO(self.read(name))
+
+        if name not in self.names:
+            self.names.append(name)
+        return MemberWriter(self, name)
+
+    def dirty(self, name):
+        self.dirtied.add(name)
+
+    def commit_item(self, name, keep_parsed=False):
+        '''Serialise a parsed file back into the container data.'''
+
+        root = self.parsed_cache.get(name)
+        if root is not None:
+            self.data[name] = serialize(root)
+            if not keep_parsed:
+                del self.parsed_cache[name]
+
+        self.dirtied.discard(name)
+
+    def insert_into_xml(self, parent, item, index=None):
+        '''Insert item into parent (or append), fixing indentation.'''
+
+        if index is None:
+            parent.append(item)
+        else:
+            parent.insert(index, item)
+
+        idx = parent.index(item)
+        if idx == 0:
+            item.tail = parent.text
+        else:
+            item.tail = parent[idx - 1].tail
+            if idx == len(parent) - 1:
+                parent[idx - 1].tail = parent.text
+
+    def flush(self):
+        '''Serialise every pending change into the container data.'''
+
+        for name in list(self.dirtied):
+            self.commit_item(name, keep_parsed=True)
+
+    def changed(self):
+        '''Return the {name: content} of the members changed (or added)
+        since they were read.'''
+
+        return {name: data for name, data in self.data.items()
+                if self.loaded.get(name) is not data}
+
+    def commit(self, path, threads=None):
+        '''Write the container to a new EPUB file (see `write_zip()`).
+
+        Members left unchanged are copied from the original file without
+        inflating them; the changed ones are deflated across `threads`
+        threads.
+        '''
+
+        import tempfile
+        import zipfile
+
+        self.flush()
+        if self.zf is None:
+            return write_zip(path, self.names, self.data, threads=threads)
+
+        if not isinstance(path, str) or not os.path.exists(path) or \
+           not os.path.samefile(path, self.path):
+            return write_zip(path, self.names, self.changed(), self.zf,
+                             threads)
+
+        # the original is still being read from
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path) or '.',
+                                   suffix='.epub')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                write_zip(f, self.names, self.changed(), self.zf, threads)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+
+        # members not read yet are read from the new file from now on
+        self.close()
+        os.replace(tmp, path)
+        self.zf = zipfile.ZipFile(path)
+        self.loaded = dict(self.data)
@@ -0,0 +1,1257 @@
+#!/usr/bin/env python3
+'''
+Access Aide - A Calibre plugin to enhance accessibility features in epub files.
+Copyright (C) 2020-2021 Luca Baffa
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+from collections import OrderedDict
+from functools import partial
+
+import lxml.etree
+
+try:
+    from .stats import Stats
+    from .metrics import Metrics, current_rss
+    from .rules import load_rule_tables
+    from .container import OPF_MIME, OEB_DOCS, parse_xml, serialize
+    from .opf import MetadataIndex
+    from .plan import PLAN_VERSION, plan_entry, revert
+    from .report import build_report, memory_entry
+    from .features import FEATURES, feature
+    from .journal import digest, digest_file
+    from .profiles import compile_plan, meta_item
+except ImportError:
+    from stats import Stats
+    from metrics import Metrics, current_rss
+    from rules import load_rule_tables
+    from container import OPF_MIME, OEB_DOCS, parse_xml, serialize
+    from opf import MetadataIndex
+    from plan import PLAN_VERSION, plan_entry, revert
+    from report import build_report, memory_entry
+    from features import FEATURES, feature
+    from journal import digest, digest_file
+    from profiles import compile_plan, meta_item
+
+XML_LANG = '{http://www.w3.org/XML/1998/namespace}lang'
+EPUB_TYPE = '{http://www.idpf.org/2007/ops}type'
+
+# rules needing the content of elements, left out when streaming
+CONTENT_RULES = ('audit', 'infer_access')
+
+# bump when the transforms change, so that cached documents are not reused
+ENGINE_VERSION = 1
+
+# memory taken by a parsed tree, per byte of the document
+TREE_FACTOR = 4
+
+# elements whose text is checked for a language other than the book one
+BLOCKS = frozenset(['p', 'li', 'blockquote', 'dd', 'dt', 'td', 'th', 'pre',
+                    'caption', 'figcaption', 'h1', 'h2', 'h3', 'h4', 'h5',
+                    'h6'])
+
+
+class AccessAideError(Exception):
+    '''Raised when a book cannot be processed.
+
+    `code` identifies the problem in machine-readable reports.
+    '''
+
+    def __init__(self, message, code=None):
+        super().__init__(message)
+        self.code = code
+
+
+# per-process engine, set once by `init_document_worker`
+_document_engine = None
+
+
+def init_document_worker(prefs):
+    '''Build the engine and load rule tables once per worker process.'''
+
+    global _document_engine
+    _document_engine = Engine(prefs)
+
+
+def transform_document(name, data, lang, audit=True):
+    '''Transform a serialised XHTML file in a worker process.
+
+    Returns the new content (None if nothing changed) along with the
+    stat deltas, a snapshot of the metrics for this document and its
+    audit findings (None if not audited).
+    '''
+
+    engine = _document_engine
+    metrics = engine.metrics
+    metrics.reset()
+    metrics.start_file(name)
+
+    with metrics.timer('parse'):
+        root = parse_xml(data)
+    with metrics.timer('transform'):
+        changes = engine.transform(root, lang, audit)
+    deltas = engine.stat_values()
+
+    output = None
+    if changes:
+        with metrics.timer('serialise'):
+            output = serialize(root)
+
+    metrics.end_file()
+    return output, deltas, metrics.snapshot(), engine.audit_findings
+
+
+class Change():
+    '''A single edit made to an element.
+
+    `op` is one of:
+     -  'attrib': `attribute` of `node` went from `old` to `new`;
+     -  'text': the text of `node` went from `old` to `new`;
+     -  'insert': `node` was inserted into the `new` parent element,
+        `old` holding the previous tail of the preceding sibling.
+    '''
+
+    __slots__ = ('op', 'node', 'attribute', 'old', 'new')
+
+    def __init__(self, op, node, attribute, old, new):
+        self.op = op
+        self.node = node
+        self.attribute = attribute
+        self.old = old
+        self.new = new
+
+    def __repr__(self):
+        return 'Change({!r}, {!r}, {!r}, {!r}, {!r})'.format(
+            self.op, self.node, self.attribute, self.old, self.new)
+
+
+class Engine():
+    '''The Access Aide pipeline.
+
+    The engine runs against any object exposing the Calibre editor
+    container API (`lib.container.EpubContainer` outside of Calibre) and
+    does not depend on the GUI: errors are raised as `AccessAideError`.
+
+    An optional `lib.cache.ResultCache` lets documents seen in a previous
+    run skip parsing altogether. Documents larger than `stream_threshold`
+    bytes are streamed (see `lib.stream`) instead of being parsed into a
+    full tree.
+
+    Stats, counters, timings and size histograms are kept in `metrics`
+    (see `lib.metrics`). Changes are recorded in `journal`, if given, so
+    that they can be undone (see `lib.journal`).
+
+    Prefs are compiled once into a `lib.profiles.RunPlan`; pass
+    `run_plan` to reuse one compiled earlier.
+
+    With a memory budget in the plan, parsed trees are kept only as long
+    as their estimated size fits in it: past that, the trees used least
+    recently are serialised and dropped from the container cache. The
+    OPF file always stays parsed.
+    '''
+
+    blacklist = ['toc.xhtml']
+
+    # streamed output is kept in memory up to this size, then on disk
+    spool_size = 16 * 1024 * 1024
+
+    def __init__(self, prefs, cache=None, stream_threshold=None,
+                 metrics=None, journal=None, run_plan=None):
+        self.prefs = prefs
+        self.run_plan = run_plan or compile_plan(prefs)
+        self.force_override = self.run_plan.force_override
+        self.cache = cache
+        self.journal = journal
+        self.cache_keys = {}
+        self.stream_threshold = stream_threshold
+        self.memory_budget = self.run_plan.memory_budget
+        self.metrics = Metrics() if metrics is None else metrics
+
+        # init stat counters
+        self.lang_stat = Stats('Language attributes', self.metrics,
+                               'lang_stat')
+        self.aria_stat = Stats('Aria roles', self.metrics, 'aria_stat')
+        self.meta_stat = Stats('Metadata declarations', self.metrics,
+                               'meta_stat')
+        self.title_stat = Stats('Text content of &lt;title&gt; tags',
+                                self.metrics, 'title_stat')
+        self.fn_stat = Stats('epub:type to footnote and endnote marks',
+                             self.metrics, 'fn_stat')
+        self.passage_stat = Stats('Language attributes on passages',
+                                  self.metrics, 'passage_stat')
+
+        self.tables = load_rule_tables()
+
+        # scan counters, e.g. to check a document is walked only once
+        self.counters = self.metrics.counters
+
+        # set up by `compile_rules()` when the audit or the inference of
+        # metadata first runs, and evidence counters to carry with the
+        # stats
+        self.auditor = None
+        self.evidence = None
+        self.evidence_keys = ()
+        if 'infer_access' in self.run_plan.rules:
+            self.evidence_keys = tuple('evidence_' + name for name in
+                                       feature('infer').EVIDENCE)
+
+        # estimated memory of the parsed trees, by document, least
+        # recently used first, and document sizes
+        self.resident = OrderedDict()
+        self.sizes = {}
+
+        self.changes = []
+        self.compiled_rules = {}
+        self.lang = None
+        self.title = self.h1 = None
+        self.meta_index = None
+
+        self.dry_run = False
+        self.planned = []
+
+        # `Image` entries of the last run, if the inventory was built
+        self.images = None
+
+        # `Finding` entries of the last run, if the audit ran; findings
+        # of the last walk, and cache keys of the documents to audit
+        self.findings = None
+        self.audit_findings = None
+        self.audit_keys = {}
+
+        # metadata inferred in the last run, as {key: [values]}
+        self.inferred = None
+
+    def run(self, container, jobs=None):
+        '''Process every document of the book and its OPF file.
+
+        With `jobs` greater than one, documents are transformed in that
+        many worker processes; the OPF file is always edited here, so
+        that there is a single writer for it.
+        '''
+
+        if container.book_type != 'epub' or \
+           container.opf_version_parsed.major not in [2, 3]:
+            message = 'Access Aide supports EPUB 2 and 3, {} {} given.' \
+                      .format(container.book_type.upper(),
+                              container.opf_version_parsed.major)
+
+            raise AccessAideError(message, code='unsupported-book')
+
+        self.sample_memory(start=True)
+        with self.metrics.timer('run'):
+            self.process(container, self.get_lang(container), jobs)
+        self.sample_memory()
+
+    def sample_memory(self, start=False):
+        '''Observe the resident memory of the process, whose highest
+        sample is the peak of the run; `start` marks the first sample.'''
+
+        rss = current_rss()
+        if rss is not None:
+            self.metrics.observe('rss', rss)
+            if start:
+                self.metrics.observe('rss_start', rss)
+
+    def documents(self, container):
+        '''Return the names of the documents to process.'''
+
+        return [name for name, media_type in container.mime_map.items()
+                if media_type in OEB_DOCS and name not in self.blacklist]
+
+    def process(self, container, lang, jobs):
+        metrics = self.metrics
+        docs = self.documents(container)
+        opfs = [name for name, media_type in container.mime_map.items()
+                if media_type == OPF_MIME]
+
+        self.findings = [] if 'audit' in self.document_rules() else None
+
+        sizes = {name: len(container.raw_data(name, decode=False))
+                 for name in docs}
+        for size in sizes.values():
+            metrics.observe('document_bytes', size)
+        self.sizes = sizes
+        self.resident.clear()
+
+        all_docs = docs
+        streamed = []
+
+        if self.stream_threshold and not self.dry_run:
+            streamed = [name for name in docs
+                        if sizes[name] > self.stream_threshold]
+            docs = [name for name in docs if name not in streamed]
+
+            for name in streamed:
+                self.stream_file(container, name, lang)
+
+        # streamed documents are too large to be loaded for this stage
+        parsed = list(docs)
+
+        if self.cache is not None and not self.dry_run:
+            with metrics.timer('cache'):
+                docs = self.apply_cached(container, docs, lang)
+
+        if jobs and jobs > 1 and len(docs) > 1 and not self.dry_run:
+            self.run_parallel(container, docs, lang, jobs)
+        else:
+            for name in docs:
+                self.transform_file(container, name, lang)
+
+        if self.run_plan.passage_threshold is not None:
+            with metrics.timer('passage_lang'):
+                self.add_passage_lang(container, parsed, lang)
+
+        if self.run_plan.images:
+            with metrics.timer('images'):
+                self.add_images(container, all_docs, streamed)
+
+        if 'infer_access' in self.document_rules():
+            with metrics.timer('infer'):
+                infer = feature('infer')
+                infer.book_evidence(container, self.counters)
+                self.inferred = infer.infer(infer.evidence(self.counters),
+                                            self.tables.features)
+
+        for name in opfs:
+            metrics.start_file(name)
+            self.changes = []
+            with metrics.timer('opf'):
+                self.add_lang_opf(container.parsed(name), lang)
+                self.add_metadata(container)
+                self.add_a11y(container)
+
+            self.mark(container, name, self.changes)
+            metrics.end_file()
+
+    def plan(self, container):
+        '''Compute the changes a run would make, without applying them.
+
+        Rules run as usual, but each change is recorded and then reverted,
+        so that files are never marked dirty nor serialised. Returns a
+        JSON-serialisable plan, see `lib.plan.apply_plan()`.
+        '''
+
+        self.dry_run = True
+        self.planned = []
+
+        try:
+            self.run(container)
+        finally:
+            self.dry_run = False
+            self.meta_index = None
+
+        return {'version': PLAN_VERSION, 'changes': self.planned}
+
+    def run_parallel(self, container, docs, lang, jobs):
+        '''Transform documents in a pool of worker processes.
+
+        The largest documents are submitted first, so that workers are
+        not left waiting on a long tail. Results (and stat deltas) are
+        merged back in spine order, which keeps the outcome deterministic.
+        '''
+
+        # multiprocessing is a large part of the import time otherwise
+        from concurrent.futures import ProcessPoolExecutor
+
+        data = {name: container.raw_data(name, decode=False)
+                for name in docs}
+        audit = {name: self.audit_needed(container, name, data[name])
+                 for name in docs}
+
+        with ProcessPoolExecutor(max_workers=jobs,
+                                 initializer=init_document_worker,
+                                 initargs=(self.prefs,)) as executor:
+            futures = {}
+            for name in sorted(docs, key=lambda n: len(data[n]),
+                               reverse=True):
+                futures[name] = executor.submit(transform_document, name,
+                                                data.pop(name), lang,
+                                                audit[name])
+
+            for name in self.spine_order(container, docs):
+                output, deltas, snapshot, findings = \
+                    futures.pop(name).result()
+                # the snapshot holds the stat counters as well
+                self.metrics.merge(snapshot)
+                if findings is not None:
+                    self.add_findings(name, findings)
+                self.apply_output(container, name, output, {})
+
+                key = self.cache_keys.pop(name, None)
+                if key is not None:
+                    self.cache.put(key, output, deltas)
+
+    def apply_cached(self, container, docs, lang):
+        '''Apply cached results, returning the documents left to process.
+
+        Cache keys of the missing documents are kept in `cache_keys`, so
+        that their results can be stored once computed.
+        '''
+
+        prefs_hash = self.run_plan.digest
+        missing = []
+
+        for name in docs:
+            data = container.raw_data(name, decode=False)
+            key = self.cache.key(data, prefs_hash, lang, self.tables.digest,
+                                 ENGINE_VERSION)
+            hit = self.cache.get(key)
+
+            if hit is None:
+                self.counters['cache_misses'] += 1
+                self.cache_keys[name] = key
+                missing.append(name)
+            else:
+                self.counters['cache_hits'] += 1
+                if self.audit_needed(container, name, data):
+                    self.audit_data(name, data)
+                self.apply_output(container, name, *hit)
+
+        return missing
+
+    def transform_file(self, container, name, lang):
+        '''Transform a document of the container in place.'''
+
+        metrics = self.metrics
+        metrics.start_file(name)
+
+        key = self.cache_keys.pop(name, None)
+        audit = self.audit_needed(container, name)
+        before = self.stat_values()
+
+        with metrics.timer('parse'):
+            root = container.parsed(name)
+        with metrics.timer('transform'):
+            changes = self.transform(root, lang, audit)
+        self.sample_memory()
+        if audit:
+            self.add_findings(name, self.audit_findings)
+
+        if key is None:
+            self.mark(container, name, changes)
+            self.keep(container, name)
+        else:
+            deltas = {k: v - before[k] for k, v in self.stat_values().items()}
+            output = None
+            if changes:
+                with metrics.timer('serialise'):
+                    output = serialize(root)
+
+            self.cache.put(key, output, deltas)
+            self.apply_output(container, name, output, {})
+
+        metrics.end_file()
+
+    def stream_file(self, container, name, lang):
+        '''Transform a large document without building its tree.
+
+        Documents that cannot be streamed faithfully (e.g. with entity
+        references) fall back to the tree-based transform. Streamed
+        documents are neither cached, audited nor searched for evidence,
+        as `CONTENT_RULES` need the content of the elements.
+        '''
+
+        import shutil
+        import tempfile
+
+        before = self.stat_values()
+        rules = self.document_rules()
+        stream = feature('stream')
+        streamer = stream.DocumentStreamer(self, tuple(
+            rule for rule in rules if rule not in CONTENT_RULES))
+        self.metrics.start_file(name)
+
+        with tempfile.SpooledTemporaryFile(self.spool_size) as sink:
+            try:
+                with container.open(name, 'rb') as source, \
+                        self.metrics.timer('stream'):
+                    changes = streamer.run(source, sink, lang)
+            except stream.StreamError:
+                self.merge_stats({k: before[k] - v for k, v in
+                                  self.stat_values().items()})
+                self.counters['stream_fallbacks'] += 1
+                return self.transform_file(container, name, lang)
+
+            if changes:
+                if self.journal is not None:
+                    sink.seek(0)
+                    self.journal.record_data(
+                        name, container.raw_data(name, decode=False),
+                        digest_file(sink))
+
+                sink.seek(0)
+                with container.open(name, 'wb') as f:
+                    shutil.copyfileobj(sink, f)
+                self.counters['files_changed'] += 1
+            else:
+                self.counters['files_skipped'] += 1
+
+        if self.findings is not None:
+            self.counters['audit_skipped'] += 1
+        if 'infer_access' in rules:
+            self.counters['evidence_skipped'] += 1
+
+        self.metrics.end_file()
+
+    def keep(self, container, name):
+        '''Account for the parsed tree of document `name`, evicting the
+        trees used least recently while over the memory budget.'''
+
+        if self.memory_budget is None:
+            return
+
+        self.resident[name] = self.sizes.get(name, 0) * TREE_FACTOR
+        self.resident.move_to_end(name)
+
+        total = sum(self.resident.values())
+        while self.resident and total > self.memory_budget:
+            old, cost = self.resident.popitem(last=False)
+            total -= cost
+            self.evict(container, old)
+        self.sample_memory()
+
+    def evict(self, container, name):
+        '''Drop the parsed tree of `name`, serialising it first if it
+        changed.'''
+
+        if name in container.dirtied:
+            with self.metrics.timer('serialise'):
+                container.commit_item(name, keep_parsed=False)
+        else:
+            container.parsed_cache.pop(name, None)
+        self.counters['trees_evicted'] += 1
+
+    def audit(self, container):
+        '''Check the documents of the book, without changing them.
+
+        Returns the list of `Finding` entries. With a cache, findings are
+        reused for documents already audited with the same content.
+        '''
+
+        self.findings = []
+
+        with self.metrics.timer('audit'):
+            for name in self.documents(container):
+                data = container.raw_data(name, decode=False)
+                if self.audit_needed(container, name, data,
+                                     transformed=False):
+                    self.audit_data(name, data, transformed=False)
+
+        return self.findings
+
+    def audit_needed(self, container, name, data=None, transformed=True):
+        '''Return whether a document is to be audited in its walk.
+
+        It is not if the audit is off, or if the findings for its content
+        are cached, in which case they are added at once (see
+        `add_findings()` for `transformed`).
+        '''
+
+        if self.findings is None:
+            return False
+        if self.cache is None:
+            return True
+
+        if data is None:
+            data = container.raw_data(name, decode=False)
+        key = feature('audit').findings_key(data, self.tables.digest)
+        hit = self.cache.get(key)
+
+        if hit is None:
+            self.audit_keys[name] = key
+            return True
+
+        self.counters['audit_cached'] += 1
+        self.add_findings(name, hit[1], transformed)
+        return False
+
+    def audit_data(self, name, data, transformed=True):
+        '''Audit a serialised document, without the other rules.'''
+
+        self.walk(parse_xml(data), None, ('audit',))
+        self.add_findings(name, self.audit_findings, transformed)
+
+    def add_findings(self, name, findings, transformed=True):
+        '''Add the (check, line, message) findings of a document, storing
+        them in the cache if it was audited.
+
+        `transformed` tells whether the rules of the run are applied to
+        the document (or were, for a cached output): title mismatches are
+        then left out if 'override_title' is one of them, as it fixes
+        them.
+        '''
+
+        key = self.audit_keys.pop(name, None)
+        if key is not None:
+            self.cache.put(key, None, [list(f) for f in findings])
+
+        Finding = feature('audit').Finding
+        fixed = transformed and 'override_title' in self.document_rules()
+        for check, line, message in findings:
+            if check == 'title-mismatch' and fixed:
+                continue
+            self.findings.append(Finding(name, check, line, message))
+            self.counters['findings'] += 1
+
+    def apply_output(self, container, name, output, deltas):
+        '''Write the result of a transform run elsewhere (a worker
+        process or a previous run) into the container.
+
+        `output` is None if the document was left untouched.
+        '''
+
+        self.metrics.start_file(name)
+        self.merge_stats(deltas)
+
+        if output is not None:
+            if self.journal is not None:
+                self.journal.record_data(
+                    name, container.raw_data(name, decode=False),
+                    digest(output))
+
+            with container.open(name, 'wb') as f:
+                f.write(output)
+            self.counters['files_changed'] += 1
+        else:
+            self.counters['files_skipped'] += 1
+
+        self.metrics.end_file()
+
+    @staticmethod
+    def spine_order(container, names):
+        '''Sort `names` in spine order, other files last.'''
+
+        position = {}
+        for index, (name, linear) in enumerate(container.spine_names):
+            position.setdefault(name, index)
+
+        return sorted(names, key=lambda n: position.get(n, len(position)))
+
+    def transform(self, root, lang, audit=True):
+        '''Apply the document heuristics to a parsed XHTML file.
+
+        All the enabled rules are applied in a single walk of the tree;
+        with `audit` false, the audit is left out. Returns the list of
+        changes made.
+        '''
+
+        return self.walk(root, lang, self.walk_rules(audit))
+
+    def document_rules(self):
+        '''Return the document rules enabled by the prefs, in order.'''
+
+        return self.run_plan.rules
+
+    def walk_rules(self, audit):
+        rules = self.document_rules()
+        if audit or 'audit' not in rules:
+            return rules
+        return tuple(rule for rule in rules if rule != 'audit')
+
+    def compile_rules(self, rules):
+        '''Build the dispatch tables used by `walk()` for the given rules.
+
+        Rules run on an element either because of its tag name or
+        because it carries a given attribute. Rules are applied in the
+        order given, e.g. 'add_fn_type' must precede 'add_aria' so that
+        the new epub:type gets its aria role, and 'audit' comes first so
+        that it checks elements before they are changed, while
+        'infer_access' comes last so that it counts the roles added.
+        '''
+
+        compiled = self.compiled_rules.get(rules)
+        if compiled is not None:
+            return compiled
+
+        by_tag = {}
+        by_attrib = []
+
+        for rule in rules:
+            if rule == 'add_lang':
+                by_tag.setdefault('html', []).append(self.lang_node)
+            elif rule == 'add_aria':
+                by_attrib.append((EPUB_TYPE, self.aria_node))
+            elif rule == 'add_fn_type':
+                by_attrib.append(('class', self.class_node))
+                for tag, crules in self.run_plan.classes.by_tag.items():
+                    by_tag.setdefault(tag, []).append(
+                        partial(self.apply_class_rules, crules))
+            elif rule == 'override_title':
+                by_tag.setdefault('title', []).append(self.title_node)
+                by_tag.setdefault('h1', []).append(self.h1_node)
+            elif rule == 'audit':
+                audit = feature('audit')
+                if self.auditor is None:
+                    self.auditor = audit.Auditor(self.tables.types)
+                auditor = self.auditor
+                for tag in audit.HEADINGS:
+                    by_tag.setdefault(tag, []).append(auditor.heading)
+                by_tag.setdefault('title', []).append(auditor.title_node)
+                by_tag.setdefault('table', []).append(auditor.table)
+                by_tag.setdefault('a', []).append(auditor.link)
+                by_attrib.append((EPUB_TYPE, auditor.epub_type))
+            elif rule == 'infer_access':
+                infer = feature('infer')
+                if self.evidence is None:
+                    self.evidence = infer.EvidenceCollector(self.counters)
+                collector = self.evidence
+                for tag in infer.TEXT_TAGS:
+                    by_tag.setdefault(tag, []).append(collector.text_node)
+                for tag in feature('audit').HEADINGS:
+                    by_tag.setdefault(tag, []).append(collector.heading)
+                by_tag.setdefault('img', []).append(collector.image)
+                by_tag.setdefault('image', []).append(collector.svg_image)
+                by_tag.setdefault('math', []).append(collector.math)
+                by_tag.setdefault('table', []).append(collector.table)
+                by_attrib.append((EPUB_TYPE, collector.epub_type))
+                by_attrib.append(('role', collector.role))
+            else:
+                raise ValueError('Unknown rule: {}'.format(rule))
+
+        compiled = ({tag: tuple(fns) for tag, fns in by_tag.items()},
+                    tuple(by_attrib), 'override_title' in rules)
+        self.compiled_rules[rules] = compiled
+
+        return compiled
+
+    def walk(self, root, lang, rules):
+        '''Walk the tree once, dispatching each element to the rules.'''
+
+        by_tag, by_attrib, titles = self.compile_rules(rules)
+
+        self.changes = []
+        self.lang = lang
+        self.title = self.h1 = None
+
+        audit = 'audit' in rules
+        if audit:
+            self.auditor.reset()
+        infer_access = 'infer_access' in rules
+        if infer_access:
+            self.evidence.reset()
+
+        count = 0
+        for node in root.iter(lxml.etree.Element):
+            count += 1
+
+            fns = by_tag.get(node.tag.rpartition('}')[2])
+            if fns:
+                for fn in fns:
+                    fn(node)
+
+            for attribute, fn in by_attrib:
+                value = node.get(attribute)
+                if value:
+                    fn(node, value)
+
+        # before the title is overridden
+        self.audit_findings = self.auditor.finish() if audit else None
+        if infer_access:
+            self.evidence.finish()
+
+        if titles and self.title is not None and self.h1 is not None:
+            self.write_text(self.title, ''.join(self.h1.itertext()),
+                            self.title_stat)
+
+        self.counters['scans'] += 1
+        self.counters['elements'] += count
+        self.metrics.observe('document_nodes', count)
+
+        return self.changes
+
+    def get_lang(self, container):
+        '''Retrieve book main language.
+        This method parses the OPF file, gets a list of the declared
+        languages and returns the first one (which we trust to be the
+        main language of the book).
+        '''
+
+        try:
+            lang = container.opf_xpath('//dc:language/text()')[0]
+        except IndexError:
+            raise AccessAideError('The OPF file does not report '
+                                  'language info.', code='missing-language')
+
+        return lang
+
+    def add_lang(self, root, lang):
+        '''Add language attributes to <html> tags.
+
+        This method finds the <html> tag of the given 'root' element
+        and adds language declarations. Changes are tracked and successes
+        increase a stat counter.
+        '''
+
+        return self.walk(root, lang, ('add_lang',))
+
+    def lang_node(self, html):
+
+        # set lang for 'lang' attribute
+        self.write_attrib(html, 'lang', self.lang, self.lang_stat)
+
+        # set lang for 'xml:lang' attribute
+        self.write_attrib(html, XML_LANG, self.lang, self.lang_stat)
+
+    def passages(self, root):
+        '''Yield the innermost block elements of a document having no
+        language of their own, with the language they inherit.'''
+
+        for node in root.iter(lxml.etree.Element):
+            if node.tag.rpartition('}')[2] not in BLOCKS \
+               or node.get('lang') or node.get(XML_LANG):
+                continue
+
+            if any(child.tag.rpartition('}')[2] in BLOCKS
+                   for child in node.iterchildren(lxml.etree.Element)):
+                continue
+
+            inherited = None
+            for parent in node.iterancestors():
+                inherited = parent.get(XML_LANG) or parent.get('lang')
+                if inherited:
+                    break
+
+            yield node, inherited
+
+    def add_passage_lang(self, container, docs, lang):
+        '''Add language attributes to passages in another language.
+
+        The text of the block elements of all the given documents is
+        scored in a single batch (see `lib/langdetect.py`); blocks whose
+        language differs from the inherited one (or the book one) with
+        enough confidence get `lang` and `xml:lang` attributes.
+        '''
+
+        # passages are found again by position, as trees may be evicted
+        # in between
+        found = []
+        texts = []
+        for name in docs:
+            for index, (node, inherited) in enumerate(
+                    self.passages(container.parsed(name))):
+                found.append((name, index, inherited or lang))
+                texts.append(''.join(node.itertext()))
+            self.keep(container, name)
+
+        langdetect = feature('langdetect')
+        self.counters['passages'] += len(found)
+        results = langdetect.detect(texts)
+
+        threshold = self.run_plan.passage_threshold
+        changed = {}
+        for (name, index, inherited), result in zip(found, results):
+            if result is None:
+                continue
+
+            detected, confidence = result
+            if confidence >= threshold \
+               and not langdetect.same_language(detected, inherited):
+                changed.setdefault(name, []).append((index, detected))
+
+        for name, passages in changed.items():
+            self.metrics.start_file(name)
+            self.changes = []
+            nodes = [node for node, _ in
+                     self.passages(container.parsed(name))]
+            for index, detected in passages:
+                node = nodes[index]
+                self.write_attrib(node, 'lang', detected, self.passage_stat)
+                self.write_attrib(node, XML_LANG, detected, None)
+
+            # already counted as changed or skipped by the document pass
+            self.mark(container, name, self.changes, count=False)
+            self.keep(container, name)
+            self.metrics.end_file()
+
+    def add_images(self, container, docs, streamed):
+        '''Build the inventory of the <img> elements of the book.
+
+        Image sizes are read from the file headers only (see
+        `lib/images.py`); alt text statuses are counted as `alt_missing`,
+        `alt_empty` and `alt_present`.
+        '''
+
+        streamed = set(streamed)
+        if self.memory_budget is not None:
+            # read evicted documents without parsing them again
+            streamed.update(name for name in docs
+                            if name not in self.resident)
+
+        self.images = feature('images').inventory(container, docs, streamed)
+
+        self.counters['images'] += len(self.images)
+        for image in self.images:
+            self.counters['alt_' + image.alt] += 1
+
+    def add_lang_opf(self, root, lang):
+        '''Add language attributes to <package> tag in the `content.opf` file.
+
+        This method finds the <package> tag of the given 'root' element
+        and adds a 'xml:lang' language declarations. Changes are tracked and
+        successes increase a stat counter.
+
+        Note: the 'xml:lang' attribute of the <package> note is set to the
+        book language value defined in the OPF file (<dc:language>).
+        This would not be appropriate in the case where the book is written
+        in a language different from the one used in the `content.opf` file.
+        '''
+
+        pkg = root.xpath('//*[local-name()="package"]')[0]
+
+        # set lang for 'xml:lang' attribute
+        self.write_attrib(pkg, XML_LANG, lang, self.lang_stat)
+
+    def add_aria(self, root):
+        '''Add aria roles.
+
+        This method finds nodes with epub:type attributes
+        and adds aria roles appropriately.
+        Before adding the new aria role, the node tag is checked against
+        a given list of possible tags and a list of allowed extra tags. Please,
+        refer to the documentation in the `./assets/` folder for more on this.
+        '''
+
+        return self.walk(root, None, ('add_aria',))
+
+    def aria_node(self, node, values):
+        aria = self.tables.aria
+        tag = node.tag.rpartition('}')[2]
+
+        # iter over values, in case of epub:type overloading
+        for value in values.split(' '):
+
+            # get rule for the (value, tag) pair (if present)
+            rule = aria.get((value, tag))
+
+            if rule:
+
+                # EXCEPTIONS
+                # skip if <img> doesn't have alt text
+                if rule.needs_alt and not node.get('alt'):
+                    continue
+
+                # skip if <a> is not in map and has href value
+                if rule.needs_no_href and node.get('href'):
+                    continue
+
+                self.write_attrib(node, 'role', rule.role, self.aria_stat)
+
+    def override_title(self, root):
+        '''Replace the text content of the <title> tag with the one of <h1>
+
+        This method finds the first <h1> tag of the given 'root' element
+        and override the text of <title> in the header.
+        Changes are tracked and successes increase a stat counter.
+        '''
+
+        return self.walk(root, None, ('override_title',))
+
+    def title_node(self, node):
+        if self.title is None:
+            self.title = node
+
+    def h1_node(self, node):
+        if self.h1 is None:
+            self.h1 = node
+
+    def add_fn_type(self, root):
+        '''Add epub:role to footnote markers and references
+
+        This method finds footnote markers and references on the page
+        and adds the corresponding epub:type(s), following the class
+        rules of the run plan. The rules shipped in `class-rules.json`
+        assume the book has been produced with InDesign.
+        Changes are tracked and successes increase a stat counter.
+        '''
+
+        return self.walk(root, None, ('add_fn_type',))
+
+    def class_node(self, node, value):
+        # exact tokens, so that e.g. `_idFootnoteLinkX` is not a match
+        by_class = self.run_plan.classes.by_class
+        for token in value.split():
+            crules = by_class.get(token)
+            if crules:
+                self.apply_class_rules(crules, node)
+
+    def apply_class_rules(self, crules, node):
+        tag = node.tag.rpartition('}')[2]
+
+        for rule in crules:
+            if rule.tags is not None and tag not in rule.tags:
+                continue
+
+            for attribute, expected in rule.attribs:
+                actual = node.get(attribute)
+                if expected is True:
+                    if actual is None:
+                        break
+                elif expected is False:
+                    if actual is not None:
+                        break
+                elif actual != expected:
+                    break
+            else:
+                for attribute, value in rule.sets:
+                    self.write_attrib(node, attribute, value,
+                                      self.fn_stat if attribute == EPUB_TYPE
+                                      else self.aria_stat)
+
+    def write_attrib(self, node, attribute, value, stat):
+        '''Write attributes to nodes.
+
+        Attributes are written if config has 'force_override' set
+        or if node is not present. Writing the value already in place is
+        not a change.
+        '''
+
+        old = node.get(attribute)
+
+        if (self.force_override or old is None) and old != value:
+
+            change = Change('attrib', node, attribute, old, value)
+            node.attrib[attribute] = value
+            self.changes.append(change)
+            if stat:
+                stat.increase()
+
+        return
+
+    def write_text(self, node, value, stat):
+        '''Write text to nodes.
+
+        Text is written if config has 'force_override' set
+        or if node text differs. Writing the text already in place is
+        not a change.
+        '''
+
+        if (self.force_override or ''.join(node.itertext()) != value) \
+           and (node.text != value or len(node)):
+
+            change = Change('text', node, None, node.text, value)
+            node.text = value
+            self.changes.append(change)
+            if stat:
+                stat.increase()
+
+        return
+
+    def insert_element(self, container, element):
+        '''Insert a new element into the OPF metadata and track the
+        change.'''
+
+        index = self.metadata_index(container)
+        tail = index.metadata[-1].tail if len(index.metadata) else None
+
+        index.insert(container, element)
+        self.changes.append(Change('insert', element, None, tail,
+                                   index.metadata))
+
+    def mark(self, container, name, changes, count=True):
+        '''Mark a file dirty, only if something changed in it.
+
+        Changes are recorded in the journal, if any. In dry-run mode,
+        they are recorded in the plan and reverted instead. With `count`
+        false, the file is not counted as changed or skipped.
+        '''
+
+        if self.dry_run:
+            self.planned.extend(plan_entry(name, c) for c in changes)
+            revert(changes)
+            return
+
+        if changes:
+            container.dirty(name)
+            if count:
+                self.counters['files_changed'] += 1
+
+            if self.journal is not None:
+                self.journal.record(name, changes)
+        elif count:
+            self.counters['files_skipped'] += 1
+
+    def stats(self):
+        '''Return the stat counters relevant to the current prefs.'''
+
+        data = [self.lang_stat, self.aria_stat, self.meta_stat]
+
+        if 'override_title' in self.run_plan.rules:
+            data.append(self.title_stat)
+        if 'add_fn_type' in self.run_plan.rules:
+            data.append(self.fn_stat)
+        if self.run_plan.passage_threshold is not None:
+            data.append(self.passage_stat)
+
+        return data
+
+    def report_lines(self):
+        '''Return the lines of the stats report.'''
+
+        data = [stat.report() for stat in self.stats()]
+        data.append('Files left untouched: {}'
+                    .format(self.counters['files_skipped']))
+        if self.cache is not None:
+            data.append('Cache hits: {}, misses: {}'
+                        .format(self.counters['cache_hits'],
+                                self.counters['cache_misses']))
+        if self.counters['streamed']:
+            data.append('Files streamed: {}'
+                        .format(self.counters['streamed']))
+        if self.images is not None:
+            images = feature('images')
+            counts = {status: self.counters['alt_' + status]
+                      for status in images.ALT_STATUS}
+            data.append('Images: {}, without alt text: {}'
+                        .format(len(self.images), counts['missing']))
+            if self.images:
+                data.append('Alt text coverage: {}%'
+                            .format(images.coverage(counts)))
+        if self.inferred is not None:
+            for key in ('accessibilityFeature', 'accessMode',
+                        'accessModeSufficient'):
+                data.append('Inferred {}: {}'.format(
+                    key, ', '.join(self.inferred[key])))
+        if self.memory_budget is not None:
+            memory = memory_entry(self.metrics.snapshot())
+            line = 'Documents unloaded: {}'.format(memory['trees_evicted'])
+            if memory['peak_rss'] is not None:
+                line += ', peak memory: {:.1f} MB (+{:.1f} MB)'.format(
+                    memory['peak_rss'] / (1024 * 1024),
+                    memory['rss_increase'] / (1024 * 1024))
+            data.append(line)
+        if self.findings is not None:
+            counts = feature('audit').count_findings(self.findings)
+            data.append('Accessibility findings: {}'.format(
+                ', '.join('{} {}'.format(count, check)
+                          for check, count in counts.items() if count)
+                or 'none'))
+
+        return data
+
+    def stats_report(self):
+        '''Compose a short report on stats.
+
+        This method returns a string to display at the end of
+        runtime along with some statistics.
+        '''
+
+        data = self.report_lines()
+
+        return '<h3>Routine completed</h3><p>{}</p>'.format('<br>'.join(data))
+
+    def report(self, book=None, errors=()):
+        '''Return the machine-readable report of the run (see
+        `lib.report`).'''
+
+        return build_report(self.metrics.snapshot(), book=book,
+                            errors=errors, images=self.images,
+                            findings=self.findings, inferred=self.inferred)
+
+    def all_stats(self):
+        return {'lang_stat': self.lang_stat, 'aria_stat': self.aria_stat,
+                'meta_stat': self.meta_stat, 'title_stat': self.title_stat,
+                'fn_stat': self.fn_stat, 'passage_stat': self.passage_stat}
+
+    def stat_values(self):
+        '''Return the stat counters, along with the evidence ones.'''
+
+        values = {key: stat.get() for key, stat in self.all_stats().items()}
+        for key in self.evidence_keys:
+            values[key] = self.counters.get(key, 0)
+
+        return values
+
+    def merge_stats(self, deltas):
+        '''Add stat deltas (as from `stat_values()`) to the counters.'''
+
+        for key, stat in self.all_stats().items():
+            stat.value += deltas.get(key, 0)
+        for key in self.evidence_keys:
+            if deltas.get(key):
+                self.counters[key] += deltas[key]
+
+    def reset_stats(self):
+        for stat in self.all_stats().values():
+            stat.reset()
+
+    def metadata_index(self, container):
+        '''Return the index of the OPF <metadata>, built once per run.'''
+
+        metadata = container.opf_xpath('//opf:metadata')[0]
+
+        if self.meta_index is None or self.meta_index.metadata is not metadata:
+            self.meta_index = MetadataIndex(metadata)
+
+        return self.meta_index
+
+    def add_metadata(self, container):
+        ''' Add metadata to OPF file.
+
+        This method looks up the config file and add appropriate metadata for
+        the volume. Declarations already present with the same value are
+        never duplicated. Inferred metadata, if any, replaces the values of
+        the prefs for the same keys.
+        '''
+
+        index = self.metadata_index(container)
+        version = container.opf_version_parsed.major
+
+        if version not in (2, 3):
+            return
+
+        items = self.run_plan.access
+        if self.inferred is not None:
+            items = [item for item in items
+                     if item.key.partition(':')[2] not in self.inferred]
+            items.extend(meta_item('schema:' + key, value)
+                         for key, values in self.inferred.items()
+                         for value in values)
+
+        for item in items:
+
+            # prevent duplicates
+            if index.has(item.key, item.value):
+                self.counters['meta_skipped'] += 1
+                continue
+
+            self.insert_element(container, item.element(version))
+
+            self.meta_stat.increase()
+
+    def add_a11y(self, container):
+        ''' Add a11y metadata to OPF file.
+
+        This method looks up the config file and add appropriate metadata for
+        the volume. Existing declarations are kept, unless config has
+        'force_override' set.
+        '''
+
+        index = self.metadata_index(container)
+        version = container.opf_version_parsed.major
+
+        if version not in (2, 3):
+            return
+
+        for item in self.run_plan.a11y:
+
+            # prevent overriding
+            if index.has(item.key, item.value) or \
+               (index.has(item.key) and not self.force_override):
+                self.counters['meta_skipped'] += 1
+                continue
+
+            self.insert_element(container, item.element(version))
+
+            self.meta_stat.increase()
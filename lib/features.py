@@ -0,0 +1,32 @@
+#!/usr/bin/env python3
+'''
+Access Aide - A Calibre plugin to enhance accessibility features in epub files.
+Copyright (C) 2020-2021 Luca Baffa
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+from importlib import import_module
+
+# optional feature modules, imported when a run first needs them
+FEATURES = ('stream', 'langdetect', 'images', 'audit', 'infer')
+
+
+def feature(name):
+    '''Return the feature module `name` (see `FEATURES`), importing it
+    on first use, so that runs without it do not pay for its import.'''
+
+    if __package__:
+        return import_module('.' + name, __package__)
+    return import_module(name)
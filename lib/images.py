@@ -0,0 +1,247 @@
+#!/usr/bin/env python3
+'''
+Access Aide - A Calibre plugin to enhance accessibility features in epub files.
+Copyright (C) 2020-2021 Luca Baffa
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+import posixpath
+import re
+import struct
+from collections import namedtuple
+from urllib.parse import unquote, urlparse
+
+import lxml.etree
+
+# `document`: file holding the <img>
+# `src`: value of its src attribute, `name`: the file it points to, None
+#        for remote and data URLs
+# `alt`: 'missing', 'empty' (decorative) or 'present'
+# `format`, `width`, `height`: None when the file is missing or unknown
+Image = namedtuple('Image', ['document', 'src', 'name', 'alt', 'format',
+                             'width', 'height'])
+
+ALT_STATUS = ('missing', 'empty', 'present')
+
+IMG_TAGS = ('{http://www.w3.org/1999/xhtml}img', 'img')
+
+# bytes read to identify a format and, for most formats, its size
+HEADER_SIZE = 32
+
+# bytes of an SVG file searched for the <svg> tag
+SVG_HEADER_SIZE = 4096
+
+# JPEG markers of a frame header (SOFn), which holds the size
+JPEG_SOF = frozenset(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+
+SVG_TAG = re.compile(rb'<svg\b[^>]*>', re.S)
+SVG_ATTRIB = re.compile(rb'\b(width|height|viewBox)\s*=\s*["\']([^"\']*)')
+SVG_LENGTH = re.compile(rb'^\s*([0-9.]+)\s*(px)?\s*$')
+
+
+def alt_status(img):
+    alt = img.get('alt')
+    if alt is None:
+        return 'missing'
+    return 'present' if alt.strip() else 'empty'
+
+
+def resolve(src, document):
+    '''Return the name of the file `src` points to, from `document`,
+    None for remote and data URLs.'''
+
+    if urlparse(src).scheme:
+        return None
+
+    path = unquote(src.partition('#')[0].partition('?')[0])
+    return posixpath.normpath(posixpath.join(posixpath.dirname(document),
+                                             path))
+
+
+def jpeg_size(f):
+    '''Walk the JPEG segments up to the first frame header, seeking over
+    the segment payloads (EXIF thumbnails, ICC profiles, ...).
+
+    Payloads are not kept, but whether seeking reads them depends on `f`:
+    a deflated zip member is inflated up to the frame header, since its
+    stream can only move forward by decompressing.
+    '''
+
+    f.seek(2)
+    while True:
+        byte = f.read(1)
+        while byte and byte != b'\xff':
+            byte = f.read(1)
+        while byte == b'\xff':
+            byte = f.read(1)
+        if not byte:
+            return None
+
+        marker = byte[0]
+        if marker == 0x01 or 0xD0 <= marker <= 0xD9:
+            continue
+
+        data = f.read(2)
+        if len(data) < 2:
+            return None
+        length = struct.unpack('>H', data)[0]
+
+        if marker in JPEG_SOF:
+            data = f.read(5)
+            if len(data) < 5:
+                return None
+            height, width = struct.unpack('>HH', data[1:5])
+            return width, height
+
+        f.seek(length - 2, 1)
+
+
+def svg_size(f):
+    f.seek(0)
+    match = SVG_TAG.search(f.read(SVG_HEADER_SIZE))
+    if match is None:
+        return None
+
+    attribs = dict(SVG_ATTRIB.findall(match.group(0)))
+    try:
+        width, height = (float(SVG_LENGTH.match(attribs[key]).group(1))
+                         for key in (b'width', b'height'))
+    except (KeyError, AttributeError, ValueError):
+        try:
+            width, height = (float(value) for value in
+                             attribs[b'viewBox'].replace(b',', b' ')
+                             .split()[2:4])
+        except (KeyError, ValueError):
+            return None
+
+    return round(width), round(height)
+
+
+def sniff(f):
+    '''Return (format, width, height) of the image in file `f`.
+
+    Only the header is read: a few bytes for most formats, the segments
+    up to the frame header for JPEG (see `jpeg_size()`), the first
+    `SVG_HEADER_SIZE` bytes for SVG. Sizes are None if the header cannot
+    be read, the format too if unknown.
+    '''
+
+    head = f.read(HEADER_SIZE)
+    size = None
+
+    if head.startswith(b'\x89PNG\r\n\x1a\n') and head[12:16] == b'IHDR':
+        fmt = 'png'
+        size = struct.unpack('>II', head[16:24])
+    elif head[:6] in (b'GIF87a', b'GIF89a'):
+        fmt = 'gif'
+        size = struct.unpack('<HH', head[6:10])
+    elif head.startswith(b'\xff\xd8'):
+        fmt = 'jpeg'
+        size = jpeg_size(f)
+    elif head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        fmt = 'webp'
+        chunk = head[12:16]
+        if chunk == b'VP8 ' and len(head) >= 30:
+            width, height = struct.unpack('<HH', head[26:30])
+            size = width & 0x3FFF, height & 0x3FFF
+        elif chunk == b'VP8L' and len(head) >= 25:
+            bits = struct.unpack('<I', head[21:25])[0]
+            size = (bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1
+        elif chunk == b'VP8X' and len(head) >= 30:
+            size = (int.from_bytes(head[24:27], 'little') + 1,
+                    int.from_bytes(head[27:30], 'little') + 1)
+    elif head.startswith(b'BM') and len(head) >= 26:
+        fmt = 'bmp'
+        width, height = struct.unpack('<ii', head[18:26])
+        size = width, abs(height)
+    elif b'<svg' in head or head.lstrip().startswith(b'<?xml') or \
+            head.lstrip().startswith(b'<!'):
+        size = svg_size(f)
+        fmt = 'svg' if size is not None or b'<svg' in head else None
+    else:
+        return None, None, None
+
+    if size is None:
+        return fmt, None, None
+    return (fmt,) + tuple(size)
+
+
+def iter_images(source):
+    '''Yield the <img> elements of a document read from file `source`,
+    without keeping its tree in memory.'''
+
+    for _, node in lxml.etree.iterparse(source, events=('end',),
+                                        resolve_entities=False):
+        if node.tag in IMG_TAGS:
+            yield node
+
+        # the element is done with, and so are its previous siblings
+        node.clear(keep_tail=True)
+        parent = node.getparent()
+        if parent is not None:
+            while node.getprevious() is not None:
+                del parent[0]
+
+
+def inventory(container, documents, streamed=()):
+    '''Return the `Image` entries of the <img> elements of `documents`.
+
+    Each image file is sniffed once, however many times it is used.
+    Documents in `streamed` are read without building their tree.
+    '''
+
+    images = []
+    sizes = {}
+
+    for document in documents:
+        if document in streamed:
+            try:
+                with container.open(document) as f:
+                    nodes = [(img.get('src'), alt_status(img))
+                             for img in iter_images(f)]
+            except lxml.etree.XMLSyntaxError:
+                nodes = None
+        else:
+            nodes = None
+
+        if nodes is None:
+            nodes = [(img.get('src'), alt_status(img))
+                     for img in container.parsed(document).iter(IMG_TAGS)]
+
+        for src, alt in nodes:
+            name = resolve(src, document) if src else None
+
+            if name is None or name not in container.mime_map:
+                size = (None, None, None)
+            else:
+                size = sizes.get(name)
+                if size is None:
+                    with container.open(name) as f:
+                        size = sizes[name] = sniff(f)
+
+            images.append(Image(document, src, name, alt, *size))
+
+    return images
+
+
+def coverage(counts):
+    '''Return the share of images with an alt attribute (empty for
+    decorative ones), as a percentage; None without images.'''
+
+    total = sum(counts.get(status, 0) for status in ALT_STATUS)
+    if not total:
+        return None
+
+    return round(100 * (total - counts.get('missing', 0)) / total, 1)
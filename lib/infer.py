@@ -0,0 +1,251 @@
+#!/usr/bin/env python3
+'''
+Access Aide - A Calibre plugin to enhance accessibility features in epub files.
+Copyright (C) 2020-2021 Luca Baffa
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+
+import lxml.etree
+
+try:
+    from .images import alt_status
+except ImportError:
+    from images import alt_status
+
+EPUB_TYPE = '{http://www.idpf.org/2007/ops}type'
+MATHML = '{http://www.w3.org/1998/Math/MathML}'
+NCX_MIME = 'application/x-dtbncx+xml'
+SMIL_MIME = 'application/smil+xml'
+
+# metadata inferred, in the order they are declared
+INFERRED = ('accessibilityFeature', 'accessMode', 'accessModeSufficient',
+            'accessibilitySummary')
+
+# evidence counters, named 'evidence_<name>' in the engine metrics
+EVIDENCE = ('documents', 'text_documents', 'image_documents', 'skipped',
+            'images', 'alt_missing', 'math', 'described_math', 'tables',
+            'headed_tables', 'headings', 'roles', 'toc', 'page_list',
+            'pagebreaks', 'index', 'smil')
+
+# elements whose text makes a document textual, besides headings
+TEXT_TAGS = ('p', 'li', 'dd', 'dt', 'td', 'th', 'pre', 'caption',
+             'figcaption', 'blockquote', 'div', 'span', 'a', 'em', 'strong',
+             'i', 'b', 'section', 'body')
+
+# epub:type and role values, and the evidence they count as
+LANDMARKS = {'toc': 'toc', 'page-list': 'page_list', 'index': 'index',
+             'pagebreak': 'pagebreaks', 'doc-toc': 'toc',
+             'doc-index': 'index', 'doc-pagebreak': 'pagebreaks'}
+
+# (feature, evidence test), in the order they are declared
+FEATURES = (
+    ('tableOfContents', lambda e: e['toc']),
+    ('structuralNavigation', lambda e: e['headings']),
+    ('pageNavigation', lambda e: e['page_list']),
+    ('printPageNumbers', lambda e: e['pagebreaks']),
+    ('index', lambda e: e['index']),
+    ('alternativeText', lambda e: e['images'] and not e['alt_missing']),
+    ('MathML', lambda e: e['math']),
+    ('describedMath',
+     lambda e: e['math'] and e['described_math'] == e['math']),
+    ('ARIA', lambda e: e['roles']),
+    ('synchronizedAudioText', lambda e: e['smil']),
+)
+
+# how features read in the summary
+PHRASES = {
+    'tableOfContents': 'a table of contents',
+    'structuralNavigation': 'structured headings',
+    'pageNavigation': 'a page list',
+    'printPageNumbers': 'the page numbers of the print edition',
+    'index': 'an index',
+    'alternativeText': 'alternative text for all images',
+    'MathML': 'mathematics in MathML',
+    'describedMath': 'text descriptions of all mathematics',
+    'ARIA': 'ARIA roles',
+    'synchronizedAudioText': 'audio synchronised with the text',
+}
+
+
+def has_headers(table):
+    return any(node.tag.rpartition('}')[2] == 'th' or node.get('scope')
+               for node in table.iter(lxml.etree.Element))
+
+
+class EvidenceCollector():
+    '''Evidence counted by the 'infer_access' rule of the engine walk.
+
+    Like `lib.audit.Auditor`, its methods are called on elements as the
+    engine finds them, after the other rules changed them; counts are
+    added to `counters` as 'evidence_<name>'. `finish()` tells whether
+    the document has text or is made of images only.
+    '''
+
+    def __init__(self, counters):
+        self.counters = counters
+        self.reset()
+
+    def reset(self):
+        self.text = False
+        self.pictures = 0
+
+    def count(self, name):
+        self.counters['evidence_' + name] += 1
+
+    def text_node(self, node):
+        if not self.text and node.text and not node.text.isspace():
+            self.text = True
+
+    def image(self, node):
+        self.pictures += 1
+        self.count('images')
+        if alt_status(node) == 'missing':
+            self.count('alt_missing')
+        if node.tail and not node.tail.isspace():
+            self.text = True
+
+    def svg_image(self, node):
+        self.pictures += 1
+
+    def math(self, node):
+        self.count('math')
+        if node.get('alttext') or \
+           next(node.iter(MATHML + 'annotation', MATHML + 'annotation-xml'),
+                None) is not None:
+            self.count('described_math')
+
+    def table(self, node):
+        self.count('tables')
+        if has_headers(node):
+            self.count('headed_tables')
+
+    def heading(self, node):
+        self.count('headings')
+        self.text_node(node)
+
+    def epub_type(self, node, value):
+        for token in value.split():
+            name = LANDMARKS.get(token)
+            if name is not None:
+                self.count(name)
+
+    def role(self, node, value):
+        self.count('roles')
+
+        # the epub:type counted already
+        types = (node.get(EPUB_TYPE) or '').split()
+        for token in value.split():
+            name = LANDMARKS.get(token)
+            if name is not None and token[4:] not in types:
+                self.count(name)
+
+    def finish(self):
+        self.count('documents')
+        if self.text:
+            self.count('text_documents')
+        elif self.pictures:
+            self.count('image_documents')
+
+
+def book_evidence(container, counters):
+    '''Count the evidence found in the manifest rather than in the
+    documents: media overlays, and the NCX of EPUB 2 books with its page
+    list.'''
+
+    for name, media_type in container.mime_map.items():
+        if media_type == SMIL_MIME:
+            counters['evidence_smil'] += 1
+        elif media_type == NCX_MIME:
+            try:
+                ncx = container.parsed(name)
+            except (KeyError, lxml.etree.XMLSyntaxError):
+                continue
+
+            counters['evidence_toc'] += 1
+            if next(ncx.iter('{*}pageList'), None) is not None:
+                counters['evidence_page_list'] += 1
+
+
+def evidence(counters):
+    '''Return the evidence counted so far, as {name: count}.'''
+
+    return {name: counters.get('evidence_' + name, 0) for name in EVIDENCE}
+
+
+def join(phrases):
+    if len(phrases) < 2:
+        return ''.join(phrases)
+    return '{} and {}'.format(', '.join(phrases[:-1]), phrases[-1])
+
+
+def summary(found, features):
+    '''Return a suggested accessibilitySummary.'''
+
+    phrases = [PHRASES[feature] for feature in features if feature in PHRASES]
+    if phrases:
+        sentences = ['This publication provides {}.'.format(join(phrases))]
+    else:
+        sentences = ['This publication has no known accessibility features.']
+
+    if found['alt_missing']:
+        sentences.append('{} of {} images have no alternative text.'
+                         .format(found['alt_missing'], found['images']))
+    if found['image_documents']:
+        sentences.append('{} documents are made of images without text.'
+                         .format(found['image_documents']))
+    if found['tables']:
+        missing = found['tables'] - found['headed_tables']
+        if missing:
+            sentences.append('{} of {} tables have no header cells.'
+                             .format(missing, found['tables']))
+        else:
+            sentences.append('All tables have header cells.')
+
+    return ' '.join(sentences)
+
+
+def infer(found, vocabulary):
+    '''Infer the schema.org accessibility metadata from the evidence.
+
+    Returns {key: [values]} for the keys in `INFERRED`. Features are
+    restricted to `vocabulary` (see `acc_feature_values.json`).
+    '''
+
+    features = [feature for feature, test in FEATURES
+                if test(found) and feature in vocabulary]
+
+    # streamed documents are large, hence textual
+    textual = found['text_documents'] or found['skipped']
+    visual = found['images'] or found['image_documents']
+
+    modes = [mode for mode, present in (('textual', textual),
+                                        ('visual', visual),
+                                        ('auditory', found['smil']))
+             if present] or ['textual']
+
+    # text alone is enough when all images are described
+    sufficient = []
+    if textual and not found['alt_missing'] and \
+       not found['image_documents']:
+        sufficient.append('textual')
+    combined = ','.join(mode for mode in modes if mode != 'auditory')
+    if combined and combined not in sufficient:
+        sufficient.append(combined)
+
+    return {'accessibilityFeature': features or ['none'],
+            'accessMode': modes,
+            'accessModeSufficient': sufficient or [','.join(modes)],
+            'accessibilitySummary': [summary(found, features)]}
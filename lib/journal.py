@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+'''
+Access Aide - A Calibre plugin to enhance accessibility features in epub files.
+Copyright (C) 2020-2021 Luca Baffa
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+
+import hashlib
+
+import lxml.etree
+
+try:
+    from .plan import find
+except ImportError:
+    from plan import find
+
+
+def digest(data):
+    return hashlib.sha1(data).hexdigest()
+
+
+def digest_file(f, chunk_size=1024 * 1024):
+    '''Return the `digest()` of the content of file object `f`.'''
+
+    sha1 = hashlib.sha1()
+    for chunk in iter(lambda: f.read(chunk_size), b''):
+        sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def element_path(node):
+    '''Return the XPath of `node` as positions among element siblings,
+    e.g. `/*[1]/*[1]/*[7]`.
+
+    Unlike `getpath()`, which names prefixed elements (`opf:meta[2]`,
+    counting only the siblings with the same prefix), the path does not
+    depend on namespace prefixes, so it finds the same element again.
+    '''
+
+    steps = []
+    while node is not None:
+        index = sum(1 for _ in node.itersiblings(lxml.etree.Element,
+                                                 preceding=True))
+        steps.append('*[{}]'.format(index + 1))
+        node = node.getparent()
+
+    return '/' + '/'.join(reversed(steps))
+
+
+def signature(node):
+    '''Return what identifies an inserted element: its tag, attributes
+    and text.'''
+
+    return node.tag, dict(node.attrib), node.text
+
+
+class Entry():
+    '''A journal record, enough to undo a change once the element is gone.
+
+    `op` is one of:
+     -  'attrib': `attribute` of the element at `path` went from `old` to
+        `new`;
+     -  'text': the text of the element at `path` went from `old` to `new`;
+     -  'insert': the element at `path` was inserted, `new` holding its
+        `signature()` and `old` the previous tail of the preceding
+        sibling;
+     -  'data': the whole file was replaced, `old` holding its previous
+        content and `new` the digest of the new one.
+    '''
+
+    __slots__ = ('name', 'op', 'path', 'attribute', 'old', 'new')
+
+    def __init__(self, name, op, path, attribute, old, new):
+        self.name = name
+        self.op = op
+        self.path = path
+        self.attribute = attribute
+        self.old = old
+        self.new = new
+
+    def __repr__(self):
+        return 'Entry({!r}, {!r}, {!r}, {!r})'.format(
+            self.name, self.op, self.path, self.attribute)
+
+
+class Journal():
+    '''Reverse journal of the changes made by a run.
+
+    Unlike a savepoint, which copies the whole book (images included),
+    the journal only keeps what the run changed: the previous value of
+    each attribute and text, the position of inserted elements and, for
+    documents rewritten as a whole (parallel, cached or streamed runs),
+    their previous content.
+    '''
+
+    def __init__(self):
+        self.entries = []
+
+    def __len__(self):
+        return len(self.entries)
+
+    def record(self, name, changes):
+        '''Record the `lib.engine.Change` list of file `name`.
+
+        Paths (see `element_path()`) are taken once the file is done, so
+        that they match the tree the journal is replayed against.
+        '''
+
+        entries = self.entries
+        for change in changes:
+            node = change.node
+            path = element_path(node)
+
+            if change.op == 'insert':
+                entries.append(Entry(name, 'insert', path, None, change.old,
+                                     signature(node)))
+            else:
+                entries.append(Entry(name, change.op, path, change.attribute,
+                                     change.old, change.new))
+
+    def record_data(self, name, old, new_digest):
+        '''Record that file `name` was rewritten from `old` to content
+        with `new_digest` (see `digest()`).'''
+
+        self.entries.append(Entry(name, 'data', None, None, old, new_digest))
+
+    def undo(self, container):
+        '''Replay the journal backwards on `container`.
+
+        An entry is undone only if the file still holds what the run
+        left there; otherwise it is counted as a conflict and skipped.
+        Returns the (undone, conflicts) counts; the journal is emptied.
+        '''
+
+        undone = conflicts = 0
+        dirtied = set()
+
+        for entry in reversed(self.entries):
+            if entry.op == 'data':
+                if digest(container.raw_data(entry.name,
+                                             decode=False)) != entry.new:
+                    conflicts += 1
+                    continue
+
+                dirtied.discard(entry.name)
+                with container.open(entry.name, 'wb') as f:
+                    f.write(entry.old)
+                undone += 1
+                continue
+
+            node = find(container.parsed(entry.name), entry.path)
+
+            if entry.op == 'attrib' and node is not None and \
+               node.get(entry.attribute) == entry.new:
+                if entry.old is None:
+                    del node.attrib[entry.attribute]
+                else:
+                    node.attrib[entry.attribute] = entry.old
+
+            elif entry.op == 'text' and node is not None and \
+                    node.text == entry.new:
+                node.text = entry.old
+
+            elif entry.op == 'insert' and node is not None and \
+                    signature(node) == entry.new:
+                previous = node.getprevious()
+                node.getparent().remove(node)
+                # the previous sibling had its tail changed by the insert
+                if previous is not None:
+                    previous.tail = entry.old
+
+            else:
+                conflicts += 1
+                continue
+
+            undone += 1
+            dirtied.add(entry.name)
+
+        for name in dirtied:
+            container.dirty(name)
+
+        self.entries = []
+
+        return undone, conflicts
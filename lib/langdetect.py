@@ -0,0 +1,248 @@
+#!/usr/bin/env python3
+'''
+Access Aide - A Calibre plugin to enhance accessibility features in epub files.
+Copyright (C) 2020-2021 Luca Baffa
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+import json
+import math
+import unicodedata
+from collections import Counter
+
+try:
+    from .prefs import get_asset
+except ImportError:
+    from prefs import get_asset
+
+SAMPLES = 'assets/lang-samples.json'
+
+# passages with fewer letters of the model alphabet are not scored
+MIN_LETTERS = 40
+
+# passage boundary in the joined text of a batch
+SEP = '\0'
+
+# characters scored at once, bounding the memory of a batch to some
+# ten times as many floats
+CHUNK_SIZE = 1 << 19
+
+_model = None
+
+
+def normalize(text, alphabet):
+    '''Lower-case `text`, turn every run of characters outside the
+    alphabet into a single space and pad it with spaces.'''
+
+    text = unicodedata.normalize('NFC', text).lower()
+    words = ''.join(c if c in alphabet else ' ' for c in text).split()
+    return ' {} '.format(' '.join(words))
+
+
+class LanguageModel():
+    '''Character trigram model of the languages of a set of samples.
+
+    Trigrams are encoded as integers, so that a whole batch of passages
+    can be scored with array operations when NumPy is available. Scores
+    are naive Bayes log-likelihoods with add-one smoothing.
+    '''
+
+    def __init__(self, samples):
+        self.languages = sorted(samples)
+
+        letters = set()
+        for text in samples.values():
+            letters.update(c for c in
+                           unicodedata.normalize('NFC', text).lower()
+                           if c.isalpha())
+
+        # 0 is the space, i.e. any character outside the alphabet
+        self.alphabet = {c: i for i, c in enumerate(sorted(letters), 1)}
+        self.base = len(self.alphabet) + 1
+
+        counts = [Counter(self.trigrams(normalize(samples[language],
+                                                  self.alphabet)))
+                  for language in self.languages]
+
+        self.vocab = sorted(set().union(*counts))
+        self.unseen = []
+        self.logp = []
+        for count in counts:
+            total = sum(count.values()) + len(self.vocab) + 1
+            self.logp.append([math.log((count[g] + 1) / total)
+                              for g in self.vocab])
+            self.unseen.append(math.log(1 / total))
+
+        self.table = {g: row for g, row in zip(self.vocab, zip(*self.logp))}
+        self.arrays = None
+
+    def trigrams(self, text):
+        '''Return the trigram codes of a normalised text.'''
+
+        ids = [self.alphabet.get(c, 0) for c in text]
+        base = self.base
+        return [(ids[i] * base + ids[i + 1]) * base + ids[i + 2]
+                for i in range(len(ids) - 2)]
+
+    def decide(self, scores):
+        '''Return the best language and its posterior probability.'''
+
+        best = max(scores)
+        total = sum(math.exp(score - best) for score in scores)
+        return self.languages[scores.index(best)], 1 / total
+
+    def detect_one(self, text, min_letters=MIN_LETTERS):
+        '''Score a single passage, without NumPy.'''
+
+        text = normalize(text, self.alphabet)
+        if len(text) - text.count(' ') < min_letters:
+            return None
+
+        scores = [0.0] * len(self.languages)
+        unseen = self.unseen
+        for g in self.trigrams(text):
+            for i, logp in enumerate(self.table.get(g, unseen)):
+                scores[i] += logp
+
+        return self.decide(scores)
+
+    def build_arrays(self, np):
+        '''Return the lookup tables of `detect_batch()`: alphabet ids by
+        code point, vocabulary index by trigram code and the matrix of
+        log-likelihoods, one column per language and a last row for
+        unseen trigrams.'''
+
+        chars = np.zeros(ord(max(self.alphabet)) + 1, dtype=np.int64)
+        for c, i in self.alphabet.items():
+            chars[ord(c)] = i
+
+        grams_index = np.full(self.base ** 3, len(self.vocab),
+                              dtype=np.int32)
+        grams_index[self.vocab] = np.arange(len(self.vocab))
+
+        logp = np.vstack([np.array(self.logp).T, np.array(self.unseen)])
+
+        return chars, grams_index, logp
+
+    def detect_batch(self, passages, np, min_letters=MIN_LETTERS):
+        '''Score all passages with NumPy, in chunks of about
+        `CHUNK_SIZE` characters.'''
+
+        results = []
+        chunk = []
+        size = 0
+        for passage in passages:
+            chunk.append(passage)
+            size += len(passage)
+            if size >= CHUNK_SIZE:
+                results.extend(self.detect_chunk(chunk, np, min_letters))
+                chunk = []
+                size = 0
+
+        if chunk:
+            results.extend(self.detect_chunk(chunk, np, min_letters))
+
+        return results
+
+    def detect_chunk(self, passages, np, min_letters):
+        '''Score passages at once.
+
+        Passages are joined into one text and turned into a single array
+        of trigram codes, tagged with the index of their passage; the
+        log-likelihoods of each language are then summed per passage.
+        '''
+
+        if self.arrays is None:
+            self.arrays = self.build_arrays(np)
+        chars, grams_index, logp = self.arrays
+
+        text = ' {} '.format((' ' + SEP + ' ').join(
+            passage.replace(SEP, ' ') for passage in passages))
+        text = unicodedata.normalize('NFC', text).lower()
+        codes = np.frombuffer(text.encode('utf-32-le'), dtype=np.uint32)
+
+        pid = np.cumsum(codes == 0)
+        keep = codes != 0
+        codes, pid = codes[keep], pid[keep]
+
+        # alphabet ids, 0 for the characters outside it
+        ids = chars[np.minimum(codes, len(chars) - 1)]
+        ids[codes >= len(chars)] = 0
+
+        # collapse runs of spaces within a passage
+        space = ids == 0
+        drop = space[1:] & space[:-1] & (pid[1:] == pid[:-1])
+        keep = np.concatenate(([True], ~drop))
+        ids, pid = ids[keep], pid[keep]
+
+        count = len(passages)
+        letters = np.bincount(pid[ids != 0], minlength=count)
+
+        base = self.base
+        grams = (ids[:-2] * base + ids[1:-1]) * base + ids[2:]
+        within = pid[:-2] == pid[2:]
+        grams, gid = grams[within], pid[:-2][within]
+
+        # one row of log-likelihoods per trigram, summed per passage; gid
+        # is sorted, and the extra zero row ends the last passage
+        rows = np.vstack([logp[grams_index[grams]],
+                          np.zeros((1, len(self.languages)))])
+        starts = np.searchsorted(gid, np.arange(count))
+        scores = np.add.reduceat(rows, starts, axis=0)
+
+        best = scores.argmax(axis=1)
+        confidence = 1 / np.exp(scores - scores.max(axis=1)[:, None]) \
+            .sum(axis=1)
+
+        return [(self.languages[b], float(c)) if n >= min_letters else None
+                for b, c, n in zip(best.tolist(), confidence.tolist(),
+                                   letters.tolist())]
+
+
+def load_model():
+    '''Return the model of the shipped samples, built once per process.'''
+
+    global _model
+    if _model is None:
+        _model = LanguageModel(json.loads(get_asset(SAMPLES)))
+
+    return _model
+
+
+def detect(passages, model=None, min_letters=MIN_LETTERS):
+    '''Return the (language, confidence) of each passage.
+
+    Passages with fewer than `min_letters` letters known to the model
+    get None. NumPy is optional: without it passages are scored one at
+    a time, with the same results.
+    '''
+
+    if model is None:
+        model = load_model()
+
+    try:
+        import numpy
+    except ImportError:
+        return [model.detect_one(passage, min_letters)
+                for passage in passages]
+
+    return model.detect_batch(passages, numpy, min_letters)
+
+
+def same_language(a, b):
+    '''Whether two language tags share their primary subtag.'''
+
+    return a.replace('_', '-').split('-')[0].lower() == \
+        b.replace('_', '-').split('-')[0].lower()
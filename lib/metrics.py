@@ -0,0 +1,259 @@
+#!/usr/bin/env python3
+'''
+Access Aide - A Calibre plugin to enhance accessibility features in epub files.
+Copyright (C) 2020-2021 Luca Baffa
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+
+import json
+import os
+import threading
+import time
+from collections import Counter, defaultdict
+
+
+def current_rss():
+    '''Return the resident set size of the process right now, in bytes,
+    or None where unknown (it is read from /proc, so only on Linux).
+
+    Unlike `ru_maxrss`, the highest size ever reached by the process,
+    this goes down as memory is given back, so that samples taken during
+    a run tell its own peak in long-lived processes.
+    '''
+
+    try:
+        with open('/proc/self/statm', 'rb') as f:
+            pages = int(f.read().split()[1])
+    except (OSError, ValueError, IndexError):
+        return None
+
+    return pages * os.sysconf('SC_PAGE_SIZE')
+
+
+class Histogram():
+    '''Distribution of non-negative values in power-of-two buckets.
+
+    The bucket of a value is its bit length, i.e. bucket `n` holds the
+    values in [2**(n-1), 2**n).
+    '''
+
+    __slots__ = ('count', 'total', 'low', 'high', 'buckets')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0
+        self.low = None
+        self.high = None
+        self.buckets = Counter()
+
+    def observe(self, value):
+        value = int(value)
+        self.count += 1
+        self.total += value
+        if self.low is None or value < self.low:
+            self.low = value
+        if self.high is None or value > self.high:
+            self.high = value
+        self.buckets[value.bit_length()] += 1
+
+    def snapshot(self):
+        return {'count': self.count, 'sum': self.total, 'min': self.low,
+                'max': self.high,
+                'buckets': {str(k): v for k, v in
+                            sorted(self.buckets.items())}}
+
+    def merge(self, data):
+        self.count += data['count']
+        self.total += data['sum']
+        for value in (data['min'], data['max']):
+            if value is None:
+                continue
+            if self.low is None or value < self.low:
+                self.low = value
+            if self.high is None or value > self.high:
+                self.high = value
+        for bucket, count in data['buckets'].items():
+            self.buckets[int(bucket)] += count
+
+
+class Timer():
+    '''Context manager adding wall-clock and CPU time to a metric.'''
+
+    __slots__ = ('metrics', 'name', 'wall', 'cpu')
+
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.cpu = time.thread_time()
+        self.wall = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        wall = time.perf_counter()
+        cpu = time.thread_time()
+        self.metrics.add_time(self.name, self.wall, wall - self.wall,
+                              cpu - self.cpu)
+
+
+class Metrics():
+    '''Registry of counters, timers and histograms.
+
+    Counters changed between `start_file()` and `end_file()` are also
+    counted for that file. Timers keep the number of runs and the total
+    wall-clock and CPU (thread) time; with `trace` set, each run is also
+    kept as an event for the Chrome trace export.
+
+    A registry is meant to be updated by a single thread: threads and
+    processes keep their own, and their `snapshot()` are merged into a
+    parent registry with `merge()`.
+    '''
+
+    def __init__(self, trace=False):
+        self.trace = trace
+        self.lock = threading.Lock()
+
+        self.counters = Counter()
+        self.files = defaultdict(Counter)
+        self.timers = {}
+        self.histograms = defaultdict(Histogram)
+        self.events = []
+        self.file = None
+        self.file_base = None
+
+    def reset(self):
+        '''Clear every metric, in place.'''
+
+        self.counters.clear()
+        self.files.clear()
+        self.timers.clear()
+        self.histograms.clear()
+        del self.events[:]
+        self.file = self.file_base = None
+
+    def incr(self, name, value=1):
+        self.counters[name] += value
+
+    def start_file(self, name):
+        '''Start counting for file `name` (ending the current file).'''
+
+        self.end_file()
+        self.file = name
+        self.file_base = self.counters.copy()
+
+    def end_file(self):
+        '''Add the counters changed since `start_file()` to the file.'''
+
+        if self.file is None:
+            return
+
+        counters = self.files[self.file]
+        base = self.file_base
+        for name, value in self.counters.items():
+            delta = value - base.get(name, 0)
+            if delta:
+                counters[name] += delta
+
+        self.file = self.file_base = None
+
+    def get(self, name):
+        return self.counters[name]
+
+    def timer(self, name):
+        return Timer(self, name)
+
+    def add_time(self, name, start, wall, cpu):
+        timer = self.timers.get(name)
+        if timer is None:
+            timer = self.timers[name] = [0, 0.0, 0.0]
+        timer[0] += 1
+        timer[1] += wall
+        timer[2] += cpu
+
+        if self.trace:
+            self.events.append((name, start, wall, cpu, os.getpid(),
+                                threading.get_ident(), self.file))
+
+    def observe(self, name, value):
+        self.histograms[name].observe(value)
+
+    def snapshot(self):
+        '''Return the metrics as plain, JSON-serialisable data.'''
+
+        return {
+            'counters': dict(self.counters),
+            'files': {name: dict(counters) for name, counters in
+                      self.files.items()},
+            'timers': {name: {'count': count, 'wall': wall, 'cpu': cpu}
+                       for name, (count, wall, cpu) in self.timers.items()},
+            'histograms': {name: histogram.snapshot() for name, histogram
+                           in self.histograms.items()},
+            'events': list(self.events),
+        }
+
+    def merge(self, snapshot, prefix=None):
+        '''Add a snapshot (from another thread or process) to these
+        metrics.
+
+        File names are prefixed with `prefix`, e.g. to tell apart files
+        from different books.
+        '''
+
+        def rename(name):
+            if prefix is None or name is None:
+                return name
+            return prefix + name
+
+        with self.lock:
+            self.counters.update(snapshot['counters'])
+            for name, counters in snapshot['files'].items():
+                self.files[rename(name)].update(counters)
+
+            for name, data in snapshot['timers'].items():
+                timer = self.timers.get(name)
+                if timer is None:
+                    timer = self.timers[name] = [0, 0.0, 0.0]
+                timer[0] += data['count']
+                timer[1] += data['wall']
+                timer[2] += data['cpu']
+
+            for name, data in snapshot['histograms'].items():
+                self.histograms[name].merge(data)
+
+            self.events.extend(tuple(event[:6]) + (rename(event[6]),)
+                               for event in snapshot['events'])
+
+    def to_json(self, **kwargs):
+        snapshot = self.snapshot()
+        del snapshot['events']
+        return json.dumps(snapshot, **kwargs)
+
+    def chrome_trace(self):
+        '''Return the timer events in the Chrome trace format, as loaded
+        by chrome://tracing or Perfetto.'''
+
+        events = []
+        for name, start, wall, cpu, pid, tid, file in self.events:
+            args = {'cpu_ms': round(cpu * 1000, 3)}
+            if file is not None:
+                args['file'] = file
+            events.append({'name': name, 'ph': 'X', 'pid': pid, 'tid': tid,
+                           'ts': round(start * 1e6, 1),
+                           'dur': round(wall * 1e6, 1), 'args': args})
+
+        return {'traceEvents': events, 'displayTimeUnit': 'ms',
+                'otherData': {'counters': dict(self.counters)}}
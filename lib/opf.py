@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+'''
+Access Aide - A Calibre plugin to enhance accessibility features in epub files.
+Copyright (C) 2020-2021 Luca Baffa
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+import lxml.etree
+
+OPF_NS = 'http://www.idpf.org/2007/opf'
+
+
+class MetadataIndex():
+    '''Exact-match index over the children of the OPF <metadata> element.
+
+    The index covers both EPUB 3 (`property`, `rel` and text content) and
+    EPUB 2 (`name` and `content`) declarations, so that existence checks
+    are set lookups instead of XPath queries over the whole OPF file.
+    Elements inserted with `insert()` are added to the index.
+    '''
+
+    def __init__(self, metadata):
+        self.metadata = metadata
+        self.properties = set()
+        self.names = set()
+        self.rels = set()
+        self.values = set()
+
+        for node in metadata.iterchildren(lxml.etree.Element):
+            self.add(node)
+
+    def add(self, node):
+        '''Add a <meta> or <link> element to the index.'''
+
+        prop = node.get('property')
+        if prop:
+            self.properties.add(prop)
+            self.values.add((prop, (node.text or '').strip()))
+
+        name = node.get('name')
+        if name:
+            self.names.add(name)
+            self.values.add((name, (node.get('content') or '').strip()))
+
+        for rel in (node.get('rel') or '').split():
+            self.rels.add(rel)
+            self.values.add((rel, (node.get('href') or '').strip()))
+
+    def has(self, key, value=None):
+        '''Whether `key` is declared as a property, name or rel.
+
+        If `value` is given, a declaration with that exact value (text
+        content, `content` or `href`) is required.
+        '''
+
+        if value is not None:
+            return (key, value.strip()) in self.values
+
+        return key in self.properties or key in self.names \
+            or key in self.rels
+
+    def insert(self, container, element):
+        '''Insert `element` into <metadata> and index it.'''
+
+        container.insert_into_xml(self.metadata, element)
+        self.add(element)
+
+
+def make_meta(version, key, value, link=False):
+    '''Build a metadata element for the given EPUB major version.
+
+    EPUB 3 gets `<meta property="key">value</meta>`, or
+    `<link rel="key" href="value"/>` if `link` is set; EPUB 2 gets
+    `<meta name="key" content="value"/>`.
+    '''
+
+    if version == 3 and link:
+        return lxml.etree.Element('{%s}link' % OPF_NS,
+                                  rel=key, href=value)
+
+    element = lxml.etree.Element('{%s}meta' % OPF_NS)
+    if version == 3:
+        element.set('property', key)
+        element.text = value
+    else:
+        element.set('name', key)
+        element.set('content', value)
+
+    return element
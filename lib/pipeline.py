@@ -0,0 +1,284 @@
+#!/usr/bin/env python3
+'''
+Access Aide - A Calibre plugin to enhance accessibility features in epub files.
+Copyright (C) 2020-2021 Luca Baffa
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+
+import io
+import os
+import queue
+import threading
+import time
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    from .batch import init_worker, process_members
+    from .container import (CONTAINER_XML, OEB_DOCS, OPF_MIME,
+                            EpubContainer, find_opf, write_zip)
+    from .metrics import Metrics
+    from .profiles import compile_plan
+    from .report import build_report, error_entry
+except ImportError:
+    from batch import init_worker, process_members
+    from container import (CONTAINER_XML, OEB_DOCS, OPF_MIME,
+                           EpubContainer, find_opf, write_zip)
+    from metrics import Metrics
+    from profiles import compile_plan
+    from report import build_report, error_entry
+
+# members a transform may read, besides documents and images
+XML_MEMBERS = {OPF_MIME, 'application/x-dtbncx+xml', 'application/smil+xml'}
+
+STAGES = ('read', 'inflate', 'transform', 'deflate', 'write')
+
+# marks the end of the input of a stage
+STOP = object()
+
+
+class Book():
+    '''A book on its way through the pipeline.'''
+
+    __slots__ = ('src', 'dst', 'start', 'raw', 'names', 'members', 'changed',
+                 'output', 'result')
+
+    def __init__(self, src, dst):
+        self.src = src
+        self.dst = dst
+        self.start = time.perf_counter()
+        self.raw = self.names = self.members = self.changed = None
+        self.output = self.result = None
+
+    def fail(self, error):
+        self.raw = self.members = self.changed = self.output = None
+        self.result = {'input': self.src, 'output': self.dst, 'ok': False,
+                       'error': '{}: {}'.format(type(error).__name__, error),
+                       'stats': {},
+                       'report': build_report(Metrics().snapshot(),
+                                              book=self.src,
+                                              errors=[error_entry(error)])}
+
+
+class Stage():
+    '''A step of the pipeline, run by `workers` threads taking books from
+    the queue of the previous step.
+
+    `busy` adds up the time spent in `fn`, `starved` the time waiting
+    for books and `blocked` the time waiting for room in the next queue.
+    '''
+
+    def __init__(self, name, fn, workers):
+        self.name = name
+        self.fn = fn
+        self.workers = workers
+        self.lock = threading.Lock()
+        self.items = 0
+        self.busy = self.starved = self.blocked = 0.0
+        self.depth = 0
+        self.left = workers
+
+    def run(self, inbox, outbox, outbox_workers):
+        while True:
+            start = time.perf_counter()
+            book = inbox.get()
+            got = time.perf_counter()
+
+            if book is STOP:
+                with self.lock:
+                    self.left -= 1
+                    last = not self.left
+                # the last thread out tells the next stage to stop
+                if last:
+                    for _ in range(outbox_workers):
+                        outbox.put(STOP)
+                return
+
+            if book.result is None or book.result['ok']:
+                try:
+                    self.fn(book)
+                except Exception as e:
+                    book.fail(e)
+            done = time.perf_counter()
+
+            outbox.put(book)
+            put = time.perf_counter()
+
+            with self.lock:
+                self.items += 1
+                self.starved += got - start
+                self.busy += done - got
+                self.blocked += put - done
+                self.depth = max(self.depth, outbox.qsize())
+
+    def stats(self, wall):
+        '''Return the stats of the stage, over `wall` seconds.'''
+
+        return {'workers': self.workers, 'items': self.items,
+                'busy': round(self.busy, 6),
+                'starved': round(self.starved, 6),
+                'blocked': round(self.blocked, 6),
+                'max_queue': self.depth,
+                'utilisation': round(self.busy / (self.workers * wall), 4)
+                if wall else 0.0}
+
+
+class BookPipeline():
+    '''Batch processing as a pipeline of stages connected by bounded
+    queues, so that reading, inflating, transforming, deflating and
+    writing different books overlap.
+
+    Reading, inflating, deflating and writing run on `threads` threads
+    each (file I/O and zlib release the GIL); parsing, transforming and
+    serialising run in `jobs` worker processes, as they need the CPU.
+    Serialising stays in the worker, as parsed trees cannot be sent
+    between processes. Only the members a transform may read (documents,
+    the OPF, the NCX, media overlays and, for the image inventory,
+    images) are inflated and sent to it; the others, and those left
+    unchanged, are copied to the output as they are. Each queue holds
+    up to `queue_size` books, which bounds the memory used by the books
+    in flight.
+
+    Other arguments are those of `lib.batch.run_batch()`.
+    '''
+
+    def __init__(self, prefs, jobs=None, threads=2, queue_size=4,
+                 cache_path=None, cache_size=None, stream_threshold=None,
+                 trace=False):
+        self.prefs = prefs
+        self.jobs = jobs or os.cpu_count() or 1
+        self.threads = threads
+        self.queue_size = queue_size
+        self.images = compile_plan(prefs).images
+        self.initargs = (prefs, cache_path, cache_size, stream_threshold,
+                         trace)
+        self.executor = None
+        self.stages = []
+        self.wall = 0.0
+
+    def read(self, book):
+        with open(book.src, 'rb') as f:
+            book.raw = f.read()
+
+    def inflate(self, book):
+        with zipfile.ZipFile(io.BytesIO(book.raw)) as zf:
+            book.names = zf.namelist()
+
+            # the OPF tells which members a transform may read
+            head = {}
+            if CONTAINER_XML in book.names:
+                head[CONTAINER_XML] = zf.read(CONTAINER_XML)
+            opf = find_opf(head, book.src)
+            head[opf] = zf.read(opf)
+
+            needed = {CONTAINER_XML}
+            mime_map = EpubContainer(book.src, head).mime_map
+            for name, media_type in mime_map.items():
+                if media_type in OEB_DOCS or media_type in XML_MEMBERS or \
+                   (self.images and media_type.startswith('image/')):
+                    needed.add(name)
+
+            book.members = {name: zf.read(name) for name in book.names
+                            if name in needed}
+
+    def transform(self, book):
+        book.changed, book.result = self.executor.submit(
+            process_members, book.src, book.members).result()
+        book.names.extend(name for name in book.changed
+                          if name not in book.members)
+        book.members = None
+
+    def deflate(self, book):
+        f = io.BytesIO()
+        with zipfile.ZipFile(io.BytesIO(book.raw)) as source:
+            write_zip(f, book.names, book.changed, source)
+        book.output = f.getvalue()
+        book.raw = book.changed = None
+
+    def write(self, book):
+        os.makedirs(os.path.dirname(book.dst) or '.', exist_ok=True)
+        with open(book.dst, 'wb') as f:
+            f.write(book.output)
+        book.output = None
+
+    def run(self, books, src_dir, dst_dir):
+        '''Process `books`, yielding the result of each one (in the shape
+        of `lib.batch.process_one()`) as soon as it is written.'''
+
+        workers = {'transform': self.jobs}
+        self.stages = [Stage(name, getattr(self, name),
+                             workers.get(name, self.threads))
+                       for name in STAGES]
+        queues = [queue.Queue(self.queue_size) for _ in range(
+            len(self.stages) + 1)]
+        start = time.perf_counter()
+
+        with ProcessPoolExecutor(max_workers=self.jobs,
+                                 initializer=init_worker,
+                                 initargs=self.initargs) as executor:
+            self.executor = executor
+
+            threads = []
+            for index, stage in enumerate(self.stages):
+                following = self.stages[index + 1].workers \
+                    if index + 1 < len(self.stages) else 1
+                for _ in range(stage.workers):
+                    thread = threading.Thread(
+                        target=stage.run, daemon=True,
+                        args=(queues[index], queues[index + 1], following))
+                    thread.start()
+                    threads.append(thread)
+
+            def feed():
+                for src in books:
+                    dst = os.path.join(dst_dir, os.path.relpath(src, src_dir))
+                    queues[0].put(Book(src, dst))
+                for _ in range(self.stages[0].workers):
+                    queues[0].put(STOP)
+
+            feeder = threading.Thread(target=feed, daemon=True)
+            feeder.start()
+
+            try:
+                while True:
+                    book = queues[-1].get()
+                    if book is STOP:
+                        break
+                    book.result['output'] = book.dst
+                    book.result['seconds'] = time.perf_counter() - book.start
+                    yield book.result
+            finally:
+                self.wall = time.perf_counter() - start
+                self.executor = None
+
+            feeder.join()
+            for thread in threads:
+                thread.join()
+
+    def stats(self):
+        '''Return the stats of each stage of the last run.'''
+
+        return {stage.name: stage.stats(self.wall) for stage in self.stages}
+
+
+def format_stats(stats):
+    '''Return one line per stage, for the command line.'''
+
+    return ['{:<10} {:>5} books, busy {:8.3f}s, utilisation {:5.1f}%, '
+            'waiting {:.3f}s, blocked {:.3f}s'.format(
+                name, data['items'], data['busy'],
+                100 * data['utilisation'], data['starved'], data['blocked'])
+            for name, data in stats.items()]
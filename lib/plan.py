@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+'''
+Access Aide - A Calibre plugin to enhance accessibility features in epub files.
+Copyright (C) 2020-2021 Luca Baffa
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+import lxml.etree
+
+try:
+    from .container import NAMESPACES, parse_xml
+except ImportError:
+    from container import NAMESPACES, parse_xml
+
+PLAN_VERSION = 1
+
+
+def plan_entry(name, change):
+    '''Describe a change as a JSON-serialisable dict.
+
+    Elements are located by XPath, so that the entry can be applied to
+    a freshly opened copy of the book. Inserted elements are stored
+    serialised, along with the path of their parent.
+    '''
+
+    if change.op == 'insert':
+        parent = change.new
+        return {'file': name, 'op': 'insert',
+                'path': parent.getroottree().getpath(parent),
+                'attribute': None, 'old': None,
+                'new': lxml.etree.tostring(change.node, encoding='unicode',
+                                           with_tail=False)}
+
+    return {'file': name, 'op': change.op,
+            'path': change.node.getroottree().getpath(change.node),
+            'attribute': change.attribute,
+            'old': change.old, 'new': change.new}
+
+
+def revert(changes):
+    '''Undo `changes`, most recent first.'''
+
+    for change in reversed(changes):
+        node = change.node
+
+        if change.op == 'attrib':
+            if change.old is None:
+                del node.attrib[change.attribute]
+            else:
+                node.attrib[change.attribute] = change.old
+
+        elif change.op == 'text':
+            node.text = change.old
+
+        elif change.op == 'insert':
+            parent = change.new
+            parent.remove(node)
+            # the previous sibling had its tail changed by the insert
+            if len(parent):
+                parent[-1].tail = change.old
+
+
+def find(root, path):
+    namespaces = dict(NAMESPACES)
+    namespaces.update((k, v) for k, v in root.nsmap.items() if k)
+
+    nodes = root.xpath(path, namespaces=namespaces)
+    return nodes[0] if nodes else None
+
+
+def apply_plan(container, plan):
+    '''Apply the changes of a plan to the container, without running
+    the rules again.
+
+    A change is applied only if the element is found and still holds
+    the value recorded as `old`; otherwise it is counted as a conflict.
+    Returns the (applied, conflicts) counts.
+    '''
+
+    if plan.get('version') != PLAN_VERSION:
+        raise ValueError('Unsupported plan version: {}'
+                         .format(plan.get('version')))
+
+    applied = conflicts = 0
+    dirtied = set()
+
+    for entry in plan['changes']:
+        root = container.parsed(entry['file'])
+        node = find(root, entry['path'])
+
+        if node is None:
+            conflicts += 1
+            continue
+
+        if entry['op'] == 'attrib':
+            if node.get(entry['attribute']) != entry['old']:
+                conflicts += 1
+                continue
+            node.attrib[entry['attribute']] = entry['new']
+
+        elif entry['op'] == 'text':
+            if node.text != entry['old']:
+                conflicts += 1
+                continue
+            node.text = entry['new']
+
+        elif entry['op'] == 'insert':
+            container.insert_into_xml(node, parse_xml(entry['new']))
+
+        else:
+            raise ValueError('Unknown change: {}'.format(entry['op']))
+
+        applied += 1
+        dirtied.add(entry['file'])
+
+    for name in dirtied:
+        container.dirty(name)
+
+    return applied, conflicts
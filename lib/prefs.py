@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+'''
+Access Aide - A Calibre plugin to enhance accessibility features in epub files.
+Copyright (C) 2020-2021 Luca Baffa
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+import copy
+import hashlib
+import json
+import os
+
+PLUGIN_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+DEFAULTS = {
+    "force_override": False,
+    "savepoint": False,
+    "image_report": False,
+    "audit": False,
+    "infer_access": False,
+    "memory_budget": 0,
+    "heuristic": {"title_override": False, "type_footnotes": False,
+                  "passage_lang": False},
+    "passage_threshold": 0.99,
+    "class_rules": [],
+    "access": {
+        "accessibilitySummary": ["This publication conforms to WCAG 2.0 AA."],
+        "accessMode": ["textual", "visual"],
+        "accessModeSufficient": ["textual"],
+        "accessibilityFeature": ["structuralNavigation", "alternativeText"],
+        "accessibilityHazard": ["unknown"],
+    },
+    "a11y": {
+        "enabled": False,
+        "certifiedBy": "",
+        "certifierCredential": "",
+        "certifierReport": "",
+    },
+    "dcterms": {"conformsTo": ""},
+}
+
+
+def get_asset(path):
+    '''Return the raw content of a file shipped with the plugin.
+
+    Within Calibre, `get_resources` is injected in the module namespace
+    and reads from the plugin zip file. Elsewhere, the file is read from
+    the plugin folder.
+    '''
+
+    loader = globals().get('get_resources')
+    if loader is not None:
+        return loader(path)
+
+    with open(os.path.join(PLUGIN_DIR, path), 'rb') as f:
+        return f.read()
+
+
+def config_dir():
+    '''Return the folder holding the plugin prefs.
+
+    Within Calibre this is the `plugins` folder of the Calibre config
+    directory. Elsewhere, `$ACCESS_AIDE_HOME` or `~/.config/access_aide`.
+    '''
+
+    try:
+        from calibre.utils.config import config_dir as calibre_config_dir
+    except ImportError:
+        return os.environ.get('ACCESS_AIDE_HOME',
+                              os.path.join(os.path.expanduser('~'),
+                                           '.config', 'access_aide'))
+
+    return os.path.join(calibre_config_dir, 'plugins')
+
+
+def merge_prefs(prefs, defaults=DEFAULTS):
+    '''Return a copy of `defaults` updated with the values in `prefs`.'''
+
+    merged = copy.deepcopy(defaults)
+    for key, value in prefs.items():
+        if isinstance(value, dict) and isinstance(merged.get(key), dict):
+            merged[key] = merge_prefs(value, merged[key])
+        else:
+            merged[key] = value
+
+    return merged
+
+
+def prefs_digest(prefs):
+    '''Return a stable digest of the prefs.'''
+
+    data = json.dumps(prefs, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+
+def load_prefs(path=None):
+    '''Load a prefs JSON file, in the same shape as `DEFAULTS`.'''
+
+    if path is None:
+        return merge_prefs({})
+
+    with open(path, encoding='utf-8') as f:
+        return merge_prefs(json.load(f))
@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+'''
+Access Aide - A Calibre plugin to enhance accessibility features in epub files.
+Copyright (C) 2020-2021 Luca Baffa
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+
+import copy
+import json
+import os
+from collections import namedtuple
+
+try:
+    from .prefs import config_dir, merge_prefs, prefs_digest
+    from .opf import make_meta
+    from .rules import compile_class_rule, index_class_rules, \
+        load_rule_tables
+except ImportError:
+    from prefs import config_dir, merge_prefs, prefs_digest
+    from opf import make_meta
+    from rules import compile_class_rule, index_class_rules, \
+        load_rule_tables
+
+MB = 1024 * 1024
+
+# same file name as the calibre JSONConfig('plugins/access_aide_profiles')
+PROFILES_NAME = 'access_aide_profiles.json'
+
+# (prefs section, metadata key, whether EPUB 3 uses a <link>)
+A11Y_METADATA = (
+    ('dcterms', 'dcterms:conformsTo', True),
+    ('a11y', 'a11y:certifiedBy', False),
+    ('a11y', 'a11y:certifierCredential', False),
+    ('a11y', 'a11y:certifierReport', True),
+)
+
+
+class MetaItem(namedtuple('MetaItem', ['key', 'value', 'epub2', 'epub3'])):
+    '''A metadata declaration, resolved for both EPUB major versions.'''
+
+    __slots__ = ()
+
+    def element(self, version):
+        '''Return a new copy of the element for the given version.'''
+
+        return copy.deepcopy(self.epub3 if version == 3 else self.epub2)
+
+
+class ProfileError(Exception):
+    '''Raised when a profile cannot be found or compiled.'''
+
+
+RunPlan = namedtuple('RunPlan', ['name', 'prefs', 'digest', 'rules',
+                                 'force_override', 'access', 'a11y',
+                                 'classes', 'passage_threshold', 'images',
+                                 'memory_budget'])
+RunPlan.__doc__ = '''Prefs compiled once, as read by the engine.
+
+`rules` are the document rules to run, in order; `access` the
+schema.org declarations (skipped when already declared with the same
+value, and replaced by the inferred ones with 'infer_access') and
+`a11y` the conformance ones (skipped when the key is already declared,
+unless `force_override`). `classes` indexes the class rules
+run by 'add_fn_type': the InDesign ones shipped in `class-rules.json`
+when footnotes are typed, followed by the user ones in `class_rules`.
+`passage_threshold` is the confidence needed to add a language to a
+passage, None when passages are not checked. `images` tells whether to
+build the image inventory. `memory_budget` is the memory, in bytes, the
+parsed documents may take, None for no limit.
+'''
+
+
+def meta_item(key, value, link=False):
+    return MetaItem(key, value, make_meta(2, key, value, link),
+                    make_meta(3, key, value, link))
+
+
+def compile_plan(prefs, name=None):
+    '''Compile prefs (in the shape of `DEFAULTS`) into a `RunPlan`.'''
+
+    heuristic = prefs.get('heuristic', {})
+
+    classes = []
+    if heuristic.get('type_footnotes'):
+        classes.extend(load_rule_tables().classes)
+    try:
+        classes.extend(compile_class_rule(rule)
+                       for rule in prefs.get('class_rules', ()))
+    except (ValueError, AttributeError, TypeError) as e:
+        raise ProfileError('Invalid class rule: {}'.format(e))
+
+    rules = []
+    if prefs.get('audit'):
+        rules.append('audit')
+    if heuristic.get('title_override'):
+        rules.append('override_title')
+    if classes:
+        rules.append('add_fn_type')
+    rules.extend(['add_lang', 'add_aria'])
+    if prefs.get('infer_access'):
+        rules.append('infer_access')
+
+    access = tuple(meta_item('schema:' + key, text)
+                   for key, values in prefs.get('access', {}).items()
+                   for text in values)
+
+    a11y = []
+    for section, key, link in A11Y_METADATA:
+        value = prefs.get(section, {}).get(key.split(':')[1])
+        if value:
+            a11y.append(meta_item(key, value, link))
+
+    return RunPlan(name=name, prefs=prefs, digest=prefs_digest(prefs),
+                   rules=tuple(rules),
+                   force_override=bool(prefs.get('force_override')),
+                   access=access, a11y=tuple(a11y),
+                   classes=index_class_rules(classes),
+                   passage_threshold=float(prefs.get('passage_threshold',
+                                                     0.99))
+                   if heuristic.get('passage_lang') else None,
+                   images=bool(prefs.get('image_report')),
+                   memory_budget=int(float(prefs['memory_budget']) * MB)
+                   if prefs.get('memory_budget') else None)
+
+
+# compiled plans, by profile name
+_plans = {}
+
+
+def get_plan(name, prefs):
+    '''Return the compiled plan of profile `name`, compiling it only if
+    its prefs changed since the last call.'''
+
+    digest = prefs_digest(prefs)
+    plan = _plans.get(name)
+    if plan is None or plan.digest != digest:
+        plan = _plans[name] = compile_plan(prefs, name=name)
+
+    return plan
+
+
+def profiles_path():
+    return os.path.join(config_dir(), PROFILES_NAME)
+
+
+def load_profiles(path=None):
+    '''Return the saved profiles, as {name: prefs}.
+
+    Profiles are stored as prefs overrides and merged over `DEFAULTS`.
+    '''
+
+    try:
+        with open(path or profiles_path(), encoding='utf-8') as f:
+            profiles = json.load(f)
+    except FileNotFoundError:
+        return {}
+
+    return {name: merge_prefs(prefs) for name, prefs in profiles.items()}
+
+
+def get_profile(name, path=None):
+    '''Return the prefs of profile `name`.'''
+
+    profiles = load_profiles(path)
+    if name not in profiles:
+        raise ProfileError('Profile {} not found, available: {}'.format(
+            name, ', '.join(sorted(profiles)) or 'none'))
+
+    return profiles[name]
@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+'''
+Access Aide - A Calibre plugin to enhance accessibility features in epub files.
+Copyright (C) 2020-2021 Luca Baffa
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+
+import json
+
+try:
+    from .features import feature
+except ImportError:
+    from features import feature
+
+REPORT_VERSION = 1
+
+# report field, stat counter
+CHANGES = (
+    ('lang', 'lang_stat'),
+    ('role', 'aria_stat'),
+    ('title', 'title_stat'),
+    ('noteref', 'fn_stat'),
+    ('passage_lang', 'passage_stat'),
+)
+
+# report field, engine counter
+DOCUMENTS = (
+    ('changed', 'files_changed'),
+    ('skipped', 'files_skipped'),
+    ('streamed', 'streamed'),
+    ('cache_hits', 'cache_hits'),
+    ('cache_misses', 'cache_misses'),
+)
+
+
+def error_entry(error):
+    '''Describe an exception for the `errors` list of a report.
+
+    `AccessAideError` carries a stable `code` (e.g. 'missing-language');
+    other exceptions are identified by their class name.
+    '''
+
+    return {'code': getattr(error, 'code', None) or type(error).__name__,
+            'message': str(error)}
+
+
+def images_entry(counters, items):
+    '''Describe the image inventory: alt text statuses, coverage and
+    one entry per <img>.'''
+
+    images = feature('images')
+    alt = {status: counters.get('alt_' + status, 0)
+           for status in images.ALT_STATUS}
+
+    return {'total': counters.get('images', 0),
+            'alt': alt,
+            'coverage': images.coverage(alt),
+            'items': [image._asdict() for image in items]}
+
+
+def audit_entry(counters, findings):
+    '''Describe the audit: findings per check, documents whose findings
+    came from the cache or that were not audited (streamed), and the
+    findings themselves.'''
+
+    return {'counts': feature('audit').count_findings(findings),
+            'cached': counters.get('audit_cached', 0),
+            'skipped': counters.get('audit_skipped', 0),
+            'findings': [finding._asdict() for finding in findings]}
+
+
+def inferred_entry(counters, inferred):
+    '''Describe the inferred metadata, along with the evidence counted
+    in the documents and the manifest.'''
+
+    return {'evidence': feature('infer').evidence(counters),
+            'metadata': inferred}
+
+
+def memory_entry(snapshot):
+    '''Describe the memory used by the run: the peak of the resident
+    memory sampled during the run and its increase over the start, in
+    bytes (None if unknown), and the parsed trees evicted to stay within
+    the memory budget.'''
+
+    histograms = snapshot['histograms']
+    peak = histograms.get('rss', {}).get('max')
+    start = histograms.get('rss_start', {}).get('max')
+
+    return {'peak_rss': peak,
+            'rss_increase': max(peak - start, 0)
+            if peak is not None and start is not None else None,
+            'trees_evicted': snapshot['counters'].get('trees_evicted', 0)}
+
+
+def build_report(snapshot, book=None, errors=(), images=None,
+                 findings=None, inferred=None):
+    '''Build the report of a book from a `Metrics` snapshot.
+
+    The report is plain data, ready to be dumped as JSON: change counts
+    for the whole book and per file, metadata inserted and skipped
+    (already declared), documents changed or left untouched, wall-clock
+    seconds per stage, the memory used (see `memory_entry()`) and the
+    errors met. With the `Image` entries of the book, it also holds the
+    image inventory, with its `Finding` entries, the audit, and with the
+    inferred metadata, the evidence it was inferred from.
+    '''
+
+    counters = snapshot['counters']
+
+    files = {}
+    for name, file_counters in sorted(snapshot['files'].items()):
+        files[name] = {field: file_counters.get(key, 0)
+                       for field, key in CHANGES}
+
+    report = {
+        'version': REPORT_VERSION,
+        'book': book,
+        'ok': not errors,
+        'errors': list(errors),
+        'changes': {field: counters.get(key, 0) for field, key in CHANGES},
+        'files': files,
+        'metadata': {'inserted': counters.get('meta_stat', 0),
+                     'skipped': counters.get('meta_skipped', 0)},
+        'documents': {field: counters.get(key, 0)
+                      for field, key in DOCUMENTS},
+        'durations': {name: round(timer['wall'], 6)
+                      for name, timer in sorted(snapshot['timers'].items())},
+        'memory': memory_entry(snapshot),
+    }
+
+    if images is not None:
+        report['images'] = images_entry(counters, images)
+    if findings is not None:
+        report['audit'] = audit_entry(counters, findings)
+    if inferred is not None:
+        report['inferred'] = inferred_entry(counters, inferred)
+
+    return report
+
+
+def write_report(path, report):
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2)
+        f.write('\n')
+
+
+def append_report(path, report):
+    '''Append a report to a JSON Lines file, one report per line.'''
+
+    with open(path, 'a', encoding='utf-8') as f:
+        f.write(json.dumps(report, sort_keys=True) + '\n')
@@ -0,0 +1,242 @@
+#!/usr/bin/env python3
+'''
+Access Aide - A Calibre plugin to enhance accessibility features in epub files.
+Copyright (C) 2020-2021 Luca Baffa
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+import hashlib
+import json
+import os
+import pickle
+from collections import namedtuple
+from types import MappingProxyType
+
+try:
+    from .prefs import get_asset, config_dir
+except ImportError:
+    from prefs import get_asset, config_dir
+
+# bump when the compiled form changes
+RULES_VERSION = 2
+
+ASSETS = ('assets/epubtype-aria-map.json', 'assets/extra-tags.json',
+          'assets/acc_feature_values.json', 'assets/class-rules.json')
+
+CACHE_NAME = 'access_aide_rules.pickle'
+
+# `needs_alt`: only applies to elements with alt text (<img>)
+# `needs_no_href`: only applies to elements without an href (<a> as extra tag)
+AriaRule = namedtuple('AriaRule', ['role', 'needs_alt', 'needs_no_href'])
+
+# `digest`: digest of the asset files the tables were compiled from
+RuleTables = namedtuple('RuleTables', ['version', 'digest', 'aria', 'types',
+                                       'features', 'classes'])
+
+# `token`: class token the element must carry, None for any
+# `tags`: element names the rule applies to, None for any
+# `attribs`: (name, expected) predicates, `expected` being True (present),
+#            False (absent) or the exact value
+# `sets`: (name, value) attributes written on matching elements
+ClassRule = namedtuple('ClassRule', ['token', 'tags', 'attribs', 'sets'])
+
+# {class token: rules} and {tag: rules} for rules without a class token
+ClassIndex = namedtuple('ClassIndex', ['by_class', 'by_tag'])
+
+# prefixes accepted in the attribute names of class rules
+PREFIXES = {
+    'epub': 'http://www.idpf.org/2007/ops',
+    'xml': 'http://www.w3.org/XML/1998/namespace',
+}
+
+_tables = None
+
+
+def compile_aria(epubtype_aria_map, extra_tags):
+    '''Compile the epub:type map into a {(epub:type, tag): rule} dict.
+
+    A (value, tag) pair is present if the tag is listed for the value in
+    `epubtype-aria-map.json` or if it is an extra tag. The `a` and `img`
+    exceptions documented in `./assets/README.md` are resolved here as
+    flags, so that they need not be checked against the map again.
+    '''
+
+    aria = {}
+    for value, map in epubtype_aria_map.items():
+        for tag in set(map['tag']) | set(extra_tags):
+            aria[(value, tag)] = (map['aria'],
+                                  tag == 'img',
+                                  tag == 'a' and tag not in map['tag'])
+
+    return aria
+
+
+def attribute_name(name):
+    '''Resolve a prefixed attribute name (`epub:type`) to its lxml form.'''
+
+    prefix, sep, local = name.rpartition(':')
+    if not sep:
+        return name
+    if prefix not in PREFIXES:
+        raise ValueError('Unknown attribute prefix: {}'.format(name))
+
+    return '{{{}}}{}'.format(PREFIXES[prefix], local)
+
+
+def compile_class_rule(rule):
+    '''Compile a class rule, as found in `class-rules.json`.
+
+    A rule matches elements by class token (`class`), element name
+    (`tag`, a name or a list) and attribute predicates (`attrib`), and
+    sets the attributes in `set`, e.g.:
+
+        {"class": "_idFootnoteLink", "tag": "a", "attrib": {"href": true},
+         "set": {"epub:type": "noteref"}}
+    '''
+
+    token = rule.get('class')
+    tags = rule.get('tag')
+    if isinstance(tags, str):
+        tags = [tags]
+
+    if not token and not tags:
+        raise ValueError('Class rule without class or tag: {}'.format(rule))
+    if token and len(token.split()) != 1:
+        raise ValueError('Class rule with more than one token: {}'
+                         .format(token))
+    if not rule.get('set'):
+        raise ValueError('Class rule without attributes to set: {}'
+                         .format(rule))
+
+    attribs = []
+    for name, expected in rule.get('attrib', {}).items():
+        if not isinstance(expected, (bool, str)):
+            raise ValueError('Invalid predicate for {}: {!r}'
+                             .format(name, expected))
+        attribs.append((attribute_name(name), expected))
+
+    return ClassRule(token or None,
+                     frozenset(tags) if tags else None,
+                     tuple(attribs),
+                     tuple((attribute_name(name), value)
+                           for name, value in rule['set'].items()))
+
+
+def index_class_rules(rules):
+    '''Index compiled class rules by class token, or by tag if they have
+    none, keeping their order within each key.'''
+
+    by_class = {}
+    by_tag = {}
+    for rule in rules:
+        if rule.token is not None:
+            by_class.setdefault(rule.token, []).append(rule)
+        else:
+            for tag in rule.tags:
+                by_tag.setdefault(tag, []).append(rule)
+
+    return ClassIndex(
+        MappingProxyType({k: tuple(v) for k, v in by_class.items()}),
+        MappingProxyType({k: tuple(v) for k, v in by_tag.items()}))
+
+
+def build(raw):
+    '''Compile the raw content of `ASSETS` into plain Python objects.'''
+
+    epubtype_aria_map, extra_tags, features, classes = (json.loads(data)
+                                                        for data in raw)
+
+    return {'aria': compile_aria(epubtype_aria_map, extra_tags),
+            'features': list(features),
+            'classes': [tuple(compile_class_rule(rule)) for rule in classes]}
+
+
+def freeze(compiled, digest):
+    '''Turn compiled tables into an immutable `RuleTables`, compiled from
+    assets of the given digest.'''
+
+    aria = {key: AriaRule(*value) for key, value in compiled['aria'].items()}
+
+    return RuleTables(version=RULES_VERSION, digest=digest,
+                      aria=MappingProxyType(aria),
+                      types=frozenset(value for value, tag in aria),
+                      features=tuple(compiled['features']),
+                      classes=tuple(ClassRule(*rule)
+                                    for rule in compiled['classes']))
+
+
+def cache_path():
+    return os.path.join(config_dir(), CACHE_NAME)
+
+
+def read_cache(path, digest):
+    '''Return the compiled tables stored at `path`, None if stale.'''
+
+    try:
+        with open(path, 'rb') as f:
+            cached = pickle.load(f)
+    except Exception:
+        return None
+
+    if cached.get('version') != RULES_VERSION \
+       or cached.get('digest') != digest:
+        return None
+
+    return cached['tables']
+
+
+def write_cache(path, digest, compiled):
+    '''Store compiled tables at `path`; failures are not fatal.'''
+
+    # only needed on a cache miss, kept out of the import time
+    import tempfile
+
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump({'version': RULES_VERSION, 'digest': digest,
+                         'tables': compiled}, f,
+                        protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, path)
+    except OSError:
+        pass
+
+
+def load_rule_tables(path=None):
+    '''Return the rule tables, compiled once per process.
+
+    The compiled form is cached on disk next to the plugin prefs, keyed
+    by the digest of the asset files, so that later starts skip JSON
+    parsing and compilation.
+    '''
+
+    global _tables
+    if _tables is not None:
+        return _tables
+
+    if path is None:
+        path = cache_path()
+
+    raw = [get_asset(asset) for asset in ASSETS]
+    digest = hashlib.sha1(b'\0'.join(raw)).hexdigest()
+
+    compiled = read_cache(path, digest)
+    if compiled is None:
+        compiled = build(raw)
+        write_cache(path, digest, compiled)
+
+    _tables = freeze(compiled, digest)
+    return _tables
@@ -0,0 +1,436 @@
+#!/usr/bin/env python3
+'''
+Access Aide - A Calibre plugin to enhance accessibility features in epub files.
+Copyright (C) 2020-2021 Luca Baffa
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+
+import asyncio
+import io
+import ipaddress
+import json
+import os
+import signal
+import time
+import zipfile
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from urllib.parse import parse_qs, urlsplit
+
+try:
+    from .batch import process_book
+    from .cache import ResultCache
+    from .engine import AccessAideError
+    from .metrics import Metrics
+    from .prefs import load_prefs
+    from .profiles import ProfileError, get_plan, get_profile
+    from .report import build_report, error_entry
+    from .rules import load_rule_tables
+except ImportError:
+    from batch import process_book
+    from cache import ResultCache
+    from engine import AccessAideError
+    from metrics import Metrics
+    from prefs import load_prefs
+    from profiles import ProfileError, get_plan, get_profile
+    from report import build_report, error_entry
+    from rules import load_rule_tables
+
+EPUB_MIME = 'application/epub+zip'
+JSON_MIME = 'application/json'
+
+REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found',
+           405: 'Method Not Allowed', 413: 'Payload Too Large',
+           422: 'Unprocessable Entity', 500: 'Internal Server Error',
+           503: 'Service Unavailable'}
+
+# latencies kept for the percentiles of `/metrics`
+LATENCY_SAMPLES = 1024
+
+# per-process cache, set once by `init_service_worker`
+_worker_cache = None
+
+
+class HTTPError(Exception):
+    '''Raised to answer a request with an error status.'''
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+def is_loopback(host):
+    '''Tell whether `host` only accepts connections from this machine.'''
+
+    if host == 'localhost':
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+
+def init_service_worker(cache_path=None, cache_size=None):
+    '''Import the engine, load the rule tables (and open the cache) once
+    per worker process.'''
+
+    global _worker_cache
+    load_rule_tables()
+
+    # Ctrl-C reaches the whole process group: the service stops them
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    if cache_path is not None:
+        _worker_cache = ResultCache(cache_path, cache_size)
+
+
+def warm():
+    return True
+
+
+def run_job(src, dst, profile=None, data=None):
+    '''Process a book in a worker process.
+
+    The book is read from `src` and written to `dst`, or with `data`,
+    read from those bytes and returned. Plans stay compiled across jobs,
+    as long as the prefs of their profile do not change. Returns
+    (report, metrics snapshot, output bytes or None).
+    '''
+
+    prefs = load_prefs() if profile is None else get_profile(profile)
+    metrics = Metrics()
+
+    if data is not None:
+        src, dst = io.BytesIO(data), io.BytesIO()
+
+    book = src if data is None else None
+
+    try:
+        engine = process_book(src, dst, prefs, cache=_worker_cache,
+                              metrics=metrics,
+                              run_plan=get_plan(profile, prefs))
+    except (AccessAideError, ValueError, OSError, zipfile.BadZipFile) as e:
+        report = build_report(metrics.snapshot(), book=book,
+                              errors=[error_entry(e)])
+        return report, metrics.snapshot(), None
+
+    output = dst.getvalue() if data is not None else None
+    return engine.report(book=book), metrics.snapshot(), output
+
+
+def percentiles(samples):
+    ordered = sorted(samples)
+    if not ordered:
+        return {'count': 0, 'p50': None, 'p95': None, 'max': None}
+
+    def at(fraction):
+        return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+    return {'count': len(ordered), 'p50': at(0.5), 'p95': at(0.95),
+            'max': ordered[-1]}
+
+
+class Job():
+    '''A book waiting in the queue, and the future of its result.'''
+
+    __slots__ = ('args', 'future', 'queued')
+
+    def __init__(self, args, future):
+        self.args = args
+        self.future = future
+        self.queued = time.perf_counter()
+
+
+class JobServer():
+    '''Long-lived service running books through warm worker processes.
+
+    Requests are plain HTTP/1.1, over a Unix socket or a localhost TCP
+    port:
+     -  `POST /jobs` with a JSON body `{"input": PATH, "output": PATH,
+        "profile": NAME}` processes a book on disk and answers with its
+        report (see `lib.report`);
+     -  `POST /jobs?profile=NAME` with an EPUB body (`application/epub+zip`)
+        answers with the processed EPUB;
+     -  `GET /metrics` answers with the queue depth, job counters,
+        latency percentiles (queue wait, run and total, in milliseconds)
+        and the stage timings of the books processed;
+     -  `GET /health` answers `{"ok": true}`.
+
+    Jobs wait in a queue of `queue_size` entries, taken by `workers`
+    tasks, each running one book at a time in the process pool. When the
+    queue is full, requests are answered at once with 503 and a
+    `Retry-After` header, so that clients back off instead of piling up.
+    Workers share the result cache at `cache_path`, if given.
+    '''
+
+    def __init__(self, workers=2, queue_size=16, max_upload=256,
+                 cache_path=None, cache_size=None):
+        self.workers = workers
+        self.queue_size = queue_size
+        self.max_upload = max_upload * 1024 * 1024
+        self.cache_args = (cache_path, cache_size)
+
+        self.metrics = Metrics()
+        self.counters = self.metrics.counters
+        self.latency = {name: deque(maxlen=LATENCY_SAMPLES)
+                        for name in ('queue', 'run', 'total')}
+
+        self.queue = None
+        self.executor = None
+        self.tasks = []
+        self.servers = []
+        self.paths = []
+        self.running = 0
+
+    async def start(self):
+        '''Start the worker processes, loading the rule tables in each,
+        and the tasks feeding them.'''
+
+        loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue(self.queue_size)
+        self.executor = ProcessPoolExecutor(
+            max_workers=self.workers, initializer=init_service_worker,
+            initargs=self.cache_args)
+
+        # spawn every process now rather than on the first requests
+        await asyncio.gather(*[loop.run_in_executor(self.executor, warm)
+                               for _ in range(self.workers)])
+
+        self.tasks = [loop.create_task(self.worker())
+                      for _ in range(self.workers)]
+
+    async def listen(self, path=None, host='127.0.0.1', port=0):
+        '''Accept requests on the Unix socket `path`, or on `host` and
+        `port`. Returns the asyncio server.
+
+        `host` must be a loopback address: jobs name files on this machine
+        and requests are not authenticated, so other hosts could read and
+        overwrite them.
+        '''
+
+        if path is None and not is_loopback(host):
+            raise ValueError('{} is not a loopback address'.format(host))
+
+        if self.queue is None:
+            self.queue = asyncio.Queue(self.queue_size)
+
+        if path is not None:
+            server = await asyncio.start_unix_server(self.handle, path)
+            self.paths.append(path)
+        else:
+            server = await asyncio.start_server(self.handle, host, port)
+        self.servers.append(server)
+
+        return server
+
+    async def close(self):
+        for server in self.servers:
+            server.close()
+            await server.wait_closed()
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        if self.executor is not None:
+            self.executor.shutdown()
+        for path in self.paths:
+            if os.path.exists(path):
+                os.unlink(path)
+
+    def submit(self, *args):
+        '''Queue a job, raising `HTTPError` (503) if the queue is full.'''
+
+        future = asyncio.get_running_loop().create_future()
+        try:
+            self.queue.put_nowait(Job(args, future))
+        except asyncio.QueueFull:
+            self.counters['jobs_rejected'] += 1
+            raise HTTPError(503, 'Queue full, retry later')
+
+        self.counters['jobs_accepted'] += 1
+        return future
+
+    async def worker(self):
+        loop = asyncio.get_running_loop()
+
+        while True:
+            job = await self.queue.get()
+            started = time.perf_counter()
+            self.running += 1
+
+            try:
+                result = await loop.run_in_executor(self.executor, run_job,
+                                                    *job.args)
+            except Exception as e:
+                self.counters['jobs_failed'] += 1
+                if not job.future.done():
+                    job.future.set_exception(e)
+            else:
+                report, snapshot, output = result
+                self.record(snapshot, report)
+                if not job.future.done():
+                    job.future.set_result((report, output))
+            finally:
+                self.running -= 1
+                self.queue.task_done()
+
+            done = time.perf_counter()
+            self.observe('queue', started - job.queued)
+            self.observe('run', done - started)
+            self.observe('total', done - job.queued)
+
+    def observe(self, name, seconds):
+        ms = seconds * 1000
+        self.latency[name].append(round(ms, 3))
+        self.metrics.observe(name + '_ms', ms)
+
+    def record(self, snapshot, report):
+        '''Add the metrics of a book to those of the service, leaving out
+        its per-file counters.'''
+
+        snapshot['files'] = {}
+        snapshot['events'] = []
+        self.metrics.merge(snapshot)
+        self.counters['jobs_done' if report['ok'] else 'jobs_failed'] += 1
+
+    def stats(self):
+        '''Return the data answered by `GET /metrics`.'''
+
+        snapshot = self.metrics.snapshot()
+        del snapshot['files'], snapshot['events']
+
+        return {'queue': {'depth': self.queue.qsize() if self.queue else 0,
+                          'size': self.queue_size,
+                          'running': self.running,
+                          'workers': self.workers},
+                'latency_ms': {name: percentiles(samples)
+                               for name, samples in self.latency.items()},
+                'metrics': snapshot}
+
+    async def handle(self, reader, writer):
+        try:
+            try:
+                status, headers, body = await self.dispatch(reader)
+            except HTTPError as e:
+                status, headers, body = self.json(e.status,
+                                                  {'error': str(e)})
+                if e.status == 503:
+                    headers['Retry-After'] = '1'
+            except ProfileError as e:
+                status, headers, body = self.json(404, {'error': str(e)})
+            except Exception as e:
+                status, headers, body = self.json(
+                    500, {'error': '{}: {}'.format(type(e).__name__, e)})
+
+            head = ['HTTP/1.1 {} {}'.format(status, REASONS[status])]
+            headers['Content-Length'] = str(len(body))
+            headers['Connection'] = 'close'
+            head.extend('{}: {}'.format(k, v) for k, v in headers.items())
+            writer.write(('\r\n'.join(head) + '\r\n\r\n').encode('latin-1'))
+            writer.write(body)
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    @staticmethod
+    def json(status, data):
+        body = json.dumps(data).encode('utf-8')
+        return status, {'Content-Type': JSON_MIME}, body
+
+    async def read_request(self, reader):
+        line = await reader.readline()
+        try:
+            method, target, _ = line.decode('latin-1').split(' ', 2)
+        except ValueError:
+            raise HTTPError(400, 'Malformed request line')
+
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            key, _, value = line.decode('latin-1').partition(':')
+            headers[key.strip().lower()] = value.strip()
+
+        try:
+            length = int(headers.get('content-length', 0))
+        except ValueError:
+            raise HTTPError(400, 'Invalid Content-Length')
+        if length > self.max_upload:
+            raise HTTPError(413, 'Upload larger than {} MB'.format(
+                self.max_upload // (1024 * 1024)))
+
+        body = await reader.readexactly(length) if length else b''
+        return method, target, headers, body
+
+    async def dispatch(self, reader):
+        method, target, headers, body = await self.read_request(reader)
+        url = urlsplit(target)
+
+        if url.path == '/health':
+            return self.json(200, {'ok': True})
+        if url.path == '/metrics':
+            return self.json(200, self.stats())
+        if url.path != '/jobs':
+            raise HTTPError(404, 'No such endpoint: {}'.format(url.path))
+        if method != 'POST':
+            raise HTTPError(405, 'Jobs are submitted with POST')
+
+        content_type = headers.get('content-type', '').split(';')[0]
+        if content_type == EPUB_MIME:
+            profile = parse_qs(url.query).get('profile', [None])[0]
+            report, output = await self.submit(None, None, profile, body)
+            if output is None:
+                return self.json(422, report)
+            return 200, {'Content-Type': EPUB_MIME}, output
+
+        try:
+            job = json.loads(body.decode('utf-8'))
+            args = (job['input'], job['output'], job.get('profile'))
+        except (ValueError, KeyError, TypeError) as e:
+            raise HTTPError(400, 'Invalid job: {}'.format(e))
+
+        report, _ = await self.submit(*args)
+        return self.json(200 if report['ok'] else 422, report)
+
+
+async def serve(path=None, host='127.0.0.1', port=8080, workers=2,
+                queue_size=16, max_upload=256, cache_path=None,
+                cache_size=None, ready=None):
+    '''Run a `JobServer` until interrupted (SIGINT or SIGTERM).
+
+    `ready`, if given, is called with the server once it listens.
+    '''
+
+    server = JobServer(workers=workers, queue_size=queue_size,
+                       max_upload=max_upload, cache_path=cache_path,
+                       cache_size=cache_size)
+    await server.start()
+    listener = await server.listen(path=path, host=host, port=port)
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, stop.set)
+
+    if ready is not None:
+        ready(listener)
+
+    try:
+        await stop.wait()
+    finally:
+        await server.close()
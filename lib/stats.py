@@ -17,20 +17,37 @@ You should have received a copy of the GNU General Public License
 along with this program.  If not, see <http://www.gnu.org/licenses/>.
 '''
 
+try:
+    from .metrics import Metrics
+except ImportError:
+    from metrics import Metrics
+
+
 class Stats:
     '''
     Simple class to manage stats.
 
     Once the object is created, stat value can be increased, returned
-    and reset to zero.
+    and reset to zero. The value is a counter of a `Metrics` registry,
+    named after `name` (or `desc`); a private registry is used if none is
+    given.
     '''
 
-    def __init__(self, desc='Items'):
+    def __init__(self, desc='Items', metrics=None, name=None):
         self.desc = desc
-        self.value = 0
+        self.name = name or desc
+        self.metrics = Metrics() if metrics is None else metrics
+
+    @property
+    def value(self):
+        return self.metrics.counters[self.name]
+
+    @value.setter
+    def value(self, value):
+        self.metrics.counters[self.name] = value
 
     def increase(self):
-        self.value += 1
+        self.metrics.counters[self.name] += 1
 
     def get(self):
         return self.value
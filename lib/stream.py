@@ -0,0 +1,339 @@
+#!/usr/bin/env python3
+'''
+Access Aide - A Calibre plugin to enhance accessibility features in epub files.
+Copyright (C) 2020-2021 Luca Baffa
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+import lxml.etree
+
+XML_NS = 'http://www.w3.org/XML/1998/namespace'
+
+# output is written to the sink in chunks of about this many characters
+CHUNK_SIZE = 64 * 1024
+
+# how much output may be held back while waiting for the first <h1>
+LOOKAHEAD = 1024 * 1024
+
+
+class StreamError(Exception):
+    '''Raised when a document cannot be streamed faithfully.
+
+    Callers should fall back to building the full tree.
+    '''
+
+
+def escape_text(text):
+    if '&' in text or '<' in text or '>' in text or '\r' in text:
+        text = text.replace('&', '&amp;').replace('<', '&lt;') \
+                   .replace('>', '&gt;').replace('\r', '&#13;')
+    return text
+
+
+def escape_attrib(value):
+    value = escape_text(value)
+    if '"' in value or '\n' in value or '\t' in value:
+        value = value.replace('"', '&quot;').replace('\n', '&#10;') \
+                     .replace('\t', '&#9;')
+    return value
+
+
+class Output():
+    '''Chunked UTF-8 writer with a lookahead buffer.
+
+    While `buffering` is set, nothing is flushed, so that already written
+    pieces can still be replaced (see `replace()`).
+    '''
+
+    def __init__(self, sink):
+        self.sink = sink
+        self.pieces = []
+        self.size = 0
+        self.buffering = False
+
+    def write(self, text):
+        self.pieces.append(text)
+        self.size += len(text)
+
+        if not self.buffering and self.size > CHUNK_SIZE:
+            self.flush()
+
+    def mark(self):
+        return len(self.pieces)
+
+    def replace(self, start, end, text):
+        self.pieces[start:end] = [text]
+
+    def flush(self):
+        if self.pieces:
+            self.sink.write(''.join(self.pieces).encode('utf-8'))
+        self.pieces = []
+        self.size = 0
+
+
+class DocumentStreamer():
+    '''Apply document rules to an XHTML file without building its tree.
+
+    The file is read with `lxml.etree.iterparse()`: each element is passed
+    to the rules of `engine` as soon as its start tag is parsed, written
+    out, and cleared once its end tag is reached, so memory use does not
+    grow with the size of the document.
+
+    'override_title' needs the first <h1>, which comes after <title>: the
+    output is held back from <title> until the <h1> is complete, or until
+    `lookahead` characters have been buffered, in which case the title is
+    left untouched.
+    '''
+
+    def __init__(self, engine, rules, lookahead=LOOKAHEAD):
+        self.engine = engine
+        self.rules = rules
+        self.lookahead = lookahead
+
+    def run(self, source, sink, lang):
+        '''Stream `source` (a file-like object) into `sink`.
+
+        Returns the number of changes made.
+        '''
+
+        engine = self.engine
+        by_tag, by_attrib, titles = engine.compile_rules(self.rules)
+        engine.lang = lang
+        engine.changes = []
+        engine.title = engine.h1 = None
+
+        out = Output(sink)
+        out.write("<?xml version='1.0' encoding='utf-8'?>\n")
+
+        changes = 0
+        count = 0
+        stack = []
+        prolog = []
+        root_seen = False
+
+        # the element whose text, and the node whose tail, come next
+        pending_text = None
+        pending_tail = None
+        open_tag = False
+
+        title = title_start = title_end = title_text = None
+        h1 = h1_text = None
+
+        context = lxml.etree.iterparse(source,
+                                       events=('start', 'end', 'comment',
+                                               'pi'),
+                                       resolve_entities=False,
+                                       remove_blank_text=False,
+                                       huge_tree=True)
+
+        for event, node in context:
+
+            if event in ('start', 'comment', 'pi') or \
+               node is not pending_text:
+                if pending_text is not None:
+                    if open_tag:
+                        out.write('>')
+                        open_tag = False
+                    if pending_text.text:
+                        out.write(escape_text(pending_text.text))
+                    pending_text = None
+
+                if pending_tail is not None:
+                    if pending_tail.tail:
+                        out.write(escape_text(pending_tail.tail))
+                    pending_tail = None
+
+                if open_tag:
+                    out.write('>')
+                    open_tag = False
+
+            if event == 'start':
+                count += 1
+
+                if not root_seen:
+                    root_seen = True
+                    doctype = node.getroottree().docinfo.doctype
+                    if doctype:
+                        if prolog:
+                            # lxml writes them on either side of the
+                            # doctype, as in the source, which iterparse
+                            # does not tell
+                            raise StreamError('Comment or PI next to the '
+                                              'doctype')
+                        out.write(doctype + '\n')
+                    out.write(''.join(prolog))
+
+                # apply rules
+                tag = node.tag.rpartition('}')[2]
+                fns = by_tag.get(tag)
+                if fns:
+                    for fn in fns:
+                        fn(node)
+                for attribute, fn in by_attrib:
+                    value = node.get(attribute)
+                    if value:
+                        fn(node, value)
+                if engine.changes:
+                    changes += len(engine.changes)
+                    engine.changes = []
+
+                parent_nsmap = stack[-1][1] if stack else {}
+                name, nsmap, start = self.start_tag(node, parent_nsmap)
+                stack.append((name, nsmap))
+
+                if titles and tag == 'h1' and h1 is None:
+                    # keep its content until the text is known
+                    h1 = node
+
+                if titles and tag == 'title' and title is None:
+                    # hold back the output until the first <h1>
+                    title = node
+                    out.buffering = True
+                    out.write(start + '>')
+                    title_start = out.mark()
+                else:
+                    out.write(start)
+                    open_tag = True
+
+                pending_text = node
+
+            elif event == 'end':
+                name, nsmap = stack.pop()
+
+                if node is pending_text:
+                    if node.text:
+                        if open_tag:
+                            out.write('>')
+                        out.write(escape_text(node.text))
+                        open_tag = False
+                    pending_text = None
+
+                if open_tag:
+                    out.write('/>')
+                    open_tag = False
+                else:
+                    if node is title:
+                        title_end = out.mark()
+                    out.write('</{}>'.format(name))
+
+                if node is title:
+                    title_text = ''.join(node.itertext())
+                elif node is h1:
+                    h1_text = ''.join(node.itertext())
+
+                if title_text is not None and h1_text is not None \
+                   and out.buffering:
+                    changes += self.override_title(out, title_text, h1_text,
+                                                   title_start, title_end)
+                elif out.buffering and out.size > self.lookahead:
+                    # give up on the title
+                    out.buffering = False
+
+                if h1 is None or h1_text is not None or node is h1:
+                    self.release(node)
+                pending_tail = node
+
+            else:
+                text = lxml.etree.tostring(node, encoding='unicode',
+                                           with_tail=False)
+                if node.getparent() is None:
+                    # prolog and epilog nodes, written without newlines
+                    if root_seen:
+                        out.write(text)
+                    else:
+                        prolog.append(text)
+                else:
+                    out.write(text)
+                    pending_tail = node
+
+        out.buffering = False
+        out.flush()
+
+        engine.counters['scans'] += 1
+        engine.counters['streamed'] += 1
+        engine.counters['elements'] += count
+        engine.metrics.observe('document_nodes', count)
+
+        return changes
+
+    def override_title(self, out, title_text, h1_text, start, end):
+        '''Rewrite the buffered <title> text, as `write_text()` would.'''
+
+        engine = self.engine
+        stub = lxml.etree.Element('title')
+        stub.text = title_text
+
+        engine.write_text(stub, h1_text, engine.title_stat)
+        changed = len(engine.changes)
+        engine.changes = []
+
+        if changed:
+            out.replace(start, end, escape_text(h1_text))
+
+        out.buffering = False
+        return changed
+
+    @staticmethod
+    def start_tag(node, parent_nsmap):
+        '''Return the qualified name, namespace map and start tag of node.
+
+        Only namespaces not already declared by an ancestor are declared.
+        '''
+
+        nsmap = node.nsmap
+        parts = []
+
+        if nsmap != parent_nsmap:
+            for prefix, uri in nsmap.items():
+                if parent_nsmap.get(prefix) != uri:
+                    if prefix is None:
+                        parts.append(' xmlns="{}"'
+                                     .format(escape_attrib(uri)))
+                    else:
+                        parts.append(' xmlns:{}="{}"'
+                                     .format(prefix, escape_attrib(uri)))
+
+        prefixes = None
+        for key, value in node.attrib.items():
+            if key[0] == '{':
+                if prefixes is None:
+                    prefixes = {uri: prefix for prefix, uri in nsmap.items()}
+                    prefixes[XML_NS] = 'xml'
+                uri, local = key[1:].split('}')
+                key = prefixes[uri] + ':' + local
+            parts.append(' ' + key + '="' + escape_attrib(value) + '"')
+
+        name = node.tag.rpartition('}')[2]
+        if node.prefix:
+            name = node.prefix + ':' + name
+
+        return name, nsmap, '<' + name + ''.join(parts)
+
+    @staticmethod
+    def release(node):
+        '''Free an element once written, with its earlier siblings.'''
+
+        for child in node.iterchildren(lxml.etree.Entity):
+            raise StreamError('Entity reference {}'.format(child))
+
+        node.clear(keep_tail=True)
+
+        parent = node.getparent()
+        if parent is not None:
+            while node.getprevious() is not None:
+                sibling = parent[0]
+                if sibling.tag is lxml.etree.Entity:
+                    raise StreamError('Entity reference {}'.format(sibling))
+                del parent[0]
@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+'''
+Access Aide - A Calibre plugin to enhance accessibility features in epub files.
+Copyright (C) 2020-2021 Luca Baffa
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+
+import random
+import zipfile
+from xml.sax.saxutils import escape, quoteattr
+
+CONTAINER_XML = '''<?xml version="1.0" encoding="UTF-8"?>
+<container version="1.0"
+    xmlns="urn:oasis:names:tc:opendocument:xmlns:container">
+  <rootfiles>
+    <rootfile full-path="OEBPS/content.opf"
+        media-type="application/oebps-package+xml"/>
+  </rootfiles>
+</container>'''
+
+OPF = '''<?xml version="1.0" encoding="UTF-8"?>
+<package xmlns="http://www.idpf.org/2007/opf" version="{version}"
+    unique-identifier="uid">
+  <metadata xmlns:dc="http://purl.org/dc/elements/1.1/"
+      xmlns:opf="http://www.idpf.org/2007/opf">
+    <dc:identifier id="uid">urn:uuid:{uid}</dc:identifier>
+    <dc:title>Synthetic book</dc:title>
+    <dc:language>en</dc:language>
+{metadata}
+  </metadata>
+  <manifest>
+{manifest}
+  </manifest>
+  <spine>
+{spine}
+  </spine>
+</package>'''
+
+DOCUMENT = '''<?xml version="1.0" encoding="UTF-8"?>
+<!DOCTYPE html>
+<html xmlns="http://www.w3.org/1999/xhtml"
+    xmlns:epub="http://www.idpf.org/2007/ops">
+<head><title>Document {index}</title></head>
+<body>
+  <section epub:type="chapter">
+    <h1>Chapter <em>{index}</em></h1>
+{body}
+  </section>
+</body>
+</html>'''
+
+# epub:type values with an ARIA role (and a couple without), used at random
+TYPES = ['chapter', 'footnote', 'endnote', 'noteref', 'pagebreak', 'epigraph',
+         'bibliography', 'glossary', 'index', 'toc', 'subtitle', 'abstract',
+         'colophon', 'credit', 'tip', 'warning']
+
+WORDS = ('lorem ipsum dolor sit amet consectetur adipiscing elit sed do '
+         'eiusmod tempor incididunt ut labore et dolore magna aliqua').split()
+
+# metadata properties found in the OPF files of real-world books
+PROPERTIES = ['schema:accessMode', 'schema:accessibilityFeature',
+              'schema:accessibilityHazard', 'dcterms:modified',
+              'calibre:timestamp', 'calibre:title_sort', 'ibooks:version']
+
+
+class BookSpec():
+    '''Shape of a synthetic book.
+
+    `documents` is the number of XHTML documents and `paragraphs` their
+    size. `type_density` and `footnote_density` are the share of
+    paragraphs carrying an epub:type and an InDesign footnote
+    (`_idFootnoteLink` / `_idFootnoteAnchor` pair) respectively.
+    `metadata` is the number of <meta> entries already in the OPF.
+    '''
+
+    def __init__(self, version=3, documents=10, paragraphs=100,
+                 type_density=0.1, footnote_density=0.05, metadata=10,
+                 seed=0):
+        self.version = version
+        self.documents = documents
+        self.paragraphs = paragraphs
+        self.type_density = type_density
+        self.footnote_density = footnote_density
+        self.metadata = metadata
+        self.seed = seed
+
+    def as_dict(self):
+        return dict(vars(self))
+
+
+def make_paragraph(rnd, spec, index, notes):
+    text = ' '.join(rnd.choice(WORDS) for _ in range(rnd.randint(20, 60)))
+
+    if rnd.random() < spec.footnote_density:
+        note = 'fn{}-{}'.format(index, len(notes) + 1)
+        notes.append(note)
+        text += ('<a class="_idFootnoteLink _idGenColorInherit" '
+                 'href="#{0}" id="back-{0}">{1}</a>'
+                 .format(note, len(notes)))
+
+    if rnd.random() < spec.type_density:
+        return '    <p epub:type="{}">{}</p>'.format(rnd.choice(TYPES), text)
+
+    return '    <p>{}</p>'.format(text)
+
+
+def make_document(rnd, spec, index):
+    notes = []
+    body = [make_paragraph(rnd, spec, index, notes)
+            for _ in range(spec.paragraphs)]
+
+    for number, note in enumerate(notes, start=1):
+        body.append('    <aside id="{0}">\n      <p><a class='
+                    '"_idFootnoteAnchor" href="#back-{0}">{1}</a> Note.</p>'
+                    '\n    </aside>'.format(note, number))
+
+    return DOCUMENT.format(index=index, body='\n'.join(body))
+
+
+def make_metadata(rnd, spec):
+    lines = []
+    for index in range(spec.metadata):
+        key = rnd.choice(PROPERTIES)
+        value = escape('value {}'.format(index))
+
+        if spec.version >= 3:
+            lines.append('    <meta property={}>{}</meta>'
+                         .format(quoteattr(key), value))
+        else:
+            lines.append('    <meta name={} content={}/>'
+                         .format(quoteattr(key), quoteattr(value)))
+
+    return '\n'.join(lines)
+
+
+def make_book(path, spec=None):
+    '''Write a synthetic EPUB file shaped after `spec` to `path`.'''
+
+    spec = spec or BookSpec()
+    rnd = random.Random(spec.seed)
+
+    manifest = []
+    spine = []
+    documents = {}
+    for index in range(1, spec.documents + 1):
+        name = 'text/doc{:04d}.xhtml'.format(index)
+        manifest.append('    <item id="d{}" href="{}" '
+                        'media-type="application/xhtml+xml"/>'
+                        .format(index, name))
+        spine.append('    <itemref idref="d{}"/>'.format(index))
+        documents[name] = make_document(rnd, spec, index)
+
+    opf = OPF.format(version='{}.0'.format(spec.version),
+                     uid='{:032x}'.format(rnd.getrandbits(128)),
+                     metadata=make_metadata(rnd, spec),
+                     manifest='\n'.join(manifest), spine='\n'.join(spine))
+
+    with zipfile.ZipFile(path, 'w') as zf:
+        zf.writestr('mimetype', 'application/epub+zip',
+                    compress_type=zipfile.ZIP_STORED)
+        zf.writestr('META-INF/container.xml', CONTAINER_XML,
+                    compress_type=zipfile.ZIP_DEFLATED)
+        zf.writestr('OEBPS/content.opf', opf,
+                    compress_type=zipfile.ZIP_DEFLATED)
+        for name, data in documents.items():
+            zf.writestr('OEBPS/' + name, data,
+                        compress_type=zipfile.ZIP_DEFLATED)
+
+    return path
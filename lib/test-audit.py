@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+'''
+Access Aide - A Calibre plugin to enhance accessibility features in epub files.
+Copyright (C) 2020-2021 Luca Baffa
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+import contextlib
+import io
+import json
+import os
+import shutil
+import tempfile
+import unittest
+import zipfile
+from importlib import import_module
+
+import cli
+from audit import Finding, count_findings
+from cache import ResultCache
+from container import EpubContainer
+from engine import Engine
+from prefs import merge_prefs
+
+make_epub = import_module('test-engine').make_epub
+
+CHAPTER = '''<?xml version="1.0" encoding="UTF-8"?>
+<!DOCTYPE html>
+<html xmlns="http://www.w3.org/1999/xhtml"
+    xmlns:epub="http://www.idpf.org/2007/ops">
+<head><title>Chapter</title></head>
+<body>
+  <section epub:type="chapter foo z3998:poem">
+    <h1>Chapter <em>One</em></h1>
+    <h3>Skipped</h3>
+    <h2>Back up</h2>
+    <table><tr><td>No headers</td></tr></table>
+    <table><tr><th>Header</th></tr><tr><td>Cell</td></tr></table>
+    <table><tr><td scope="row">Scoped</td></tr></table>
+    <p><a href="#fn1"> </a><a href="#fn2"><img src="a.png" alt="Note"/></a>
+       <a href="#fn3" aria-label="Note 3"></a><a id="anchor"></a></p>
+  </section>
+</body>
+</html>'''
+
+CHAPTER_NAME = 'OEBPS/text/chapter.xhtml'
+
+
+class TestModule(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.src = os.path.join(self.tmp, 'in.epub')
+        make_epub(self.src, chapter=CHAPTER)
+
+        self.prefs = merge_prefs({'audit': True})
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_audit(self):
+        container = EpubContainer(self.src)
+        findings = Engine(self.prefs).audit(container)
+
+        self.assertEqual([(f.check, f.line) for f in findings],
+                         [('unknown-epub-type', 7), ('heading-skip', 9),
+                          ('table-headers', 11), ('empty-link', 14),
+                          ('title-mismatch', 5)])
+        self.assertEqual(findings[0],
+                         Finding(CHAPTER_NAME, 'unknown-epub-type', 7,
+                                 'epub:type "foo" has no aria role mapping'))
+        self.assertIn('"Chapter One"', findings[-1].message)
+        self.assertEqual(count_findings(findings)['table-headers'], 1)
+
+        # the book is left untouched
+        self.assertFalse(container.dirtied)
+
+    def test_audit_title_override(self):
+        # titles are only fixed by a run, so the audit alone reports them
+        prefs = merge_prefs({'heuristic': {'title_override': True}},
+                            self.prefs)
+        cache = ResultCache(os.path.join(self.tmp, 'cache.sqlite'))
+        self.addCleanup(cache.close)
+
+        findings = Engine(prefs).audit(EpubContainer(self.src))
+        self.assertIn('title-mismatch', [f.check for f in findings])
+
+        # nor when the findings come from the cache of a run
+        engine = Engine(prefs, cache=cache)
+        engine.run(EpubContainer(self.src))
+        self.assertNotIn('title-mismatch', [f.check for f in engine.findings])
+
+        engine = Engine(prefs, cache=cache)
+        findings = engine.audit(EpubContainer(self.src))
+        self.assertEqual(engine.counters['audit_cached'], 1)
+        self.assertIn('title-mismatch', [f.check for f in findings])
+
+    def test_run(self):
+        container = EpubContainer(self.src)
+        engine = Engine(merge_prefs({'heuristic': {'title_override': True}},
+                                    self.prefs))
+        engine.run(container)
+
+        # the audit checks elements before the rules change them, and
+        # leaves out what the run fixes
+        self.assertEqual([f.check for f in engine.findings],
+                         ['unknown-epub-type', 'heading-skip',
+                          'table-headers', 'empty-link'])
+        self.assertEqual(engine.aria_stat.get(), 1)
+        self.assertEqual(engine.counters['scans'], 1)
+
+        report = engine.report()
+        self.assertEqual(report['audit']['counts']['empty-link'], 1)
+        self.assertEqual(report['audit']['findings'][0]['line'], 7)
+        self.assertIn('Accessibility findings: 1 heading-skip, '
+                      '1 table-headers, 1 empty-link, 1 unknown-epub-type',
+                      engine.report_lines())
+
+        engine = Engine(merge_prefs({}))
+        engine.run(EpubContainer(self.src))
+        self.assertIsNone(engine.findings)
+        self.assertNotIn('audit', engine.report())
+
+    def test_cache(self):
+        cache = ResultCache(os.path.join(self.tmp, 'cache.sqlite'))
+        self.addCleanup(cache.close)
+
+        first = Engine(self.prefs, cache=cache)
+        findings = first.audit(EpubContainer(self.src))
+        self.assertEqual(first.counters['audit_cached'], 0)
+
+        # unchanged documents are not checked again
+        second = Engine(self.prefs, cache=cache)
+        self.assertEqual(second.audit(EpubContainer(self.src)), findings)
+        self.assertEqual(second.counters['audit_cached'], 1)
+        self.assertEqual(second.counters['scans'], 0)
+
+        # the transform cache and the findings cache work together
+        for _ in range(2):
+            engine = Engine(self.prefs, cache=cache)
+            engine.run(EpubContainer(self.src))
+            self.assertEqual(engine.findings, findings)
+        self.assertEqual(engine.counters['cache_hits'], 1)
+        self.assertEqual(engine.counters['audit_cached'], 1)
+
+        make_epub(self.src, chapter=CHAPTER.replace('<h3>', '<h2>')
+                  .replace('</h3>', '</h2>'))
+        third = Engine(self.prefs, cache=cache)
+        changed = third.audit(EpubContainer(self.src))
+        self.assertEqual(third.counters['audit_cached'], 0)
+        self.assertNotIn('heading-skip', [f.check for f in changed])
+
+        # nor are they once the rule files are edited
+        fourth = Engine(self.prefs, cache=cache)
+        fourth.tables = fourth.tables._replace(digest='edited')
+        fourth.audit(EpubContainer(self.src))
+        self.assertEqual(fourth.counters['audit_cached'], 0)
+
+    def test_parallel(self):
+        with zipfile.ZipFile(self.src, 'a') as zf:
+            zf.writestr('OEBPS/text/part.xhtml',
+                        CHAPTER.replace('Chapter', 'Part'))
+        engines = []
+        for jobs in (None, 2):
+            container = EpubContainer(self.src)
+            container.mime_map['OEBPS/text/part.xhtml'] = \
+                'application/xhtml+xml'
+            engine = Engine(self.prefs)
+            engine.run(container, jobs=jobs)
+            engines.append(engine)
+
+        self.assertEqual(len(engines[0].findings), 10)
+        self.assertEqual(engines[1].findings, engines[0].findings)
+
+    def test_streamed(self):
+        engine = Engine(self.prefs, stream_threshold=1)
+        engine.run(EpubContainer(self.src))
+
+        self.assertEqual(engine.findings, [])
+        self.assertEqual(engine.counters['audit_skipped'], 1)
+
+    def test_cli(self):
+        path = os.path.join(self.tmp, 'findings.json')
+
+        with contextlib.redirect_stderr(io.StringIO()):
+            self.assertEqual(cli.main(['audit', self.src, '-o', path]), 1)
+
+        with open(path, encoding='utf-8') as f:
+            findings = json.load(f)['findings']
+        self.assertEqual(findings[1]['check'], 'heading-skip')
+
+        stdout = io.StringIO()
+        with contextlib.redirect_stdout(stdout), \
+                contextlib.redirect_stderr(io.StringIO()):
+            cli.main(['audit', self.src])
+        self.assertIn('{}:9: heading-skip: <h3> follows <h1>'
+                      .format(CHAPTER_NAME), stdout.getvalue())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+'''
+Access Aide - A Calibre plugin to enhance accessibility features in epub files.
+Copyright (C) 2020-2021 Luca Baffa
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+
+import contextlib
+import copy
+import io
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import bench
+import cli
+from container import EpubContainer
+from engine import Engine
+from prefs import merge_prefs
+from synth import BookSpec, make_book
+
+SUITE = {'small': BookSpec(documents=2, paragraphs=20, footnote_density=0.5)}
+
+
+class TestModule(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_make_book(self):
+        for version in (2, 3):
+            path = os.path.join(self.tmp, 'book{}.epub'.format(version))
+            make_book(path, BookSpec(version=version, documents=3,
+                                     paragraphs=20, footnote_density=0.5,
+                                     metadata=5))
+
+            container = EpubContainer(path)
+            self.assertEqual(container.opf_version_parsed.major, version)
+            self.assertEqual(len(list(container.spine_names)), 3)
+
+            engine = Engine(merge_prefs(bench.PREFS))
+            engine.run(container)
+            self.assertGreater(engine.fn_stat.get(), 0)
+            self.assertEqual(engine.title_stat.get(), 3)
+
+    def test_same_seed(self):
+        first = os.path.join(self.tmp, 'first.epub')
+        second = os.path.join(self.tmp, 'second.epub')
+        make_book(first, SUITE['small'])
+        make_book(second, SUITE['small'])
+
+        first, second = EpubContainer(first), EpubContainer(second)
+        self.assertEqual(first.names, second.names)
+        for name in first.names:
+            self.assertEqual(first.read(name), second.read(name))
+
+    def test_run_suite(self):
+        results = bench.run_suite(SUITE, repeat=1)
+
+        stages = results['books']['small']['stages']
+        self.assertEqual(tuple(stages), bench.STAGES)
+        self.assertEqual(bench.compare(results, results), [])
+
+        # the core never pulls in Qt or the calibre GUI
+        self.assertGreater(results['books']['core']['stages']['import'], 0)
+        self.assertEqual(results['books']['core']['gui_modules'], [])
+
+    def test_import_budget(self):
+        seconds, gui = bench.time_import(5)
+        self.assertEqual(gui, [])
+        self.assertLess(seconds, bench.IMPORT_BUDGET)
+
+    def test_compare(self):
+        results = bench.run_suite(SUITE, repeat=1)
+        baseline = copy.deepcopy(results)
+        baseline['books']['small']['stages']['add_aria'] = 0
+
+        regressions = bench.compare(results, baseline, min_delta=0)
+        self.assertEqual([(r.book, r.stage) for r in regressions],
+                         [('small', 'add_aria')])
+
+        # baselines made from another spec are not comparable
+        baseline['books']['small']['spec']['seed'] = 1
+        self.assertEqual(bench.compare(results, baseline, min_delta=0), [])
+
+    def test_cli(self):
+        path = os.path.join(self.tmp, 'baseline.json')
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.assertEqual(cli.main(['bench', '--book', 'epub3',
+                                       '--repeat', '1', '--save', path]), 0)
+
+        with open(path, encoding='utf-8') as f:
+            baseline = json.load(f)
+        # the import of the engine is timed as well, and always takes
+        # longer than the noise allowed for
+        for book in baseline['books'].values():
+            for stage in book['stages']:
+                book['stages'][stage] = 0
+
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(baseline, f)
+
+        with contextlib.redirect_stdout(io.StringIO()), \
+                contextlib.redirect_stderr(io.StringIO()):
+            self.assertEqual(cli.main(['bench', '--book', 'epub3',
+                                       '--repeat', '1',
+                                       '--baseline', path]), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
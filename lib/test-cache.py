@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+'''
+Access Aide - A Calibre plugin to enhance accessibility features in epub files.
+Copyright (C) 2020-2021 Luca Baffa
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from cache import ResultCache
+from prefs import prefs_digest
+
+
+class TestModule(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.cache = ResultCache(os.path.join(self.tmp, 'cache.sqlite'))
+
+    def tearDown(self):
+        self.cache.close()
+        shutil.rmtree(self.tmp)
+
+    def test_key(self):
+        digest = prefs_digest({'force_override': False})
+
+        key = self.cache.key(b'doc', digest, 'en', 'rules', 1)
+
+        self.assertEqual(key, self.cache.key(b'doc', digest, 'en', 'rules', 1))
+        self.assertNotEqual(key,
+                            self.cache.key(b'doc', digest, 'it', 'rules', 1))
+        self.assertNotEqual(key,
+                            self.cache.key(b'doc2', digest, 'en', 'rules', 1))
+        # edited rule files or a new engine invalidate the entries
+        self.assertNotEqual(key,
+                            self.cache.key(b'doc', digest, 'en', 'edited', 1))
+        self.assertNotEqual(key,
+                            self.cache.key(b'doc', digest, 'en', 'rules', 2))
+        self.assertNotEqual(digest, prefs_digest({'force_override': True}))
+
+    def test_get_put(self):
+        self.assertIsNone(self.cache.get('a'))
+
+        self.cache.put('a', b'output', {'lang_stat': 2})
+        self.cache.put('b', None, {})
+
+        self.assertEqual(self.cache.get('a'), (b'output', {'lang_stat': 2}))
+        self.assertEqual(self.cache.get('b'), (None, {}))
+        self.assertEqual((self.cache.hits, self.cache.misses), (2, 1))
+
+    def test_persistent(self):
+        self.cache.put('a', b'output', {})
+        self.cache.close()
+
+        self.cache = ResultCache(os.path.join(self.tmp, 'cache.sqlite'))
+        self.assertEqual(self.cache.get('a'), (b'output', {}))
+
+    def test_eviction(self):
+        self.cache.max_size = 250
+        for key in 'abc':
+            self.cache.put(key, b'x' * 100, {})
+            # keep 'a' as the most recently used entry
+            self.cache.get('a')
+
+        self.assertLessEqual(self.cache.size(), 250)
+        self.assertIsNotNone(self.cache.get('a'))
+        self.assertIsNone(self.cache.get('b'))
+        self.assertIsNotNone(self.cache.get('c'))
+
+
+if __name__ == '__main__':
+    unittest.main()
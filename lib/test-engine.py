@@ -0,0 +1,515 @@
+#!/usr/bin/env python3
+'''
+Access Aide - A Calibre plugin to enhance accessibility features in epub files.
+Copyright (C) 2020-2021 Luca Baffa
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+import contextlib
+import io
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+import zipfile
+
+import lxml.etree
+
+from container import (PARALLEL_DEFLATE_SIZE, EpubContainer, copy_info,
+                       parse_xml, read_raw, write_raw)
+from engine import Engine, AccessAideError, XML_LANG, EPUB_TYPE
+from prefs import merge_prefs
+from batch import run_batch, find_books
+from cache import ResultCache
+from plan import apply_plan
+import cli
+
+CONTAINER_XML = '''<?xml version="1.0" encoding="UTF-8"?>
+<container version="1.0"
+    xmlns="urn:oasis:names:tc:opendocument:xmlns:container">
+  <rootfiles>
+    <rootfile full-path="OEBPS/content.opf"
+        media-type="application/oebps-package+xml"/>
+  </rootfiles>
+</container>'''
+
+OPF = '''<?xml version="1.0" encoding="UTF-8"?>
+<package xmlns="http://www.idpf.org/2007/opf" version="{version}"
+    unique-identifier="uid">
+  <metadata xmlns:dc="http://purl.org/dc/elements/1.1/">
+    <dc:title>Test</dc:title>
+    {language}
+  </metadata>
+  <manifest>
+    <item id="c1" href="text/chapter.xhtml"
+        media-type="application/xhtml+xml"/>
+    <item id="css" href="style.css" media-type="text/css"/>
+  </manifest>
+  <spine>
+    <itemref idref="c1"/>
+  </spine>
+</package>'''
+
+CHAPTER = '''<?xml version="1.0" encoding="UTF-8"?>
+<!DOCTYPE html>
+<html xmlns="http://www.w3.org/1999/xhtml"
+    xmlns:epub="http://www.idpf.org/2007/ops">
+<head><title>Wrong</title></head>
+<body>
+  <section epub:type="chapter">
+    <h1>Chapter <em>One</em></h1>
+    <p>Text<a class="_idFootnoteLink _idGenColorInherit"
+        href="#fn1">1</a></p>
+    <aside epub:type="footnote" id="fn1">
+      <a class="_idFootnoteAnchor" href="#back">1</a>
+    </aside>
+  </section>
+</body>
+</html>'''
+
+
+def make_epub(path, version='3.0',
+              language='<dc:language>en</dc:language>', chapter=CHAPTER):
+    with zipfile.ZipFile(path, 'w') as zf:
+        zf.writestr('mimetype', 'application/epub+zip',
+                    compress_type=zipfile.ZIP_STORED)
+        zf.writestr('META-INF/container.xml', CONTAINER_XML)
+        zf.writestr('OEBPS/content.opf',
+                    OPF.format(version=version, language=language))
+        zf.writestr('OEBPS/text/chapter.xhtml', chapter)
+        zf.writestr('OEBPS/style.css', 'p { margin: 0 }')
+
+
+class TestModule(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.src = os.path.join(self.tmp, 'in.epub')
+        self.dst = os.path.join(self.tmp, 'out.epub')
+        make_epub(self.src)
+
+        self.prefs = merge_prefs({'heuristic': {'title_override': True,
+                                                'type_footnotes': True}})
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_container(self):
+        container = EpubContainer(self.src)
+
+        self.assertEqual(container.opf_name, 'OEBPS/content.opf')
+        self.assertEqual(container.opf_version_parsed.major, 3)
+        self.assertEqual(container.mime_map['OEBPS/text/chapter.xhtml'],
+                         'application/xhtml+xml')
+        self.assertEqual(container.opf_xpath('//dc:language/text()'), ['en'])
+
+    def test_commit(self):
+        with zipfile.ZipFile(self.src, 'a') as zf:
+            zf.writestr('OEBPS/font.otf', os.urandom(4096),
+                        compress_type=zipfile.ZIP_DEFLATED)
+            zf.writestr('OEBPS/text/long.xhtml',
+                        b'<p>Text</p>' * PARALLEL_DEFLATE_SIZE)
+
+        container = EpubContainer(self.src)
+        Engine(self.prefs).run(container)
+        with container.open('OEBPS/text/long.xhtml', 'wb') as f:
+            f.write(b'<p>Changed</p>' * PARALLEL_DEFLATE_SIZE)
+        container.commit(self.dst)
+
+        changed = container.changed()
+        self.assertEqual(sorted(changed), ['OEBPS/content.opf',
+                                           'OEBPS/text/chapter.xhtml',
+                                           'OEBPS/text/long.xhtml'])
+        # members the run does not look at are never inflated
+        self.assertNotIn('OEBPS/font.otf', container.data)
+        self.assertNotIn('OEBPS/style.css', container.data)
+
+        with zipfile.ZipFile(self.src) as a, zipfile.ZipFile(self.dst) as b:
+            self.assertIsNone(b.testzip())
+            self.assertEqual(b.namelist(), a.namelist())
+
+            mimetype = b.infolist()[0]
+            self.assertEqual(mimetype.filename, 'mimetype')
+            self.assertEqual(mimetype.compress_type, zipfile.ZIP_STORED)
+            with open(self.dst, 'rb') as f:
+                self.assertEqual(f.read(58)[30:],
+                                 b'mimetypeapplication/epub+zip')
+
+            for name in a.namelist():
+                if name in changed:
+                    self.assertEqual(b.read(name), changed[name])
+                else:
+                    # copied as is, without inflating it again
+                    self.assertEqual(read_raw(b, b.getinfo(name)),
+                                     read_raw(a, a.getinfo(name)))
+
+        # committing over the original file
+        container = EpubContainer(self.dst)
+        Engine(self.prefs).run(container)
+        container.commit(self.dst)
+        with zipfile.ZipFile(self.dst) as zf:
+            self.assertIsNone(zf.testzip())
+            font = zf.read('OEBPS/font.otf')
+        self.assertEqual(sorted(os.listdir(self.tmp)), ['in.epub', 'out.epub'])
+
+        # members not read yet are read from the new file
+        self.assertEqual(container.read('OEBPS/font.otf'), font)
+        container.close()
+
+    def test_write_raw(self):
+        with zipfile.ZipFile(self.src) as source:
+            infos = source.infolist()
+            raw = [read_raw(source, info) for info in infos]
+
+            f = io.BytesIO()
+            with zipfile.ZipFile(f, 'w') as zf:
+                for info, data in zip(infos, raw):
+                    write_raw(zf, copy_info(info), data)
+                # members written by zipfile itself still fit in
+                zf.writestr('extra.txt', b'extra')
+
+            with zipfile.ZipFile(f) as zf:
+                self.assertIsNone(zf.testzip())
+                self.assertEqual(zf.namelist(),
+                                 source.namelist() + ['extra.txt'])
+                for info in infos:
+                    self.assertEqual(zf.read(info.filename),
+                                     source.read(info.filename))
+                self.assertEqual(zf.read('extra.txt'), b'extra')
+
+    def test_run(self):
+        container = EpubContainer(self.src)
+        engine = Engine(self.prefs)
+        engine.run(container)
+
+        root = container.parsed('OEBPS/text/chapter.xhtml')
+        self.assertEqual(root.get('lang'), 'en')
+        self.assertEqual(root.get(XML_LANG), 'en')
+
+        section = root.xpath('//*[local-name()="section"]')[0]
+        self.assertEqual(section.get('role'), 'doc-chapter')
+
+        title = root.xpath('//*[local-name()="title"]')[0]
+        self.assertEqual(title.text, 'Chapter One')
+
+        link = root.xpath('//*[local-name()="p"]/*')[0]
+        self.assertEqual(link.get(EPUB_TYPE), 'noteref')
+        self.assertEqual(link.get('role'), 'doc-noteref')
+
+        self.assertEqual(engine.lang_stat.get(), 3)
+        self.assertEqual(engine.title_stat.get(), 1)
+        self.assertEqual(engine.fn_stat.get(), 1)
+        self.assertEqual(engine.meta_stat.get(), 7)
+
+    def test_memory_budget(self):
+        name = 'OEBPS/text/chapter.xhtml'
+
+        container = EpubContainer(self.src)
+        Engine(self.prefs).run(container)
+        expected = container.raw_data(name, decode=False)
+
+        container = EpubContainer(self.src)
+        engine = Engine(merge_prefs(dict(self.prefs, memory_budget=0.001)))
+        engine.run(container)
+
+        # only the OPF stays parsed, the chapter is serialised at once
+        self.assertEqual(list(container.parsed_cache), [container.opf_name])
+        self.assertNotIn(name, container.dirtied)
+        self.assertEqual(container.read(name), expected)
+        self.assertEqual(engine.counters['trees_evicted'], 1)
+        self.assertEqual(engine.lang_stat.get(), 3)
+
+        report = engine.report()
+        self.assertGreater(report['memory']['peak_rss'], 0)
+        self.assertGreaterEqual(report['memory']['rss_increase'], 0)
+        self.assertEqual(report['memory']['trees_evicted'], 1)
+        self.assertIn('Documents unloaded: 1', engine.report_lines()[-1])
+
+    def test_memory_budget_fits(self):
+        container = EpubContainer(self.src)
+        engine = Engine(merge_prefs(dict(self.prefs, memory_budget=16)))
+        engine.run(container)
+
+        self.assertIn('OEBPS/text/chapter.xhtml', container.parsed_cache)
+        self.assertEqual(engine.counters['trees_evicted'], 0)
+
+    def test_lazy_features(self):
+        # optional features are imported by the runs that need them
+        code = ('import sys, engine; print(" ".join(m for m in '
+                'engine.FEATURES if m in sys.modules))')
+        output = subprocess.check_output(
+            [sys.executable, '-c', code],
+            cwd=os.path.dirname(os.path.abspath(__file__)))
+        self.assertEqual(output.strip(), b'')
+
+    def test_single_scan(self):
+        container = EpubContainer(self.src)
+        engine = Engine(self.prefs)
+        engine.run(container)
+
+        self.assertEqual(engine.counters['scans'], 1)
+
+    def test_transform_changes(self):
+        container = EpubContainer(self.src)
+        engine = Engine(self.prefs)
+        root = container.parsed('OEBPS/text/chapter.xhtml')
+
+        changes = engine.transform(root, 'en')
+        self.assertEqual(len(changes), 8)
+        self.assertEqual((changes[0].attribute, changes[0].old,
+                          changes[0].new), ('lang', None, 'en'))
+
+        title = [c for c in changes if c.op == 'text'][0]
+        self.assertEqual((title.old, title.new), ('Wrong', 'Chapter One'))
+
+        # a second run has nothing left to do
+        self.assertEqual(engine.transform(root, 'en'), [])
+
+    def test_rerun_is_clean(self):
+        container = EpubContainer(self.src)
+        Engine(self.prefs).run(container)
+        self.assertEqual(len(container.dirtied), 2)
+        container.commit(self.dst)
+
+        container = EpubContainer(self.dst)
+        engine = Engine(self.prefs)
+        engine.run(container)
+
+        self.assertEqual(container.dirtied, set())
+        self.assertEqual(engine.counters['files_skipped'], 2)
+        self.assertIn('Files left untouched: 2', engine.stats_report())
+
+    def test_force_override_same_value(self):
+        prefs = merge_prefs({'force_override': True})
+        container = EpubContainer(self.src)
+        engine = Engine(prefs)
+        root = container.parsed('OEBPS/text/chapter.xhtml')
+
+        self.assertTrue(engine.transform(root, 'en'))
+        self.assertEqual(engine.transform(root, 'en'), [])
+
+    def test_single_rule(self):
+        container = EpubContainer(self.src)
+        engine = Engine(self.prefs)
+        root = container.parsed('OEBPS/text/chapter.xhtml')
+
+        changes = engine.add_fn_type(root)
+        self.assertEqual([c.new for c in changes], ['noteref',
+                                                    'doc-backlink'])
+
+    def test_class_rules(self):
+        prefs = merge_prefs({'class_rules': [
+            {'class': 'aside', 'tag': 'p', 'attrib': {'id': False},
+             'set': {'epub:type': 'footnote'}},
+            {'tag': 'section', 'attrib': {'epub:type': 'chapter'},
+             'set': {'aria-label': 'Chapter'}},
+        ]})
+        root = parse_xml(CHAPTER.replace(
+            '<p>Text', '<p class="aside">Text</p><p class="asides">'
+            '</p><p class="x aside" id="n">Text').encode('utf-8'))
+        engine = Engine(prefs)
+
+        changes = engine.add_fn_type(root)
+
+        # exact tokens only, and only on elements matching the predicates
+        self.assertEqual([(c.node.get('class'), c.new) for c in changes],
+                         [(None, 'Chapter'), ('aside', 'footnote')])
+        self.assertEqual(engine.fn_stat.get(), 1)
+        self.assertEqual(engine.counters['scans'], 1)
+
+        # the InDesign rules run only when footnotes are typed
+        self.assertNotIn('noteref', [c.new for c in changes])
+
+    def test_run_epub2(self):
+        make_epub(self.src, version='2.0')
+        container = EpubContainer(self.src)
+        engine = Engine(self.prefs)
+        engine.run(container)
+
+        names = container.opf_xpath('//*[local-name()="meta"]/@name')
+        self.assertIn('schema:accessMode', names)
+
+    def test_run_parallel(self):
+        chapter2 = CHAPTER.replace('Chapter', 'Part')
+        with zipfile.ZipFile(self.src, 'a') as zf:
+            zf.writestr('OEBPS/text/part.xhtml', chapter2)
+        containers = [EpubContainer(self.src), EpubContainer(self.src)]
+        for container in containers:
+            container.mime_map['OEBPS/text/part.xhtml'] = \
+                'application/xhtml+xml'
+
+        serial = Engine(self.prefs)
+        serial.run(containers[0])
+
+        parallel = Engine(self.prefs)
+        parallel.run(containers[1], jobs=2)
+
+        container = containers[1]
+
+        self.assertEqual(parallel.stat_values(), serial.stat_values())
+        self.assertEqual(parallel.lang_stat.get(), 5)
+
+        root = container.parsed('OEBPS/text/part.xhtml')
+        title = root.xpath('//*[local-name()="title"]')[0]
+        self.assertEqual(title.text, 'Part One')
+
+    def test_cache(self):
+        cache = ResultCache(os.path.join(self.tmp, 'cache.sqlite'))
+        self.addCleanup(cache.close)
+
+        outputs = []
+        engines = []
+        for i in range(2):
+            container = EpubContainer(self.src)
+            engine = Engine(self.prefs, cache=cache)
+            engine.run(container)
+            outputs.append(container.raw_data('OEBPS/text/chapter.xhtml'))
+            engines.append(engine)
+
+        first, second = engines
+        self.assertEqual((first.counters['cache_hits'],
+                          first.counters['cache_misses']), (0, 1))
+        self.assertEqual((second.counters['cache_hits'],
+                          second.counters['cache_misses']), (1, 0))
+        self.assertEqual(second.counters['scans'], 0)
+        self.assertEqual(outputs[0], outputs[1])
+        self.assertEqual(first.stat_values(), second.stat_values())
+        self.assertIn('Cache hits: 1, misses: 0', second.stats_report())
+
+        # edited rule files are not served from the cache
+        engine = Engine(self.prefs, cache=cache)
+        engine.tables = engine.tables._replace(digest='edited')
+        engine.run(EpubContainer(self.src))
+        self.assertEqual(engine.counters['cache_misses'], 1)
+
+    def test_metadata_exact_match(self):
+        make_epub(self.src, language='<dc:language>en</dc:language>'
+                  '<meta property="schema:accessModeSufficient">textual'
+                  '</meta>')
+        prefs = merge_prefs({'a11y': {'certifiedBy': 'Books Ltd'},
+                             'dcterms': {'conformsTo': 'http://wcag'}})
+        prefs['access'] = {'accessMode': ['textual'],
+                           'accessModeSufficient': ['textual']}
+        container = EpubContainer(self.src)
+        engine = Engine(prefs)
+        engine.run(container)
+
+        props = container.opf_xpath('//opf:meta/@property')
+        self.assertEqual(props.count('schema:accessMode'), 1)
+        self.assertEqual(props.count('schema:accessModeSufficient'), 1)
+        self.assertIn('a11y:certifiedBy', props)
+        self.assertEqual(container.opf_xpath('//opf:link/@href'),
+                         ['http://wcag'])
+        self.assertEqual(engine.meta_stat.get(), 3)
+
+        # a second run adds nothing, even when forcing overrides
+        prefs['force_override'] = True
+        engine = Engine(prefs)
+        engine.run(container)
+        self.assertEqual(engine.meta_stat.get(), 0)
+
+    def test_plan(self):
+        prefs = merge_prefs(self.prefs)
+        prefs['a11y']['certifiedBy'] = 'Books Ltd'
+        container = EpubContainer(self.src)
+        before = {name: container.raw_data(name) for name in container.names
+                  if name.endswith(('.xhtml', '.opf'))}
+
+        engine = Engine(prefs)
+        plan = engine.plan(container)
+
+        # nothing changed, nothing to serialise
+        self.assertEqual(container.dirtied, set())
+        for name, data in before.items():
+            self.assertEqual(lxml.etree.tostring(container.parsed(name)),
+                             lxml.etree.tostring(lxml.etree.fromstring(
+                                 data.encode('utf-8'))))
+
+        ops = [entry['op'] for entry in plan['changes']]
+        self.assertEqual(ops.count('insert'), 8)
+        self.assertEqual(ops.count('text'), 1)
+        self.assertEqual(engine.title_stat.get(), 1)
+
+        # the plan applies to a fresh copy, with the outcome of a run
+        planned = EpubContainer(self.src)
+        applied, conflicts = apply_plan(planned, plan)
+        self.assertEqual((applied, conflicts), (len(plan['changes']), 0))
+
+        ran = EpubContainer(self.src)
+        Engine(prefs).run(ran)
+        for name in before:
+            self.assertEqual(planned.raw_data(name), ran.raw_data(name))
+
+    def test_missing_language(self):
+        make_epub(self.src, language='')
+        container = EpubContainer(self.src)
+
+        with self.assertRaises(AccessAideError):
+            Engine(self.prefs).run(container)
+
+    def test_unsupported_version(self):
+        make_epub(self.src, version='1.0')
+        container = EpubContainer(self.src)
+
+        with self.assertRaises(AccessAideError):
+            Engine(self.prefs).run(container)
+
+    def test_commit(self):
+        container = EpubContainer(self.src)
+        Engine(self.prefs).run(container)
+        container.commit(self.dst)
+
+        with zipfile.ZipFile(self.dst) as zf:
+            infos = zf.infolist()
+            self.assertEqual(infos[0].filename, 'mimetype')
+            self.assertEqual(infos[0].compress_type, zipfile.ZIP_STORED)
+            self.assertEqual(zf.read('OEBPS/style.css'), b'p { margin: 0 }')
+
+            chapter = zf.read('OEBPS/text/chapter.xhtml')
+            self.assertIn(b'<!DOCTYPE html>', chapter)
+            root = lxml.etree.fromstring(chapter)
+            self.assertEqual(root.get('lang'), 'en')
+
+    def test_cli(self):
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.assertEqual(cli.main(['run', self.src, self.dst]), 0)
+        self.assertTrue(os.path.exists(self.dst))
+
+    def test_batch(self):
+        src_dir = os.path.join(self.tmp, 'books')
+        dst_dir = os.path.join(self.tmp, 'out')
+        os.makedirs(src_dir)
+        for i in range(3):
+            make_epub(os.path.join(src_dir, 'book{}.epub'.format(i)))
+        with open(os.path.join(src_dir, 'broken.epub'), 'w') as f:
+            f.write('not a zip file')
+
+        books = find_books(src_dir)
+        self.assertEqual(len(books), 4)
+
+        results = list(run_batch(books, src_dir, dst_dir, self.prefs,
+                                 jobs=2))
+        self.assertEqual(len(results), 4)
+
+        failed = [r for r in results if not r['ok']]
+        self.assertEqual(len(failed), 1)
+        self.assertTrue(failed[0]['input'].endswith('broken.epub'))
+        self.assertTrue(os.path.exists(os.path.join(dst_dir, 'book2.epub')))
+
+
+if __name__ == '__main__':
+    unittest.main()
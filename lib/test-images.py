@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+'''
+Access Aide - A Calibre plugin to enhance accessibility features in epub files.
+Copyright (C) 2020-2021 Luca Baffa
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+import io
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+import zipfile
+from importlib import import_module
+
+import images
+from container import EpubContainer
+from engine import Engine
+from prefs import merge_prefs
+
+make_epub = import_module('test-engine').make_epub
+
+PNG = (b'\x89PNG\r\n\x1a\n' + struct.pack('>I', 13) + b'IHDR'
+       + struct.pack('>II', 640, 480) + b'\x08\x02\0\0\0' + b'\0' * 1000)
+
+# an APP1 segment (e.g. EXIF) before the frame header
+JPEG = (b'\xff\xd8\xff\xe1' + struct.pack('>H', 1002) + b'x' * 1000
+        + b'\xff\xc0' + struct.pack('>HBHH', 17, 8, 300, 400) + b'\0' * 64)
+
+CHAPTER = '''<?xml version="1.0" encoding="UTF-8"?>
+<!DOCTYPE html>
+<html xmlns="http://www.w3.org/1999/xhtml"
+    xmlns:epub="http://www.idpf.org/2007/ops">
+<head><title>Chapter</title></head>
+<body>
+  <section epub:type="chapter">
+    <h1>Chapter</h1>
+    <img src="../images/a%20b.png" alt="A chart"/>
+    <img src="../images/photo.jpg"/>
+    <img src="../images/a%20b.png" alt=" "/>
+    <img src="../images/gone.png" alt="Gone"/>
+    <img src="https://example.com/remote.png"/>
+  </section>
+</body>
+</html>'''
+
+
+class ReadCounter(io.BytesIO):
+
+    def __init__(self, data):
+        super().__init__(data)
+        self.bytes_read = 0
+
+    def read(self, size=-1):
+        data = super().read(size)
+        self.bytes_read += len(data)
+        return data
+
+
+class TestModule(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.src = os.path.join(self.tmp, 'in.epub')
+        make_epub(self.src, chapter=CHAPTER)
+        with zipfile.ZipFile(self.src, 'a') as zf:
+            zf.writestr('OEBPS/images/a b.png', PNG)
+            zf.writestr('OEBPS/images/photo.jpg', JPEG)
+
+        self.prefs = merge_prefs({'image_report': True})
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def container(self):
+        container = EpubContainer(self.src)
+        container.mime_map['OEBPS/images/a b.png'] = 'image/png'
+        container.mime_map['OEBPS/images/photo.jpg'] = 'image/jpeg'
+        return container
+
+    def test_sniff(self):
+        gif = b'GIF89a' + struct.pack('<HH', 10, 20) + b'\0' * 30
+        webp = (b'RIFF\0\0\0\0WEBPVP8X' + b'\0' * 8
+                + (99).to_bytes(3, 'little') + (49).to_bytes(3, 'little'))
+        svg = (b'<?xml version="1.0"?>\n<svg xmlns="http://www.w3.org/2000/'
+               b'svg" viewBox="0 0 120 80"><rect/></svg>')
+
+        self.assertEqual(images.sniff(io.BytesIO(PNG)), ('png', 640, 480))
+        self.assertEqual(images.sniff(io.BytesIO(gif)), ('gif', 10, 20))
+        self.assertEqual(images.sniff(io.BytesIO(webp)), ('webp', 100, 50))
+        self.assertEqual(images.sniff(io.BytesIO(svg)), ('svg', 120, 80))
+        self.assertEqual(images.sniff(io.BytesIO(b'\xff\xd8\xff')),
+                         ('jpeg', None, None))
+        self.assertEqual(images.sniff(io.BytesIO(b'plain text')),
+                         (None, None, None))
+
+    def test_header_only(self):
+        f = ReadCounter(JPEG + b'\0' * 100000)
+
+        self.assertEqual(images.sniff(f), ('jpeg', 400, 300))
+        # the APP1 payload is skipped with seek(), not read
+        self.assertLess(f.bytes_read, 64)
+
+    def test_resolve(self):
+        self.assertEqual(images.resolve('../images/a%20b.png#x',
+                                        'OEBPS/text/c.xhtml'),
+                         'OEBPS/images/a b.png')
+        self.assertIsNone(images.resolve('data:image/png;base64,AA',
+                                         'OEBPS/text/c.xhtml'))
+
+    def test_inventory(self):
+        chapter = 'OEBPS/text/chapter.xhtml'
+        container = self.container()
+        inventory = images.inventory(container, [chapter])
+
+        # headers are read from the zip, images are not loaded whole
+        self.assertNotIn('OEBPS/images/photo.jpg', container.data)
+
+        self.assertEqual(inventory[0],
+                         images.Image(chapter, '../images/a%20b.png',
+                                      'OEBPS/images/a b.png', 'present',
+                                      'png', 640, 480))
+        self.assertEqual([(i.alt, i.format, i.width) for i in inventory],
+                         [('present', 'png', 640), ('missing', 'jpeg', 400),
+                          ('empty', 'png', 640), ('present', None, None),
+                          ('missing', None, None)])
+
+        # streamed documents are read without their tree
+        streamed = images.inventory(self.container(), [chapter], {chapter})
+        self.assertEqual(streamed, inventory)
+
+        self.assertEqual(images.coverage({'missing': 2, 'empty': 1,
+                                          'present': 2}), 60.0)
+        self.assertIsNone(images.coverage({}))
+
+    def test_report(self):
+        engine = Engine(self.prefs)
+        engine.run(self.container())
+        report = engine.report()
+
+        self.assertEqual(report['images']['total'], 5)
+        self.assertEqual(report['images']['alt'],
+                         {'missing': 2, 'empty': 1, 'present': 2})
+        self.assertEqual(report['images']['coverage'], 60.0)
+        self.assertEqual(report['images']['items'][1]['height'], 300)
+        self.assertIn('Alt text coverage: 60.0%', engine.report_lines())
+
+        engine = Engine(merge_prefs({}))
+        engine.run(self.container())
+        self.assertNotIn('images', engine.report())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+'''
+Access Aide - A Calibre plugin to enhance accessibility features in epub files.
+Copyright (C) 2020-2021 Luca Baffa
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+import contextlib
+import io
+import json
+import os
+import shutil
+import tempfile
+import unittest
+import zipfile
+from importlib import import_module
+
+import cli
+from cache import ResultCache
+from container import EpubContainer
+from engine import Engine
+from infer import EVIDENCE, infer
+from prefs import merge_prefs
+from rules import load_rule_tables
+
+make_epub = import_module('test-engine').make_epub
+
+CHAPTER = '''<?xml version="1.0" encoding="UTF-8"?>
+<!DOCTYPE html>
+<html xmlns="http://www.w3.org/1999/xhtml"
+    xmlns:epub="http://www.idpf.org/2007/ops">
+<head><title>Chapter</title></head>
+<body>
+  <nav epub:type="page-list"><ol><li><a href="#p1">1</a></li></ol></nav>
+  <section epub:type="chapter">
+    <h1>Chapter One</h1>
+    <span id="p1" epub:type="pagebreak" role="doc-pagebreak"/>
+    <p>Text <img src="a.png" alt="A"/><img src="b.png" alt=""/></p>
+    <table><tr><th>Header</th></tr><tr><td>Cell</td></tr></table>
+    <table><tr><td>No headers</td></tr></table>
+    <math xmlns="http://www.w3.org/1998/Math/MathML" alttext="x">
+      <mi>x</mi></math>
+  </section>
+</body>
+</html>'''
+
+COVER = '''<?xml version="1.0" encoding="UTF-8"?>
+<html xmlns="http://www.w3.org/1999/xhtml">
+<head><title>Cover</title></head>
+<body><div><img src="cover.jpg"/></div></body>
+</html>'''
+
+COVER_NAME = 'OEBPS/text/cover.xhtml'
+
+
+def evidence(**counts):
+    found = dict.fromkeys(EVIDENCE, 0)
+    found.update(counts)
+    return found
+
+
+class TestModule(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.src = os.path.join(self.tmp, 'in.epub')
+        make_epub(self.src, chapter=CHAPTER)
+        with zipfile.ZipFile(self.src, 'a') as zf:
+            zf.writestr(COVER_NAME, COVER)
+
+        self.prefs = merge_prefs({'infer_access': True})
+        self.features = load_rule_tables().features
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def container(self):
+        container = EpubContainer(self.src)
+        container.mime_map[COVER_NAME] = 'application/xhtml+xml'
+        return container
+
+    def test_infer(self):
+        inferred = infer(evidence(text_documents=1, headings=2, images=1),
+                         self.features)
+        self.assertEqual(inferred['accessibilityFeature'],
+                         ['structuralNavigation', 'alternativeText'])
+        self.assertEqual(inferred['accessMode'], ['textual', 'visual'])
+        self.assertEqual(inferred['accessModeSufficient'],
+                         ['textual', 'textual,visual'])
+        self.assertEqual(inferred['accessibilitySummary'],
+                         ['This publication provides structured headings '
+                          'and alternative text for all images.'])
+
+        # images without alt text are not enough for the text alone
+        inferred = infer(evidence(text_documents=1, images=2, alt_missing=1,
+                                  smil=1), self.features)
+        self.assertEqual(inferred['accessibilityFeature'],
+                         ['synchronizedAudioText'])
+        self.assertEqual(inferred['accessMode'],
+                         ['textual', 'visual', 'auditory'])
+        self.assertEqual(inferred['accessModeSufficient'],
+                         ['textual,visual'])
+        self.assertIn('1 of 2 images have no alternative text.',
+                      inferred['accessibilitySummary'][0])
+
+        inferred = infer(evidence(), self.features)
+        self.assertEqual(inferred['accessibilityFeature'], ['none'])
+        self.assertEqual(inferred['accessModeSufficient'], ['textual'])
+
+        # features outside the vocabulary are left out
+        inferred = infer(evidence(headings=1), ['tableOfContents'])
+        self.assertEqual(inferred['accessibilityFeature'], ['none'])
+
+    def test_run(self):
+        container = self.container()
+        engine = Engine(self.prefs)
+        engine.run(container)
+
+        report = engine.report()['inferred']
+        self.assertEqual(report['evidence'], evidence(
+            documents=2, text_documents=1, image_documents=1, images=3,
+            alt_missing=1, math=1, described_math=1, tables=2,
+            headed_tables=1, headings=1, roles=3, page_list=1,
+            pagebreaks=1))
+        self.assertEqual(report['metadata'], engine.inferred)
+
+        # evidence is collected in the walk of the transforms
+        self.assertEqual(engine.counters['scans'], 2)
+
+        self.assertEqual(engine.inferred['accessibilityFeature'],
+                         ['structuralNavigation', 'pageNavigation',
+                          'printPageNumbers', 'MathML', 'describedMath',
+                          'ARIA'])
+        self.assertEqual(engine.inferred['accessModeSufficient'],
+                         ['textual,visual'])
+        summary = engine.inferred['accessibilitySummary'][0]
+        self.assertIn('1 documents are made of images without text.',
+                      summary)
+        self.assertIn('1 of 2 tables have no header cells.', summary)
+
+        # inferred values replace the prefs ones, the hazard is kept
+        metadata = container.opf_xpath('//opf:meta/@property')
+        self.assertEqual(metadata.count('schema:accessibilityFeature'), 6)
+        self.assertEqual(metadata.count('schema:accessModeSufficient'), 1)
+        self.assertEqual(metadata.count('schema:accessibilityHazard'), 1)
+        self.assertIn('Inferred accessMode: textual, visual',
+                      engine.report_lines())
+
+        engine = Engine(merge_prefs({}))
+        engine.run(self.container())
+        self.assertIsNone(engine.inferred)
+        self.assertNotIn('inferred', engine.report())
+
+    def test_batch(self):
+        src_dir = os.path.join(self.tmp, 'books')
+        os.makedirs(src_dir)
+        shutil.copy(self.src, src_dir)
+        prefs = os.path.join(self.tmp, 'prefs.json')
+        with open(prefs, 'w', encoding='utf-8') as f:
+            json.dump({'infer_access': True}, f)
+
+        engine = Engine(self.prefs)
+        engine.run(EpubContainer(self.src))
+        expected = engine.report()['inferred']
+
+        # the per-book reports of batch runs keep the inferred metadata
+        for options in ([], ['--pipeline']):
+            path = os.path.join(self.tmp, 'reports.jsonl')
+            with contextlib.redirect_stdout(io.StringIO()):
+                cli.main(['batch', src_dir, '-o',
+                          os.path.join(self.tmp, 'out'), '--prefs', prefs,
+                          '--report', path] + options)
+
+            with open(path, encoding='utf-8') as f:
+                report = json.loads(f.read())
+            os.remove(path)
+
+            self.assertEqual(report['inferred'], expected)
+            self.assertEqual(report['inferred']['evidence']['headings'], 1)
+
+    def test_cache(self):
+        cache = ResultCache(os.path.join(self.tmp, 'cache.sqlite'))
+        self.addCleanup(cache.close)
+
+        engines = []
+        for _ in range(2):
+            engine = Engine(self.prefs, cache=cache)
+            engine.run(self.container())
+            engines.append(engine)
+
+        self.assertEqual(engines[1].counters['cache_hits'], 2)
+        self.assertEqual(engines[1].counters['scans'], 0)
+        self.assertEqual(engines[1].inferred, engines[0].inferred)
+
+    def test_parallel(self):
+        engines = []
+        for jobs in (None, 2):
+            engine = Engine(self.prefs)
+            engine.run(self.container(), jobs=jobs)
+            engines.append(engine)
+
+        self.assertEqual(engines[1].inferred, engines[0].inferred)
+
+    def test_streamed(self):
+        engine = Engine(self.prefs, stream_threshold=1)
+        engine.run(self.container())
+
+        self.assertEqual(engine.counters['evidence_skipped'], 2)
+        self.assertEqual(engine.inferred['accessMode'], ['textual'])
+
+
+if __name__ == '__main__':
+    unittest.main()
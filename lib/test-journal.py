@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+'''
+Access Aide - A Calibre plugin to enhance accessibility features in epub files.
+Copyright (C) 2020-2021 Luca Baffa
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+
+import os
+import shutil
+import tempfile
+import unittest
+import zipfile
+from importlib import import_module
+
+from container import EpubContainer, parse_xml, serialize
+from engine import Engine, XML_LANG
+from journal import Journal
+from prefs import merge_prefs
+
+make_epub = import_module('test-engine').make_epub
+
+CHAPTER = 'OEBPS/text/chapter.xhtml'
+OPF = 'OEBPS/content.opf'
+
+
+class TestModule(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.src = os.path.join(self.tmp, 'in.epub')
+        make_epub(self.src)
+
+        self.prefs = merge_prefs({'heuristic': {'title_override': True,
+                                                'type_footnotes': True}})
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def original(self, name):
+        # what the container would hold for an untouched file
+        container = EpubContainer(self.src)
+        return serialize(parse_xml(container.read(name)))
+
+    def test_undo(self):
+        container = EpubContainer(self.src)
+        journal = Journal()
+        engine = Engine(self.prefs, journal=journal)
+        engine.run(container)
+
+        # 8 document changes, the OPF language and 7 metadata inserts
+        self.assertEqual(len(journal), 16)
+        self.assertEqual(journal.undo(container), (16, 0))
+        self.assertEqual(len(journal), 0)
+
+        for name in (CHAPTER, OPF):
+            self.assertEqual(container.raw_data(name, decode=False),
+                             self.original(name))
+
+    def test_undo_evicted(self):
+        # trees dropped under a memory budget are parsed again to undo
+        container = EpubContainer(self.src)
+        journal = Journal()
+        prefs = merge_prefs(dict(self.prefs, memory_budget=0.001))
+        Engine(prefs, journal=journal).run(container)
+
+        self.assertNotIn(CHAPTER, container.parsed_cache)
+        self.assertEqual(journal.undo(container), (16, 0))
+        self.assertEqual(container.raw_data(CHAPTER, decode=False),
+                         self.original(CHAPTER))
+
+    def test_undo_rewritten(self):
+        # documents rewritten as a whole are restored byte for byte
+        container = EpubContainer(self.src)
+        original = container.read(CHAPTER)
+
+        journal = Journal()
+        engine = Engine(self.prefs, journal=journal, stream_threshold=1)
+        engine.run(container)
+        self.assertEqual(journal.entries[0].op, 'data')
+
+        undone, conflicts = journal.undo(container)
+        self.assertEqual(conflicts, 0)
+        self.assertEqual(container.raw_data(CHAPTER, decode=False), original)
+
+    def test_undo_prefixed_metadata(self):
+        # inserted <meta> elements get the opf: prefix declared on
+        # <metadata>; undo must remove them, not the book's own ones
+        language = ('<dc:language>en</dc:language>\n'
+                    '    <meta property="dcterms:modified">'
+                    '2021-01-01T00:00:00Z</meta>\n'
+                    '    <meta property="schema:accessMode">textual</meta>')
+        make_epub(self.src, language=language)
+        with zipfile.ZipFile(self.src) as zf:
+            members = [(info, zf.read(info)) for info in zf.infolist()]
+        with zipfile.ZipFile(self.src, 'w') as zf:
+            for info, data in members:
+                if info.filename == OPF:
+                    data = data.replace(
+                        b'<metadata ', b'<metadata xmlns:opf='
+                        b'"http://www.idpf.org/2007/opf" ')
+                zf.writestr(info, data)
+
+        original = self.original(OPF)
+        container = EpubContainer(self.src)
+        journal = Journal()
+        Engine(self.prefs, journal=journal).run(container)
+        self.assertIn(b'<opf:meta', container.raw_data(OPF, decode=False))
+
+        undone, conflicts = journal.undo(container)
+        self.assertEqual(conflicts, 0)
+        self.assertEqual(container.raw_data(OPF, decode=False), original)
+
+    def test_conflicts(self):
+        container = EpubContainer(self.src)
+        journal = Journal()
+        Engine(self.prefs, journal=journal).run(container)
+
+        # edited after the run: left alone
+        root = container.parsed(CHAPTER)
+        root.set(XML_LANG, 'fr')
+
+        undone, conflicts = journal.undo(container)
+        self.assertEqual(conflicts, 1)
+        self.assertEqual(root.get(XML_LANG), 'fr')
+        self.assertIsNone(root.get('lang'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+'''
+Access Aide - A Calibre plugin to enhance accessibility features in epub files.
+Copyright (C) 2020-2021 Luca Baffa
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+import os
+import shutil
+import tempfile
+import unittest
+from importlib import import_module
+
+import langdetect
+from container import EpubContainer
+from engine import Engine, XML_LANG
+from prefs import merge_prefs
+
+make_epub = import_module('test-engine').make_epub
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+PASSAGES = [
+    'The author argues that these lines were added by a later editor, '
+    'probably in the twelfth century.',
+    'Quo usque tandem abutere, Catilina, patientia nostra? quam diu etiam '
+    'furor iste tuus nos eludet?',
+    'Der Mensch ist frei geschaffen, ist frei, und würd er in Ketten '
+    'geboren.',
+    'ἐν ἀρχῇ ἐποίησεν ὁ θεὸς τὸν οὐρανὸν καὶ τὴν γῆν. ἡ δὲ γῆ ἦν ἀόρατος.',
+    'Too short.',
+    'Это текст на языке, которого нет среди образцов модели.',
+]
+
+CHAPTER = '''<?xml version="1.0" encoding="UTF-8"?>
+<!DOCTYPE html>
+<html xmlns="http://www.w3.org/1999/xhtml"
+    xmlns:epub="http://www.idpf.org/2007/ops">
+<head><title>Chapter</title></head>
+<body>
+  <section>
+    <p>{0}</p>
+    <blockquote><p>{1}</p></blockquote>
+    <blockquote lang="de"><p>{2}</p></blockquote>
+    <ul><li><p>{3}</p></li></ul>
+  </section>
+</body>
+</html>'''.format(*PASSAGES)
+
+
+class TestModule(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.src = os.path.join(self.tmp, 'in.epub')
+        make_epub(self.src, chapter=CHAPTER)
+
+        self.prefs = merge_prefs({'heuristic': {'passage_lang': True}})
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_detect(self):
+        results = langdetect.detect(PASSAGES)
+
+        self.assertEqual([r and r[0] for r in results],
+                         ['en', 'la', 'de', 'grc', None, None])
+        for result in results[:4]:
+            self.assertGreater(result[1], 0.99)
+
+        self.assertEqual(langdetect.detect([]), [])
+
+    @unittest.skipIf(numpy is None, 'NumPy not installed')
+    def test_batch(self):
+        model = langdetect.load_model()
+        passages = PASSAGES + ['', '!!', ' \0 '] + PASSAGES
+
+        langdetect.CHUNK_SIZE, size = 100, langdetect.CHUNK_SIZE
+        try:
+            batch = model.detect_batch(passages, numpy)
+        finally:
+            langdetect.CHUNK_SIZE = size
+
+        for result, expected in zip(batch, map(model.detect_one, passages)):
+            if expected is None:
+                self.assertIsNone(result)
+            else:
+                self.assertEqual(result[0], expected[0])
+                self.assertAlmostEqual(result[1], expected[1])
+
+    def test_same_language(self):
+        self.assertTrue(langdetect.same_language('en', 'en-GB'))
+        self.assertTrue(langdetect.same_language('EN_us', 'en'))
+        self.assertFalse(langdetect.same_language('el', 'grc'))
+
+    def test_run(self):
+        container = EpubContainer(self.src)
+        engine = Engine(self.prefs)
+        engine.run(container)
+
+        root = container.parsed('OEBPS/text/chapter.xhtml')
+        paragraphs = root.xpath('//*[local-name()="p"]')
+
+        self.assertEqual([p.get('lang') for p in paragraphs],
+                         [None, 'la', None, 'grc'])
+        self.assertEqual(paragraphs[1].get(XML_LANG), 'la')
+        self.assertEqual(engine.passage_stat.get(), 2)
+        self.assertEqual(engine.counters['passages'], 4)
+        self.assertEqual(engine.counters['files_changed'], 2)
+        self.assertIn(engine.passage_stat, engine.stats())
+
+    def test_memory_budget(self):
+        container = EpubContainer(self.src)
+        prefs = merge_prefs(dict(self.prefs, memory_budget=0.001))
+        engine = Engine(prefs)
+        engine.run(container)
+
+        self.assertNotIn('OEBPS/text/chapter.xhtml', container.parsed_cache)
+        root = container.parsed('OEBPS/text/chapter.xhtml')
+        paragraphs = root.xpath('//*[local-name()="p"]')
+
+        self.assertEqual([p.get('lang') for p in paragraphs],
+                         [None, 'la', None, 'grc'])
+        self.assertEqual(engine.passage_stat.get(), 2)
+        self.assertEqual(engine.counters['files_changed'], 2)
+
+    def test_plan(self):
+        container = EpubContainer(self.src)
+        plan = Engine(self.prefs).plan(container)
+
+        added = [c['new'] for c in plan['changes'] if c['new'] == 'la']
+        self.assertEqual(len(added), 2)
+
+        root = container.parsed('OEBPS/text/chapter.xhtml')
+        self.assertFalse(root.xpath('//*[@lang="la"]'))
+
+    def test_disabled(self):
+        container = EpubContainer(self.src)
+        engine = Engine(merge_prefs({}))
+        engine.run(container)
+
+        self.assertEqual(engine.counters['passages'], 0)
+        self.assertNotIn(engine.passage_stat, engine.stats())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+'''
+Access Aide - A Calibre plugin to enhance accessibility features in epub files.
+Copyright (C) 2020-2021 Luca Baffa
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+
+import contextlib
+import io
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import cli
+from container import EpubContainer
+from engine import Engine
+from metrics import Metrics, current_rss
+from prefs import merge_prefs
+from synth import BookSpec, make_book
+
+
+class TestModule(unittest.TestCase):
+
+    def setUp(self):
+        self.metrics = Metrics(trace=True)
+
+    def test_counters(self):
+        self.metrics.incr('nodes')
+        self.metrics.start_file('a.xhtml')
+        self.metrics.incr('nodes', 2)
+        self.metrics.end_file()
+        self.metrics.incr('nodes')
+
+        self.assertEqual(self.metrics.get('nodes'), 4)
+        self.assertEqual(self.metrics.get('missing'), 0)
+        self.assertEqual(self.metrics.files['a.xhtml']['nodes'], 2)
+
+    def test_timer(self):
+        with self.metrics.timer('stage'):
+            sum(range(1000))
+        with self.metrics.timer('stage'):
+            pass
+
+        count, wall, cpu = self.metrics.timers['stage']
+        self.assertEqual(count, 2)
+        self.assertGreater(wall, 0)
+        self.assertGreaterEqual(cpu, 0)
+        self.assertEqual(len(self.metrics.events), 2)
+
+    def test_histogram(self):
+        for value in (0, 1, 3, 4, 1000):
+            self.metrics.observe('size', value)
+
+        data = self.metrics.snapshot()['histograms']['size']
+        self.assertEqual(data['count'], 5)
+        self.assertEqual(data['sum'], 1008)
+        self.assertEqual((data['min'], data['max']), (0, 1000))
+        self.assertEqual(data['buckets'], {'0': 1, '1': 1, '2': 1, '3': 1,
+                                           '10': 1})
+
+    def test_merge(self):
+        self.metrics.incr('nodes')
+        self.metrics.observe('size', 10)
+        with self.metrics.timer('stage'):
+            pass
+
+        other = Metrics(trace=True)
+        other.start_file('a.xhtml')
+        other.incr('nodes', 4)
+        other.observe('size', 100)
+        with other.timer('stage'):
+            pass
+        other.end_file()
+
+        # snapshots travel between processes as plain data
+        snapshot = json.loads(json.dumps(other.snapshot()))
+        self.metrics.merge(snapshot, prefix='book.epub/')
+
+        self.assertEqual(self.metrics.get('nodes'), 5)
+        self.assertEqual(self.metrics.files['book.epub/a.xhtml']['nodes'], 4)
+        self.assertEqual(self.metrics.timers['stage'][0], 2)
+        self.assertEqual(self.metrics.histograms['size'].count, 2)
+        self.assertEqual(self.metrics.histograms['size'].high, 100)
+        self.assertEqual(self.metrics.events[1][6], 'book.epub/a.xhtml')
+
+    def test_chrome_trace(self):
+        self.metrics.start_file('a.xhtml')
+        with self.metrics.timer('stage'):
+            pass
+
+        trace = json.loads(json.dumps(self.metrics.chrome_trace()))
+        event = trace['traceEvents'][0]
+        self.assertEqual(event['name'], 'stage')
+        self.assertEqual(event['ph'], 'X')
+        self.assertEqual(event['args']['file'], 'a.xhtml')
+
+    def test_no_trace(self):
+        metrics = Metrics()
+        with metrics.timer('stage'):
+            pass
+
+        self.assertEqual(metrics.timers['stage'][0], 1)
+        self.assertEqual(metrics.events, [])
+
+
+class TestEngine(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.src = os.path.join(self.tmp, 'in.epub')
+        make_book(self.src, BookSpec(documents=3, paragraphs=20,
+                                     footnote_density=0.5))
+        self.prefs = merge_prefs({'heuristic': {'title_override': True,
+                                                'type_footnotes': True}})
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_stats(self):
+        engine = Engine(self.prefs)
+        engine.run(EpubContainer(self.src))
+        metrics = engine.metrics
+
+        self.assertEqual(metrics.get('aria_stat'), engine.aria_stat.get())
+        self.assertEqual(sum(counters['aria_stat'] for counters in
+                             metrics.files.values()), engine.aria_stat.get())
+        self.assertEqual(metrics.files['OEBPS/text/doc0001.xhtml']
+                         ['title_stat'], 1)
+        self.assertEqual(metrics.timers['transform'][0], 3)
+        self.assertEqual(metrics.histograms['document_bytes'].count, 3)
+        self.assertEqual(metrics.histograms['document_nodes'].count, 3)
+
+    @unittest.skipIf(current_rss() is None, 'RSS not available')
+    def test_run_memory(self):
+        # memory used before the run does not count as its peak
+        block = b'x' * (64 * 1024 * 1024)
+        before = current_rss()
+        del block
+
+        engine = Engine(self.prefs)
+        engine.run(EpubContainer(self.src))
+        rss = engine.metrics.histograms['rss']
+
+        self.assertEqual(rss.count, 5)
+        self.assertLess(rss.high, before)
+        self.assertEqual(engine.report()['memory']['peak_rss'], rss.high)
+
+    def test_parallel(self):
+        serial = Engine(self.prefs)
+        serial.run(EpubContainer(self.src))
+
+        parallel = Engine(self.prefs)
+        parallel.run(EpubContainer(self.src), jobs=2)
+
+        self.assertEqual(parallel.stat_values(), serial.stat_values())
+        self.assertEqual(dict(parallel.metrics.files),
+                         dict(serial.metrics.files))
+        self.assertEqual(parallel.metrics.timers['transform'][0], 3)
+
+    def test_cli(self):
+        dst = os.path.join(self.tmp, 'out.epub')
+        path = os.path.join(self.tmp, 'metrics.json')
+        trace = os.path.join(self.tmp, 'trace.json')
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.assertEqual(cli.main(['run', self.src, dst, '--metrics',
+                                       path, '--trace', trace]), 0)
+
+        with open(path, encoding='utf-8') as f:
+            data = json.load(f)
+        self.assertIn('run', data['timers'])
+        self.assertGreater(data['counters']['lang_stat'], 0)
+
+        with open(trace, encoding='utf-8') as f:
+            data = json.load(f)
+        self.assertIn('commit', {e['name'] for e in data['traceEvents']})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+'''
+Access Aide - A Calibre plugin to enhance accessibility features in epub files.
+Copyright (C) 2020-2021 Luca Baffa
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+import unittest
+
+import lxml.etree
+
+from opf import MetadataIndex, make_meta, OPF_NS
+
+METADATA = '''<metadata xmlns="http://www.idpf.org/2007/opf"
+    xmlns:dc="http://purl.org/dc/elements/1.1/">
+  <dc:title>Test</dc:title>
+  <meta property="schema:accessModeSufficient">textual</meta>
+  <meta name="schema:accessibilityHazard" content="none"/>
+  <link rel="dcterms:conformsTo" href="http://example.com/wcag"/>
+</metadata>'''
+
+
+class Container():
+
+    def insert_into_xml(self, parent, item):
+        parent.append(item)
+
+
+class TestModule(unittest.TestCase):
+
+    def setUp(self):
+        self.metadata = lxml.etree.fromstring(METADATA)
+        self.index = MetadataIndex(self.metadata)
+
+    def test_has(self):
+        self.assertTrue(self.index.has('schema:accessModeSufficient'))
+        self.assertTrue(self.index.has('schema:accessModeSufficient',
+                                       'textual'))
+        self.assertTrue(self.index.has('schema:accessibilityHazard', 'none'))
+        self.assertTrue(self.index.has('dcterms:conformsTo'))
+        self.assertTrue(self.index.has('dcterms:conformsTo',
+                                       'http://example.com/wcag'))
+
+    def test_exact_match(self):
+        self.assertFalse(self.index.has('schema:accessMode'))
+        self.assertFalse(self.index.has('schema:accessMode', 'textual'))
+        self.assertFalse(self.index.has('schema:accessModeSufficient',
+                                        'text'))
+
+    def test_insert(self):
+        element = make_meta(3, 'schema:accessMode', 'visual')
+        self.index.insert(Container(), element)
+
+        self.assertIs(self.metadata[-1], element)
+        self.assertTrue(self.index.has('schema:accessMode', 'visual'))
+
+    def test_make_meta(self):
+        meta3 = make_meta(3, 'a11y:certifiedBy', 'Books Ltd')
+        self.assertEqual(meta3.tag, '{%s}meta' % OPF_NS)
+        self.assertEqual(meta3.get('property'), 'a11y:certifiedBy')
+        self.assertEqual(meta3.text, 'Books Ltd')
+
+        link3 = make_meta(3, 'a11y:certifierReport', 'http://r', link=True)
+        self.assertEqual(link3.tag, '{%s}link' % OPF_NS)
+        self.assertEqual(link3.get('rel'), 'a11y:certifierReport')
+        self.assertEqual(link3.get('href'), 'http://r')
+
+        meta2 = make_meta(2, 'a11y:certifierReport', 'http://r', link=True)
+        self.assertEqual(meta2.get('name'), 'a11y:certifierReport')
+        self.assertEqual(meta2.get('content'), 'http://r')
+
+
+if __name__ == '__main__':
+    unittest.main()
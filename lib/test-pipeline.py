@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+'''
+Access Aide - A Calibre plugin to enhance accessibility features in epub files.
+Copyright (C) 2020-2021 Luca Baffa
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+import contextlib
+import io
+import os
+import shutil
+import tempfile
+import unittest
+import zipfile
+from importlib import import_module
+
+import cli
+from batch import find_books, process_book
+from pipeline import STAGES, BookPipeline, format_stats
+from prefs import merge_prefs
+
+make_epub = import_module('test-engine').make_epub
+
+
+class TestModule(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.src_dir = os.path.join(self.tmp, 'books')
+        self.dst_dir = os.path.join(self.tmp, 'out')
+        os.makedirs(os.path.join(self.src_dir, 'sub'))
+        for name in ('book0.epub', 'book1.epub', 'sub/book2.epub'):
+            make_epub(os.path.join(self.src_dir, name))
+        with open(os.path.join(self.src_dir, 'broken.epub'), 'w') as f:
+            f.write('not a zip file')
+
+        self.prefs = merge_prefs({'heuristic': {'title_override': True,
+                                                'type_footnotes': True}})
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_pipeline(self):
+        books = find_books(self.src_dir, recursive=True)
+        pipeline = BookPipeline(self.prefs, jobs=2, threads=2, queue_size=1)
+        results = list(pipeline.run(books, self.src_dir, self.dst_dir))
+
+        self.assertEqual(sorted(r['input'] for r in results), books)
+        failed = [r for r in results if not r['ok']]
+        self.assertEqual(len(failed), 1)
+        self.assertTrue(failed[0]['input'].endswith('broken.epub'))
+        self.assertIn('BadZipFile', failed[0]['error'])
+
+        # the same book as processed in one go
+        expected = os.path.join(self.tmp, 'expected.epub')
+        process_book(books[1], expected, self.prefs)
+        with zipfile.ZipFile(expected) as a, \
+                zipfile.ZipFile(os.path.join(self.dst_dir, 'book1.epub')) \
+                as b:
+            self.assertEqual(b.namelist(), a.namelist())
+            self.assertEqual(b.infolist()[0].compress_type,
+                             zipfile.ZIP_STORED)
+            for name in a.namelist():
+                self.assertEqual(b.read(name), a.read(name))
+        self.assertTrue(os.path.exists(os.path.join(self.dst_dir, 'sub',
+                                                    'book2.epub')))
+
+        ok = [r for r in results if r['ok']]
+        self.assertEqual(ok[0]['stats']['Language attributes'], 3)
+        self.assertEqual(ok[0]['files_changed'], 2)
+        self.assertIn('serialise', ok[0]['metrics']['timers'])
+
+        stats = pipeline.stats()
+        self.assertEqual(list(stats), list(STAGES))
+        self.assertEqual(stats['read']['items'], 4)
+        # the broken book goes through every stage, doing nothing
+        self.assertEqual(stats['write']['items'], 4)
+        self.assertEqual(stats['transform']['workers'], 2)
+        for data in stats.values():
+            self.assertLessEqual(data['max_queue'], 1)
+            self.assertTrue(0 <= data['utilisation'] <= 1)
+        self.assertEqual(len(format_stats(stats)), len(STAGES))
+
+    def test_cli(self):
+        stdout = io.StringIO()
+        with contextlib.redirect_stdout(stdout), \
+                contextlib.redirect_stderr(io.StringIO()):
+            self.assertEqual(cli.main(['batch', self.src_dir, '-o',
+                                       self.dst_dir, '--pipeline', '-j', '2',
+                                       '--queue-size', '2']), 1)
+
+        self.assertIn('3 books processed, 1 failed.', stdout.getvalue())
+        self.assertIn('utilisation', stdout.getvalue())
+        self.assertTrue(os.path.exists(os.path.join(self.dst_dir,
+                                                    'book0.epub')))
+
+
+if __name__ == '__main__':
+    unittest.main()
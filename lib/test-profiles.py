@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+'''
+Access Aide - A Calibre plugin to enhance accessibility features in epub files.
+Copyright (C) 2020-2021 Luca Baffa
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+
+import contextlib
+import io
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from importlib import import_module
+
+import lxml.etree
+
+import cli
+from container import EpubContainer
+from engine import Engine
+from prefs import merge_prefs
+from profiles import (ProfileError, compile_plan, get_plan, get_profile,
+                      load_profiles, profiles_path)
+
+make_epub = import_module('test-engine').make_epub
+
+
+class TestModule(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.home = os.environ.get('ACCESS_AIDE_HOME')
+        os.environ['ACCESS_AIDE_HOME'] = self.tmp
+
+        self.prefs = merge_prefs({
+            'force_override': True,
+            'heuristic': {'type_footnotes': True},
+            'access': {'accessMode': ['textual']},
+            'a11y': {'certifiedBy': 'Imprint'},
+        })
+
+    def tearDown(self):
+        if self.home is None:
+            del os.environ['ACCESS_AIDE_HOME']
+        else:
+            os.environ['ACCESS_AIDE_HOME'] = self.home
+        shutil.rmtree(self.tmp)
+
+    def test_compile_plan(self):
+        plan = compile_plan(self.prefs, name='imprint')
+
+        self.assertEqual(plan.rules, ('add_fn_type', 'add_lang', 'add_aria'))
+        self.assertTrue(plan.force_override)
+        self.assertEqual([(i.key, i.value) for i in plan.a11y],
+                         [('a11y:certifiedBy', 'Imprint')])
+
+        access_mode = [i for i in plan.access if i.key == 'schema:accessMode']
+        self.assertEqual(len(access_mode), 1)
+        self.assertEqual(access_mode[0].element(2).get('content'), 'textual')
+        self.assertEqual(access_mode[0].element(3).text, 'textual')
+
+        # elements are copied, the plan is never changed
+        element = access_mode[0].element(3)
+        lxml.etree.Element('metadata').append(element)
+        self.assertIsNone(access_mode[0].epub3.getparent())
+
+    def test_class_rules(self):
+        plan = compile_plan(self.prefs)
+        self.assertIn('_idFootnoteLink', plan.classes.by_class)
+
+        # user rules run after the InDesign ones, and on their own
+        prefs = merge_prefs({'heuristic': {'type_footnotes': False},
+                             'class_rules': [{'class': '_idFootnoteLink',
+                                              'set': {'role': 'link'}}]})
+        plan = compile_plan(prefs)
+        self.assertIn('add_fn_type', plan.rules)
+        self.assertEqual(len(plan.classes.by_class['_idFootnoteLink']), 1)
+
+        self.assertNotIn('add_fn_type', compile_plan(merge_prefs({})).rules)
+
+        with self.assertRaises(ProfileError):
+            compile_plan(merge_prefs({'class_rules': [{'class': 'x'}]}))
+
+    def test_get_plan(self):
+        plan = get_plan('imprint', self.prefs)
+        self.assertIs(get_plan('imprint', self.prefs), plan)
+
+        prefs = merge_prefs({'force_override': False}, self.prefs)
+        self.assertIsNot(get_plan('imprint', prefs), plan)
+
+    def test_run_plan(self):
+        src = os.path.join(self.tmp, 'in.epub')
+        make_epub(src)
+
+        with_prefs = Engine(self.prefs)
+        with_prefs.run(EpubContainer(src))
+
+        with_plan = Engine(self.prefs, run_plan=compile_plan(self.prefs))
+        with_plan.run(EpubContainer(src))
+
+        self.assertEqual(with_plan.stat_values(), with_prefs.stat_values())
+
+    def test_profiles(self):
+        self.assertEqual(load_profiles(), {})
+
+        with open(profiles_path(), 'w', encoding='utf-8') as f:
+            json.dump({'imprint': {'force_override': True}}, f)
+
+        prefs = get_profile('imprint')
+        self.assertTrue(prefs['force_override'])
+        self.assertIn('access', prefs)
+
+        with self.assertRaises(ProfileError):
+            get_profile('missing')
+
+    def test_cli(self):
+        src = os.path.join(self.tmp, 'in.epub')
+        dst = os.path.join(self.tmp, 'out.epub')
+        make_epub(src)
+
+        with contextlib.redirect_stderr(io.StringIO()):
+            self.assertEqual(cli.main(['run', src, dst, '--profile',
+                                       'imprint']), 2)
+
+        with open(profiles_path(), 'w', encoding='utf-8') as f:
+            json.dump({'imprint': self.prefs}, f)
+
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            self.assertEqual(cli.main(['run', src, dst, '--profile',
+                                       'imprint']), 0)
+        self.assertIn('epub:type to footnote', output.getvalue())
+
+
+if __name__ == '__main__':
+    unittest.main()
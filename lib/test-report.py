@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+'''
+Access Aide - A Calibre plugin to enhance accessibility features in epub files.
+Copyright (C) 2020-2021 Luca Baffa
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+
+import contextlib
+import io
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from importlib import import_module
+
+import cli
+from batch import find_books, run_batch
+from container import EpubContainer
+from engine import Engine
+from pipeline import BookPipeline
+from prefs import merge_prefs
+
+make_epub = import_module('test-engine').make_epub
+
+CHAPTER = 'OEBPS/text/chapter.xhtml'
+
+
+class TestModule(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.src = os.path.join(self.tmp, 'in.epub')
+        self.dst = os.path.join(self.tmp, 'out.epub')
+        make_epub(self.src)
+
+        self.prefs = merge_prefs({'heuristic': {'title_override': True,
+                                                'type_footnotes': True}})
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_report(self):
+        engine = Engine(self.prefs)
+        engine.run(EpubContainer(self.src))
+        report = json.loads(json.dumps(engine.report(book='in.epub')))
+
+        self.assertTrue(report['ok'])
+        self.assertEqual(report['book'], 'in.epub')
+        self.assertEqual(report['changes'], {'lang': 3, 'role': 4,
+                                             'title': 1, 'noteref': 1,
+                                             'passage_lang': 0})
+        self.assertEqual(report['files'][CHAPTER], {'lang': 2, 'role': 4,
+                                                    'title': 1, 'noteref': 1,
+                                                    'passage_lang': 0})
+        self.assertEqual(report['files']['OEBPS/content.opf']['lang'], 1)
+        self.assertEqual(report['metadata'], {'inserted': 7, 'skipped': 0})
+        self.assertEqual(report['documents']['changed'], 2)
+        self.assertIn('run', report['durations'])
+
+    def test_metadata_skipped(self):
+        container = EpubContainer(self.src)
+        Engine(self.prefs).run(container)
+
+        engine = Engine(self.prefs)
+        engine.run(container)
+        report = engine.report()
+
+        self.assertEqual(report['metadata'], {'inserted': 0, 'skipped': 7})
+        self.assertEqual(report['changes']['lang'], 0)
+
+    def test_missing_language(self):
+        make_epub(self.src, language='')
+        path = os.path.join(self.tmp, 'report.json')
+
+        with contextlib.redirect_stderr(io.StringIO()):
+            self.assertEqual(cli.main(['run', self.src, self.dst,
+                                       '--report', path]), 1)
+
+        with open(path, encoding='utf-8') as f:
+            report = json.load(f)
+        self.assertFalse(report['ok'])
+        self.assertEqual(report['errors'][0]['code'], 'missing-language')
+
+    def test_batch(self):
+        src_dir = os.path.join(self.tmp, 'books')
+        os.makedirs(src_dir)
+        make_epub(os.path.join(src_dir, 'book.epub'))
+        make_epub(os.path.join(src_dir, 'nolang.epub'), language='')
+        path = os.path.join(self.tmp, 'reports.jsonl')
+
+        for _ in range(2):
+            with contextlib.redirect_stdout(io.StringIO()), \
+                    contextlib.redirect_stderr(io.StringIO()):
+                cli.main(['batch', src_dir, '-o',
+                          os.path.join(self.tmp, 'out'), '--report', path])
+
+        with open(path, encoding='utf-8') as f:
+            reports = [json.loads(line) for line in f]
+
+        # reports are appended, one per line
+        self.assertEqual(len(reports), 4)
+        by_book = {os.path.basename(r['book']): r for r in reports[:2]}
+        self.assertTrue(by_book['book.epub']['ok'])
+        self.assertEqual(by_book['book.epub']['files'][CHAPTER]['noteref'],
+                         0)
+        self.assertEqual(by_book['nolang.epub']['errors'][0]['code'],
+                         'missing-language')
+
+    def test_batch_sections(self):
+        src_dir = os.path.join(self.tmp, 'books')
+        os.makedirs(src_dir)
+        make_epub(os.path.join(src_dir, 'book.epub'))
+        books = find_books(src_dir)
+        prefs = merge_prefs({'image_report': True, 'audit': True,
+                             'infer_access': True})
+
+        engine = Engine(prefs)
+        engine.run(EpubContainer(books[0]))
+        expected = engine.report()
+
+        # every mode reports the same sections as `run`
+        for mode in ('batch', 'pipeline'):
+            out = os.path.join(self.tmp, mode)
+            if mode == 'batch':
+                results = run_batch(books, src_dir, out, prefs, jobs=1)
+            else:
+                results = BookPipeline(prefs, jobs=1).run(books, src_dir,
+                                                          out)
+            report = list(results)[0]['report']
+
+            for section in ('images', 'audit', 'inferred'):
+                self.assertEqual(report[section], expected[section])
+
+
+if __name__ == '__main__':
+    unittest.main()
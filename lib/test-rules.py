@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+'''
+Access Aide - A Calibre plugin to enhance accessibility features in epub files.
+Copyright (C) 2020-2021 Luca Baffa
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import rules
+
+
+class TestModule(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp, 'plugins', rules.CACHE_NAME)
+        rules._tables = None
+
+    def tearDown(self):
+        rules._tables = None
+        shutil.rmtree(self.tmp)
+
+    def test_compile_aria(self):
+        aria = rules.compile_aria(
+            {'noteref': {'tag': ['a'], 'aria': 'doc-noteref'},
+             'cover': {'tag': ['img'], 'aria': 'doc-cover'},
+             'chapter': {'tag': ['section'], 'aria': 'doc-chapter'}},
+            ['a', 'img', 'span'])
+
+        self.assertEqual(aria[('chapter', 'section')],
+                         ('doc-chapter', False, False))
+        self.assertEqual(aria[('chapter', 'span')],
+                         ('doc-chapter', False, False))
+        self.assertEqual(aria[('noteref', 'a')], ('doc-noteref', False, False))
+        self.assertEqual(aria[('chapter', 'a')], ('doc-chapter', False, True))
+        self.assertEqual(aria[('cover', 'img')], ('doc-cover', True, False))
+        self.assertNotIn(('chapter', 'div'), aria)
+
+    def test_compile_class_rule(self):
+        rule = rules.compile_class_rule(
+            {'class': 'note', 'tag': 'a', 'attrib': {'href': True,
+                                                     'epub:type': False},
+             'set': {'epub:type': 'noteref', 'role': 'doc-noteref'}})
+
+        self.assertEqual(rule.token, 'note')
+        self.assertEqual(rule.tags, frozenset(['a']))
+        self.assertEqual(rule.attribs,
+                         (('href', True),
+                          ('{http://www.idpf.org/2007/ops}type', False)))
+        self.assertEqual(rule.sets[0],
+                         ('{http://www.idpf.org/2007/ops}type', 'noteref'))
+
+        for invalid in ({'set': {'role': 'note'}},
+                        {'class': 'a b', 'set': {'role': 'note'}},
+                        {'class': 'note'},
+                        {'class': 'note', 'set': {'foo:type': 'note'}},
+                        {'class': 'note', 'attrib': {'href': 1},
+                         'set': {'role': 'note'}}):
+            with self.assertRaises(ValueError):
+                rules.compile_class_rule(invalid)
+
+    def test_index_class_rules(self):
+        compiled = [rules.compile_class_rule(rule) for rule in (
+            {'class': 'note', 'set': {'role': 'note'}},
+            {'tag': ['aside', 'div'], 'set': {'role': 'note'}},
+            {'class': 'note', 'tag': 'a', 'set': {'role': 'doc-noteref'}})]
+
+        index = rules.index_class_rules(compiled)
+
+        self.assertEqual(index.by_class['note'], (compiled[0], compiled[2]))
+        self.assertEqual(index.by_tag['div'], (compiled[1],))
+        self.assertNotIn('a', index.by_tag)
+
+    def test_load_rule_tables(self):
+        tables = rules.load_rule_tables(self.path)
+
+        self.assertEqual(tables.version, rules.RULES_VERSION)
+        self.assertEqual(len(tables.digest), 40)
+        self.assertEqual(tables.aria[('chapter', 'section')].role,
+                         'doc-chapter')
+        self.assertIn('alternativeText', tables.features)
+        self.assertIn('noteref', tables.types)
+        self.assertIn('_idFootnoteLink', [r.token for r in tables.classes])
+
+        # loaded once per process
+        self.assertIs(rules.load_rule_tables(self.path), tables)
+
+        # immutable
+        with self.assertRaises(TypeError):
+            tables.aria[('chapter', 'div')] = None
+
+    def test_disk_cache(self):
+        tables = rules.load_rule_tables(self.path)
+        self.assertTrue(os.path.exists(self.path))
+
+        # a later start reads the compiled form instead of the JSON assets
+        rules._tables = None
+        build = rules.build
+        rules.build = None
+        try:
+            cached = rules.load_rule_tables(self.path)
+        finally:
+            rules.build = build
+
+        self.assertEqual(dict(cached.aria), dict(tables.aria))
+        self.assertEqual(cached.digest, tables.digest)
+
+    def test_stale_cache(self):
+        rules.write_cache(self.path, 'outdated',
+                          {'aria': {}, 'features': [], 'classes': []})
+
+        tables = rules.load_rule_tables(self.path)
+        self.assertTrue(tables.aria)
+
+
+if __name__ == '__main__':
+    unittest.main()
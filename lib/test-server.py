@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+'''
+Access Aide - A Calibre plugin to enhance accessibility features in epub files.
+Copyright (C) 2020-2021 Luca Baffa
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+import asyncio
+import io
+import json
+import os
+import shutil
+import tempfile
+import unittest
+import zipfile
+from importlib import import_module
+from unittest import mock
+
+from server import EPUB_MIME, JSON_MIME, HTTPError, JobServer, is_loopback
+
+make_epub = import_module('test-engine').make_epub
+
+
+async def request(path, method, target, body=b'', content_type=JSON_MIME):
+    '''Send a request to the Unix socket `path`, returning (status,
+    headers, body).'''
+
+    reader, writer = await asyncio.open_unix_connection(path)
+    head = '{} {} HTTP/1.1\r\nContent-Type: {}\r\nContent-Length: {}\r\n' \
+           '\r\n'.format(method, target, content_type, len(body))
+    writer.write(head.encode('latin-1') + body)
+    await writer.drain()
+
+    data = await reader.read()
+    writer.close()
+
+    head, _, body = data.partition(b'\r\n\r\n')
+    lines = head.decode('latin-1').split('\r\n')
+    headers = dict(line.split(': ', 1) for line in lines[1:])
+    return int(lines[0].split()[1]), headers, body
+
+
+class TestModule(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.src = os.path.join(self.tmp, 'in.epub')
+        self.dst = os.path.join(self.tmp, 'out.epub')
+        self.socket = os.path.join(self.tmp, 'aide.sock')
+        make_epub(self.src)
+
+        patcher = mock.patch.dict(os.environ, {'ACCESS_AIDE_HOME': self.tmp})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_jobs(self):
+        async def scenario():
+            server = JobServer(workers=1)
+            await server.start()
+            await server.listen(path=self.socket)
+
+            try:
+                job = json.dumps({'input': self.src, 'output': self.dst})
+                status, _, body = await request(self.socket, 'POST', '/jobs',
+                                                job.encode('utf-8'))
+                self.assertEqual(status, 200)
+                report = json.loads(body)
+                self.assertTrue(report['ok'])
+                self.assertEqual(report['book'], self.src)
+                self.assertTrue(os.path.exists(self.dst))
+
+                with open(self.src, 'rb') as f:
+                    status, headers, body = await request(
+                        self.socket, 'POST', '/jobs', f.read(), EPUB_MIME)
+                self.assertEqual(status, 200)
+                self.assertEqual(headers['Content-Type'], EPUB_MIME)
+                with zipfile.ZipFile(io.BytesIO(body)) as zf:
+                    self.assertEqual(zf.namelist()[0], 'mimetype')
+
+                status, _, body = await request(self.socket, 'GET',
+                                                '/metrics')
+                return status, json.loads(body)
+            finally:
+                await server.close()
+
+        status, stats = asyncio.run(scenario())
+
+        self.assertEqual(status, 200)
+        self.assertEqual(stats['queue'], {'depth': 0, 'size': 16,
+                                          'running': 0, 'workers': 1})
+        self.assertEqual(stats['latency_ms']['total']['count'], 2)
+        self.assertEqual(stats['metrics']['counters']['jobs_done'], 2)
+        self.assertEqual(stats['metrics']['counters']['files_changed'], 4)
+        self.assertIn('opf', stats['metrics']['timers'])
+
+    def test_errors(self):
+        async def scenario():
+            server = JobServer(workers=1)
+            await server.start()
+            await server.listen(path=self.socket)
+
+            statuses = []
+            try:
+                for target, body, content_type in (
+                        ('/jobs', b'{"input": 1}', JSON_MIME),
+                        ('/jobs?profile=nope', b'', EPUB_MIME),
+                        ('/jobs', b'not a zip', EPUB_MIME),
+                        ('/books', b'', JSON_MIME)):
+                    status, _, body = await request(self.socket, 'POST',
+                                                    target, body,
+                                                    content_type)
+                    statuses.append(status)
+            finally:
+                await server.close()
+            return statuses
+
+        self.assertEqual(asyncio.run(scenario()), [400, 404, 422, 404])
+
+    def test_backpressure(self):
+        async def scenario():
+            # no workers, so that jobs stay queued
+            server = JobServer(queue_size=1)
+            await server.listen(path=self.socket)
+
+            try:
+                server.submit(self.src, self.dst, None, None)
+                with self.assertRaises(HTTPError):
+                    server.submit(self.src, self.dst, None, None)
+
+                job = json.dumps({'input': self.src, 'output': self.dst})
+                status, headers, _ = await request(
+                    self.socket, 'POST', '/jobs', job.encode('utf-8'))
+                _, _, body = await request(self.socket, 'GET', '/metrics')
+            finally:
+                await server.close()
+            return status, headers, json.loads(body)
+
+        status, headers, stats = asyncio.run(scenario())
+
+        self.assertEqual(status, 503)
+        self.assertEqual(headers['Retry-After'], '1')
+        self.assertEqual(stats['queue']['depth'], 1)
+        self.assertEqual(stats['metrics']['counters'],
+                         {'jobs_accepted': 1, 'jobs_rejected': 2})
+
+    def test_loopback_only(self):
+        for host in ('127.0.0.1', '127.0.0.2', '::1', 'localhost'):
+            self.assertTrue(is_loopback(host))
+        for host in ('0.0.0.0', '::', '', None, '192.168.1.10', 'example.com'):
+            self.assertFalse(is_loopback(host))
+
+        # path jobs must not be reachable from other machines
+        async def scenario():
+            server = JobServer(workers=1)
+            with self.assertRaises(ValueError):
+                await server.listen(host='0.0.0.0')
+            self.assertEqual(server.servers, [])
+
+        asyncio.run(scenario())
+
+
+if __name__ == '__main__':
+    unittest.main()
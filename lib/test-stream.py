@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+'''
+Access Aide - A Calibre plugin to enhance accessibility features in epub files.
+Copyright (C) 2020-2021 Luca Baffa
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+import io
+import os
+import shutil
+import tempfile
+import unittest
+
+from container import EpubContainer, parse_xml, serialize
+from engine import Engine
+from prefs import merge_prefs
+from stream import DocumentStreamer, StreamError
+
+CHAPTER = '''<?xml version="1.0" encoding="UTF-8"?>
+<!DOCTYPE html>
+<html xmlns="http://www.w3.org/1999/xhtml"
+    xmlns:epub="http://www.idpf.org/2007/ops">
+<head><title>Wrong</title></head>
+<body>
+  <!-- a comment -->
+  <section epub:type="chapter">
+    <h1>Chapter <em>One</em> &amp; more</h1>
+    <p>Text<a class="_idFootnoteLink _idGenColorInherit"
+        href="#fn1">1</a> "quoted" &lt;tail&gt;</p>
+    <img src="a.png"/>
+    <aside epub:type="footnote" id="fn1">
+      <a class="_idFootnoteAnchor" href="#back">1</a>
+    </aside>
+  </section>
+</body>
+</html>'''
+
+
+class TestModule(unittest.TestCase):
+
+    def setUp(self):
+        self.prefs = merge_prefs({'heuristic': {'title_override': True,
+                                                'type_footnotes': True}})
+
+    def tree(self, data):
+        engine = Engine(self.prefs)
+        root = parse_xml(data)
+        changes = engine.transform(root, 'en')
+        return serialize(root), len(changes), engine
+
+    def stream(self, data, **kwargs):
+        engine = Engine(self.prefs)
+        streamer = DocumentStreamer(engine, engine.document_rules(), **kwargs)
+        sink = io.BytesIO()
+        changes = streamer.run(io.BytesIO(data), sink, 'en')
+        return sink.getvalue(), changes, engine
+
+    def test_same_output(self):
+        data = CHAPTER.encode('utf-8')
+        tree_output, tree_changes, tree_engine = self.tree(data)
+        output, changes, engine = self.stream(data)
+
+        self.assertEqual(output, tree_output)
+        self.assertEqual(changes, tree_changes)
+        self.assertEqual(engine.stat_values(), tree_engine.stat_values())
+        self.assertEqual(engine.counters['streamed'], 1)
+
+    def test_same_output_prolog(self):
+        # carriage returns in text, comments and PIs around the root
+        data = CHAPTER.replace('<!DOCTYPE html>\n', '<!-- before -->') \
+                      .replace('"quoted"', '"quoted"&#13;\n&#13;') \
+                      .replace('Text<a', 'Text<a title="a&#13;b"') \
+                      .replace('</html>', '</html>\n<!-- after --><?pi x?>')
+        tree_output, _, _ = self.tree(data.encode('utf-8'))
+        output, _, _ = self.stream(data.encode('utf-8'))
+
+        self.assertIn(b'&#13;\n&#13;', output)
+        self.assertIn(b'<!-- before --><html', output)
+        self.assertEqual(output, tree_output)
+
+    def test_prolog_doctype(self):
+        # lxml keeps comments on their side of the doctype, which
+        # iterparse does not tell
+        data = CHAPTER.replace('<!DOCTYPE html>', '<!-- c --><!DOCTYPE html>')
+
+        with self.assertRaises(StreamError):
+            self.stream(data.encode('utf-8'))
+
+    def test_rerun_is_clean(self):
+        output, changes, _ = self.stream(CHAPTER.encode('utf-8'))
+        self.assertGreater(changes, 0)
+
+        again, changes, _ = self.stream(output)
+        self.assertEqual(changes, 0)
+        self.assertEqual(again, output)
+
+    def test_lookahead(self):
+        # the title is left alone when the h1 is too far away
+        data = CHAPTER.replace('<body>', '<body><p>{}</p>'.format(
+            'x' * 1024)).encode('utf-8')
+        output, _, _ = self.stream(data, lookahead=256)
+
+        self.assertIn(b'<title>Wrong</title>', output)
+        self.assertIn(b'role="doc-chapter"', output)
+
+    def test_entities(self):
+        data = CHAPTER.replace('<!DOCTYPE html>',
+                               '<!DOCTYPE html [<!ENTITY x "y">]>') \
+                      .replace('Text', 'Text &x;').encode('utf-8')
+
+        with self.assertRaises(StreamError):
+            self.stream(data)
+
+
+class TestEngine(unittest.TestCase):
+
+    def setUp(self):
+        from importlib import import_module
+        make_epub = import_module('test-engine').make_epub
+
+        self.tmp = tempfile.mkdtemp()
+        self.src = os.path.join(self.tmp, 'in.epub')
+        make_epub(self.src, chapter=CHAPTER)
+        self.prefs = merge_prefs({'heuristic': {'title_override': True,
+                                                'type_footnotes': True}})
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_run(self):
+        name = 'OEBPS/text/chapter.xhtml'
+
+        container = EpubContainer(self.src)
+        Engine(self.prefs).run(container)
+        expected = container.raw_data(name, decode=False)
+
+        container = EpubContainer(self.src)
+        engine = Engine(self.prefs, stream_threshold=1)
+        engine.run(container)
+
+        self.assertEqual(container.raw_data(name, decode=False), expected)
+        self.assertEqual(engine.counters['streamed'], 1)
+        self.assertEqual(engine.counters['files_changed'], 2)
+
+    def test_fallback(self):
+        from importlib import import_module
+        make_epub = import_module('test-engine').make_epub
+
+        chapter = CHAPTER.replace('<!DOCTYPE html>',
+                                  '<!DOCTYPE html [<!ENTITY x "y">]>') \
+                         .replace('Text', 'Text &x;')
+        make_epub(self.src, chapter=chapter)
+
+        container = EpubContainer(self.src)
+        engine = Engine(self.prefs, stream_threshold=1)
+        engine.run(container)
+
+        self.assertEqual(engine.counters['stream_fallbacks'], 1)
+        self.assertEqual(engine.lang_stat.get(), 3)
+        self.assertIn(b'&x;', container.raw_data('OEBPS/text/chapter.xhtml',
+                                                 decode=False))
+
+
+if __name__ == '__main__':
+    unittest.main()